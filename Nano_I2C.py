@@ -1,78 +1,55 @@
 import os
 import time
 import typing
-import struct
+import hashlib
+import collections
 
-class I2CPacket:
+from i2c_packet import I2CPacket, PacketCodec
+
+class Backoff:
     '''
-    Contains functions that aim to abstract away all the functionality
-    related to packets, mainly building it and verifying packet integrity
-    Packet structure:
-    Size of data                - Python type
-    245 byte for data           - bytes
-    1 byte for data length      - integer
-    1 byte for status messages  - bytes
-    4 bytes for checksum        - integer
-    4 bytes for sequence number - integer
-    1 byte for sender ID        - bytes
+    Poll interval that starts at shortest after activity and grows by factor
+    up to longest while nothing happens
     '''
+    def __init__(self, shortest=0.001, longest=0.05, factor=1.5):
+        self.shortest = shortest
+        self.longest = longest
+        self.factor = factor
+        self.interval = shortest
 
-    struct_format: str = '=245sBcIIc'
-    data_len: int = 245
-    data_index: int = 0
-    dlen_index: int = 1
-    stat_index: int = 2
-    par_index: int = 3
-    seq_index: int = 4
-    id_index: int = 5
-
-    def create_pkt(data: bytes, size: int, status: str,
-                   sequence: int, ID: str):
-        '''
-        Builds a packet containing the specified data. Adds in checksum.
-        Returns bytes object for writing.
-        '''
-        # Check lengths of input. Return false if packing cannot be done
-        if size > I2CPacket.data_len:
-            return False
-
-        # Create packet with zero checksum for calculation
-        pkt_array = bytearray(struct.pack(I2CPacket.struct_format,
-                                data, size, status[:1].encode(),
-                                          0, sequence, ID[:1].encode()))
-
-        # Use the sum of the packet array to set the checksum
-        pkt_array[247:251] = sum(pkt_array).to_bytes(4, 'little')
+    def reset(self):
+        self.interval = self.shortest
 
-        # Convert to bytes object and return it
-        pkt = bytes(pkt_array)
+    def wait(self):
+        time.sleep(self.interval)
+        self.interval = min(self.interval * self.factor, self.longest)
 
-        return pkt
-
-    def parse_pkt(pkt: bytes):
-        '''
-        Unpacks packet, returns resulting tuple
-        '''
-        return struct.unpack(I2CPacket.struct_format, pkt)
+class EepromTransport:
+    '''
+    Keeps one file descriptor open on the eeprom buffer and reads and
+    writes it in place with positional I/O, instead of opening the sysfs
+    file for every packet. path can be any file of at least
+    slots * blocksize bytes, e.g. a temp file standing in for the eeprom.
+    A larger eeprom (e.g. slave-24c32) holds several packet slots, slot 0
+    being the one the single-slot protocol uses.
+    '''
 
-    def verify_pkt(pkt: bytes):
-        '''
-        Given a packet, calculates checksum, checks with provided checksum of
-        packet.
-        Returns True if they match, False if they do not.
-        '''
-        # Convert to byte array
-        pkt_array = bytearray(pkt)
+    def __init__(self, path: str, blocksize: int = 256, slots: int = 1):
+        self.path = path
+        self.blocksize = blocksize
+        self.slots = slots
+        self.fd = os.open(path, os.O_RDWR)
 
-        # Extract checksum from packet
-        provided = int.from_bytes(pkt_array[247:251], 'little', signed=False)
+    def read(self, slot: int = 0):
+        return os.pread(self.fd, self.blocksize, slot * self.blocksize)
 
-        # Substitute checksum with all zeros
-        pkt_array[247:251] = bytearray(4)
+    def write(self, data: bytes, slot: int = 0):
+        return os.pwrite(self.fd, data, slot * self.blocksize)
 
-        # Calculate checksum
-        calculated = sum(pkt_array)
-        return calculated == provided
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
 class Nano_I2CBus:
     '''
@@ -88,143 +65,278 @@ class Nano_I2CBus:
 
     buf: str = '/sys/bus/i2c/devices/0-0064/slave-eeprom'
     blocksize: int = 256
+    slots: int = 1                   # Packet slots in the eeprom (16 for a 24c32)
+    resend_after: float = 0.5        # Windowed transfer: resend unacked packets after
+    keep_transfers: int = 4          # Files kept for the Pi to resume a transfer
     timewait: float = 0.2 # Time delay to help with data transmission
 
     pkt_self_id: str = 'J'           # This system's packet ID
     pkt_targ_id: str = 'P'           # The target packet ID (RPi)
 
-    def __init__(self):
+    def __init__(self, buf: str = None, slots: int = None):
+        '''
+        buf overrides the eeprom path, e.g. with a plain file for testing.
+        slots is the number of packets the eeprom holds; more than one
+        enables windowed file transfers.
+        '''
+        if buf is not None:
+            self.buf = buf
+        if slots is not None:
+            self.slots = slots
+        self.transport = EepromTransport(self.buf, self.blocksize, self.slots)
+        self.codec = PacketCodec()   # Checksum version 1 until the Pi asks for another
         self.log = open('logfile', 'w')
         self.vision = False
+        self.writes = 0              # Packets written, to tell replies apart
+        self.last_read = None        # Last block read and what poll_pkt made of it
+        self.last_writes = 0
+        self.last_result = None
+        self.transfers = collections.OrderedDict()  # file name -> (chunks, digest)
         print('Nano I2C Ready')
 
+    def close(self):
+        self.transport.close()
+        self.log.close()
+
     def write_log(self, msg: str):
         date = time.asctime()
 
         self.log.write(date + ': ' + msg + '\n')
 
-    def write_pkt(self, response, status, sequence):
+    def write_pkt(self, response, status, sequence, slot: int = 0):
         '''
-        Takes a string, converts it to bytes to send across I2C to the
-        specified target.
+        Builds a packet around response and writes it to the buffer for
+        the target to read.
 
-        msg limited to 256 bytes.
+        response limited to I2CPacket.data_len bytes.
 
-        Returns number bytes sent
+        Returns number bytes sent, False if response does not fit
         '''
-        pkt = I2CPacket.create_pkt(response, len(response), status, 
-                                sequence, self.pkt_self_id)
-        
-        # If pkt is already in bytes, do nothing
-        if type(pkt) == bytes:
-            pass
-
-        # Otherwise if the data is a string, encode it with UTF-8
-        elif type(pkt) == str:
-            pkt = pkt.encode(encoding='UTF-8', errors='replace')
-
-        # Otherwise try to convert it to a bytes object
-        else:
-            try:
-                pkt = bytes(pkt)
-
-            # If this fails, return false
-            except:
-                return False
+        pkt = self.codec.encode(response, status, sequence, self.pkt_self_id)
+        if pkt is None:
+            return False
 
-        with open(self.buf, 'wb') as buf:
-            return buf.write(pkt)
+        self.writes += 1
+        return self.transport.write(pkt, slot)
 
-    def read_pkt(self, size: int = blocksize):
+    def read_pkt(self, size: int = blocksize, slot: int = 0):
         '''
         Reads from the eeprom buffer.
         Returns the data as a bytes object.
         '''
-        # Open buffer and return first 256 bytes
-        with open(self.buf, 'rb') as buf:
-            return buf.read(self.blocksize)
+        return self.transport.read(slot)
 
-    def wait_response(self):
+    def poll_pkt(self):
         '''
-        Blocks for one second or until the target responds
-        Returns resulting packet, if valid packet is received
-        Returns false otherwise
+        Reads the buffer once.
+        Returns the raw packet if the target wrote a valid one, None otherwise
         '''
-        # Timeout in 1 second
-        timeout = time.time() + 3
+        data = self.read_pkt()
 
-        # Continuously check the Pi for its response
-        while timeout > time.time():
+        # Nothing changed since the last read, nor did we write: same answer,
+        # without parsing and checksumming the block again
+        if data == self.last_read and self.writes == self.last_writes:
+            return self.last_result
+        result = self.check_pkt(data)
+        self.last_read, self.last_writes, self.last_result = data, self.writes, result
+        return result
 
-            # Get the packet from the Pi and Parse
-            data = self.read_pkt()
-            pkt = I2CPacket.parse_pkt(data)
+    def check_pkt(self, data: bytes):
+        pkt = I2CPacket.parse_pkt(data)
 
-            # Grab sender ID to know if transmission was complete
-            sender = pkt[I2CPacket.id_index].decode(errors='ignore')
+        # Grab sender ID to know if transmission was complete
+        sender = pkt[I2CPacket.id_index].decode(errors='ignore')
 
-            # If the sender ID is not ourselves, we received a transmission
-            if sender != self.pkt_self_id:
+        # If the sender ID is ourselves, nothing new was received
+        if sender == self.pkt_self_id:
+            return None
 
-                # Check its integrity (checksum)
-                if I2CPacket.verify_pkt(data):
-                    return pkt
-                else:
-                    # If invalid, send an error message so pi resends it
-                    print('Requesting new packet (invalid)')
-                    self.write_pkt(b'', 'e', 0)
+        # Check its integrity (checksum)
+        if self.codec.verify(data):
+            return data
+
+        # The Pi restarted and went back to the first checksum
+        if sender == self.pkt_targ_id and self.codec.fallback(data):
+            self.write_log('Pi went back to checksum version 1')
+            return data
+
+        # If invalid, send an error message so pi resends it
+        print('Requesting new packet (invalid)')
+        self.write_pkt(b'', 'e', 0)
+        return None
+
+    def wait_response(self, timeout: float = 3):
+        '''
+        Blocks for timeout seconds or until the target responds, checking
+        quickly at first and less often the longer it takes
+        Returns resulting packet, if valid packet is received
+        Returns false otherwise
+        '''
+        deadline = time.time() + timeout
+        backoff = Backoff()
+
+        # Keep checking the Pi for its response
+        while deadline > time.time():
+            data = self.poll_pkt()
+            if data is not None:
+                return I2CPacket.parse_pkt(data)
+            backoff.wait()
 
         # If timeout occurs, return false
         self.write_log('Timeout occured. Returning false.')
         return False
     
-    def file_send(self, filename: str):
+    def file_send(self, filename: str, window: int = 0, data: bytes = None):
         '''
-        Send a file from the jetson to the pi
+        Send a file from the jetson to the pi.
+        With data given, data is sent under filename instead of the file's
+        contents, so images encoded in memory never go to disk.
+        The last keep_transfers files sent are kept, so the Pi can pick up
+        an interrupted transfer again with file_resume.
         '''
-        sequence = 0
-
-        # Send File name and wait for a response to start
-        if not self.send_and_wait(filename.encode(), 'd', sequence):
-            print('Error writing packet')
-            self.write_log('Error writing data')
+        chunks = self.file_chunks(filename, data)
+        digest = hashlib.sha256(b''.join(chunks)).hexdigest().encode()
+        self.transfers[filename] = (chunks, digest)
+        self.transfers.move_to_end(filename)
+        while len(self.transfers) > self.keep_transfers:
+            self.transfers.popitem(last=False)
+        return self.file_resume(filename, window)
+
+    def file_resume(self, filename: str, window: int = 0):
+        '''
+        Sends a file kept by file_send, starting from the chunk the Pi asks
+        for first, so an interrupted transfer goes on where it stopped.
+        The 't' end packet carries 'end' and the SHA-256 of the whole file.
+        With window above 1 (asked for by the Pi) and an eeprom with more
+        than one slot, up to window packets are sent ahead of the Pi's
+        acknowledgements, see file_send_windowed.
+        '''
+        if filename not in self.transfers:
+            self.write_log('Unknown transfer ' + filename)
+            self.write_pkt(b'Unknown transfer', 'd', 0)
             return False
-        
-        print('Starting Transmission')
 
-        # Try to open requested file for reading
-        try:
-            reqfile = open(filename, 'rb')
+        window = min(window, self.slots - 1)
+        if window > 1:
+            return self.file_send_windowed(filename, window)
 
-        # Ignore File Not Found exceptions and move on to ending transmission
-        except FileNotFoundError:
-            self.write_log('File does not exist')
+        chunks, digest = self.transfers[filename]
 
-        # If open was successful, start transferring data
+        # Send File name and wait for the Pi to ask for a chunk
+        reply = self.send_and_wait(filename.encode(), 'd', 0)
+        if reply:
+            print('Starting Transmission')
+
+        # Every ready packet of the Pi carries the sequence number of the
+        # chunk it needs, so only what it is missing is sent again
+        while reply and reply[I2CPacket.stat_index] == b'r':
+            wanted = reply[I2CPacket.seq_index]
+            if wanted >= len(chunks):
+                break
+            reply = self.send_and_wait(chunks[wanted], 'd', wanted)
         else:
-            with reqfile:
-                # Read first chunk of data
-                data = reqfile.read(I2CPacket.data_len)
-                # While we are still grabbing data from the file
-                while data:
-                    # Write data to buffer to be sent
-                    if not self.send_and_wait(data, 'd', sequence):
-                        print('Error writing packet')
-                        self.write_log('Error writing data')
-                        return False
-                
-                    sequence += 1
-
-                    # Read next chunk of data
-                    data = reqfile.read(I2CPacket.data_len)
+            # Timed out, or the Pi moved on to another command
+            print('Error writing packet')
+            self.write_log('Transfer of ' + filename + ' interrupted')
+            return False
 
         # End transmission
         # Notify Pi transmission is over
-        self.write_pkt(b'end', 't', sequence)
+        self.write_pkt(b'end ' + digest, 't', len(chunks))
 
         self.write_log('Ending transmission')
 
         print('Ending transmission')
+        return True
+
+    def file_chunks(self, filename: str, data: bytes = None):
+        '''
+        data, or the contents of the file, in packet sized chunks.
+        A missing file is sent as an empty one.
+        '''
+        if data is None:
+            try:
+                with open(filename, 'rb') as reqfile:
+                    data = reqfile.read()
+            except FileNotFoundError:
+                self.write_log('File does not exist')
+                data = b''
+        size = I2CPacket.data_len
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def file_send_windowed(self, filename: str, window: int):
+        '''
+        Sliding window transfer over the eeprom slots of a file kept by
+        file_send.
+        The file name goes out in slot 0 with status 'w' and the window size
+        as its sequence number. Packet n then goes in slot 1 + n % window,
+        with the 't' end packet last, and the Pi acknowledges cumulatively
+        in slot 0 with an 'a' packet carrying the next sequence it needs;
+        its first one tells where to start. Packets not acknowledged within
+        resend_after are sent again (go-back-N), which only rewrites our
+        own eeprom slots.
+        '''
+        # Clear the slots first so the Pi cannot take packets left over from
+        # an earlier transfer for new ones
+        for slot in range(1, window + 1):
+            self.transport.write(bytes(self.blocksize), slot)
+
+        # Announce the window and wait for the Pi to be ready
+        reply = self.send_and_wait(filename.encode(), 'w', window)
+        if not reply or reply[I2CPacket.stat_index] != b'a':
+            print('Error writing packet')
+            self.write_log('Error writing data')
+            return False
+
+        print('Starting windowed transmission')
+        chunks, digest = self.transfers[filename]
+        total = len(chunks) + 1          # plus the end packet
+
+        acked = min(reply[I2CPacket.seq_index], total)  # Every packet before this one arrived
+        sent = acked                     # Next packet to write
+        progress = time.time()
+        resends = 0
+        backoff = Backoff(shortest=0.0005, longest=0.01)
+        while acked < total:
+            # Fill the free slots
+            while sent < min(acked + window, total):
+                if sent < len(chunks):
+                    self.write_pkt(chunks[sent], 'd', sent, 1 + sent % window)
+                else:
+                    self.write_pkt(b'end ' + digest, 't', sent, 1 + sent % window)
+                sent += 1
+
+            ack = self.read_ack()
+            if ack is not None and ack > acked:
+                acked = min(ack, total)
+                progress = time.time()
+                backoff.reset()
+                continue
+
+            if time.time() - progress > self.resend_after:
+                resends += 1
+                if resends > 5:
+                    print('Error writing packet')
+                    self.write_log('Windowed transfer of ' + filename + ' timed out')
+                    return False
+                sent = acked
+                progress = time.time()
+            backoff.wait()
+
+        self.write_log('Ending transmission')
+        print('Ending transmission')
+        return True
+
+    def read_ack(self):
+        '''
+        The sequence number in the Pi's acknowledgement in slot 0, or None
+        '''
+        data = self.read_pkt()
+        pkt = I2CPacket.parse_pkt(data)
+        if (pkt[I2CPacket.id_index].decode(errors='ignore') != self.pkt_targ_id or
+                pkt[I2CPacket.stat_index] != b'a' or not self.codec.verify(data)):
+            return None
+        return pkt[I2CPacket.seq_index]
         
     def send_and_wait(self, data: bytes, status: str, sequence: int):
         '''
@@ -0,0 +1,135 @@
+'''
+Picks the model input size for each inference call.
+
+Large, close tubes are found just as well at a small input size, which is
+much cheaper; small, far tubes need a larger one. The controller uses the
+last detection's box size and depth to pick the smallest size at which the
+tube is still big enough, then caps it by a latency target using the
+latencies it has measured at each size. A size is only measured when it
+runs, so one slow call (e.g. the first at a new input shape) would rule it
+out for good; sizes skipped for too long are run once more to re-measure.
+'''
+
+import collections
+import time
+
+
+class ResolutionController:
+    '''
+        sizes         - candidate input sizes, multiples of 32
+        latencyTarget - seconds allowed per image
+        minBoxPixels  - length the tube box should have in model input pixels
+        farDepth      - cm beyond which one size larger is used
+        smoothing     - weight of a new latency in the running average
+        history       - number of recent decisions kept for inspection
+        reprobeAfter  - calls after which a size ruled out by its latency is
+                        tried again, its old estimate replaced
+    '''
+    def __init__(self, sizes=(320, 416, 512, 640), latencyTarget=0.15, minBoxPixels=64,
+                 farDepth=40.0, smoothing=0.2, history=64, reprobeAfter=50):
+        self.sizes = sorted(sizes)
+        self.latencyTarget = latencyTarget
+        self.minBoxPixels = minBoxPixels
+        self.farDepth = farDepth
+        self.smoothing = smoothing
+        self.reprobeAfter = reprobeAfter
+        self.latencies = {}
+        self.calls = collections.Counter()
+        self.callCount = 0
+        self.lastCall = {}
+        self.decisions = collections.deque(maxlen=history)
+        self.lastBox = None
+        self.lastDepth = None
+        self.pending = None
+
+    def observe(self, box, depth=None):
+        '''
+        Records the latest tube (x1, y1, x2, y2) and depth in cm, or None if
+        there was no tube
+        '''
+        self.lastBox = box
+        self.lastDepth = depth
+
+    def estimate(self, size):
+        '''
+        Expected latency at size, scaled from the nearest measured size by
+        input area. None before anything was measured.
+        '''
+        if size in self.latencies:
+            return self.latencies[size]
+        if not self.latencies:
+            return None
+        nearest = min(self.latencies, key=lambda s: abs(s - size))
+        return self.latencies[nearest] * (size / nearest) ** 2
+
+    def stale(self, size):
+        '''
+        True when size has not run for reprobeAfter calls
+        '''
+        return self.callCount - self.lastCall.get(size, 0) >= self.reprobeAfter
+
+    def choose(self, frameShape=(480, 640)):
+        '''
+        Returns the input size for the next call
+        '''
+        if self.lastBox is None:
+            # Nothing to go on, search at full resolution
+            index = len(self.sizes) - 1
+            reason = 'search'
+        else:
+            x1, y1, x2, y2 = self.lastBox
+            boxLength = max(x2 - x1, y2 - y1, 1)
+            longest = max(frameShape[:2])
+            index = len(self.sizes) - 1
+            for i, size in enumerate(self.sizes):
+                if boxLength * size / longest >= self.minBoxPixels:
+                    index = i
+                    break
+            reason = 'box'
+            if self.lastDepth and self.lastDepth > self.farDepth and index < len(self.sizes) - 1:
+                index += 1
+                reason = 'far'
+
+        # Step down until the expected latency fits the target, unless the
+        # estimate is too old to trust: then run the size again to find out
+        while index > 0:
+            expected = self.estimate(self.sizes[index])
+            if expected is None or expected <= self.latencyTarget:
+                break
+            if self.sizes[index] in self.latencies and self.stale(self.sizes[index]):
+                reason = 'reprobe'
+                break
+            index -= 1
+            reason = 'latency'
+
+        size = self.sizes[index]
+        self.pending = {'time': time.monotonic(), 'size': size, 'reason': reason,
+                        'box': self.lastBox, 'depth': self.lastDepth}
+        return size
+
+    def record(self, size, latency, found):
+        '''
+        Records the per-image latency of a call made at size and whether it
+        found a tube
+        '''
+        decision = self.pending or {'time': time.monotonic(), 'size': size, 'reason': 'fixed'}
+        previous = self.latencies.get(size)
+        if previous is None or decision['reason'] == 'reprobe':
+            self.latencies[size] = latency
+        else:
+            self.latencies[size] = previous + self.smoothing * (latency - previous)
+        self.calls[size] += 1
+        self.callCount += 1
+        self.lastCall[size] = self.callCount
+        decision.update(latency=latency, found=found)
+        self.decisions.append(decision)
+        self.pending = None
+
+    def summary(self):
+        '''
+        Calls and smoothed latency in ms per size, plus the recent decisions
+        '''
+        return {'sizes': {size: {'calls': self.calls[size],
+                                 'latency_ms': round(self.latencies[size] * 1000, 1)}
+                          for size in self.sizes if size in self.latencies},
+                'decisions': list(self.decisions)}
@@ -0,0 +1,186 @@
+'''
+Depth to color alignment over a detection box.
+
+The D405 depth image is not pixel aligned with the color image, so looking up
+a color box in the raw depth image reads depth from slightly the wrong place.
+rs.align fixes that for the whole frame, which costs too much per frame on
+the Nano. DepthAligner does the same mapping as rs.align, but only for the
+depth pixels that can land inside one box of the color image.
+
+Every depth pixel corner's ray is precomputed and rotated into the color
+camera, so mapping a pixel is a multiply, add and project. Like rs.align,
+each depth pixel is splatted over the color pixels its footprint covers and
+the nearest depth wins where several land on the same color pixel.
+'''
+
+import numpy as np
+
+from coordinates import Intrinsics
+
+# Unmapped color pixels, before they are set to 0
+EMPTY = np.iinfo(np.uint32).max
+
+
+def cameraMatrix(intrinsics):
+    return np.array([[intrinsics.fx, 0, intrinsics.ppx],
+                     [0, intrinsics.fy, intrinsics.ppy],
+                     [0, 0, 1]])
+
+
+def pixelRays(intrinsics, u, v):
+    '''
+    Rays at unit depth (x/z, y/z) through pixel positions, undistorted if
+    the camera reports distortion. Returns an (..., 2) array.
+    '''
+    u, v = np.broadcast_arrays(np.asarray(u, np.float64), np.asarray(v, np.float64))
+    if intrinsics.coeffs:
+        import cv2
+        pixels = np.stack((u.ravel(), v.ravel()), axis=-1)[:, None, :]
+        normalized = cv2.undistortPoints(pixels, cameraMatrix(intrinsics),
+                                         np.array(intrinsics.coeffs))
+        return normalized[:, 0, :].reshape(u.shape + (2,))
+    return np.stack(((u - intrinsics.ppx) / intrinsics.fx,
+                     (v - intrinsics.ppy) / intrinsics.fy), axis=-1)
+
+
+def projectPoints(intrinsics, points):
+    '''
+    Camera frame points (n, 3) to pixel positions (n, 2)
+    '''
+    if intrinsics.coeffs:
+        import cv2
+        pixels, _ = cv2.projectPoints(points.astype(np.float64).reshape(-1, 1, 3),
+                                      np.zeros(3), np.zeros(3), cameraMatrix(intrinsics),
+                                      np.array(intrinsics.coeffs))
+        return pixels[:, 0, :]
+    return np.stack((points[:, 0] / points[:, 2] * intrinsics.fx + intrinsics.ppx,
+                     points[:, 1] / points[:, 2] * intrinsics.fy + intrinsics.ppy), axis=-1)
+
+
+class DepthAligner:
+    '''
+    Maps depth pixels into the color image.
+        depthIntrinsics, colorIntrinsics - coordinates.Intrinsics of each stream
+        rotation, translation            - depth to color extrinsics (3x3, meters)
+        nearest                          - closest depth in meters that is looked for
+        margin                           - extra depth pixels searched around a box
+    '''
+    def __init__(self, depthIntrinsics, colorIntrinsics, rotation=None, translation=None,
+                 nearest=0.07, margin=2):
+        self.depthIntrinsics = depthIntrinsics
+        self.colorIntrinsics = colorIntrinsics
+        self.rotation = np.eye(3) if rotation is None else np.asarray(rotation, np.float64)
+        self.translation = (np.zeros(3) if translation is None
+                            else np.asarray(translation, np.float64))
+        self.nearest = nearest
+        self.margin = margin
+
+        # Corner (u - 0.5, v - 0.5) of every depth pixel plus one extra row and
+        # column, as rays in color camera axes. Pixel (u, v) spans corners
+        # [v, u] to [v + 1, u + 1].
+        u, v = np.meshgrid(np.arange(depthIntrinsics.width + 1) - 0.5,
+                           np.arange(depthIntrinsics.height + 1) - 0.5)
+        rays = pixelRays(depthIntrinsics, u, v)
+        rays = np.concatenate((rays, np.ones(rays.shape[:-1] + (1,))), axis=-1)
+        self.cornerRays = (rays @ self.rotation.T).astype(np.float32)
+
+    @classmethod
+    def fromProfiles(cls, depthStream, colorStream, **kwargs):
+        '''
+        From the pyrealsense2 video stream profiles of a started pipeline
+        '''
+        extrinsics = depthStream.get_extrinsics_to(colorStream)
+        # librealsense stores the rotation column-major
+        rotation = np.array(extrinsics.rotation).reshape(3, 3).T
+        return cls(Intrinsics.fromRealSense(depthStream.get_intrinsics()),
+                   Intrinsics.fromRealSense(colorStream.get_intrinsics()),
+                   rotation, extrinsics.translation, **kwargs)
+
+    def asArray(self):
+        return np.concatenate((self.depthIntrinsics.asArray(), self.colorIntrinsics.asArray(),
+                               self.rotation.ravel(), self.translation))
+
+    @classmethod
+    def fromArray(cls, values, **kwargs):
+        return cls(Intrinsics.fromArray(values[0:11]), Intrinsics.fromArray(values[11:22]),
+                   np.reshape(values[22:31], (3, 3)), values[31:34], **kwargs)
+
+    def searchWindow(self, window):
+        '''
+        The depth image window (left, top, right, bottom) holding every depth
+        pixel that can map into the color window, for depths from nearest out
+        to infinity
+        '''
+        left, top, right, bottom = window
+        rays = pixelRays(self.colorIntrinsics, [left, right, left, right],
+                         [top, top, bottom, bottom])
+        rays = np.concatenate((rays, np.ones((4, 1))), axis=-1)
+
+        # Color points back into depth camera axes: far away only the rotation
+        # matters, up close the translation too
+        far = rays @ self.rotation
+        near = (rays * self.nearest - self.translation) @ self.rotation
+        points = np.concatenate((far, near))
+        points = points[points[:, 2] > 0]
+        intr = self.depthIntrinsics
+        u = points[:, 0] / points[:, 2] * intr.fx + intr.ppx
+        v = points[:, 1] / points[:, 2] * intr.fy + intr.ppy
+        return (max(int(np.floor(u.min())) - self.margin, 0),
+                max(int(np.floor(v.min())) - self.margin, 0),
+                min(int(np.ceil(u.max())) + self.margin + 1, intr.width),
+                min(int(np.ceil(v.max())) + self.margin + 1, intr.height))
+
+    def align(self, depthImage, depthScale, window):
+        '''
+        Depth image values seen from the color camera over the color window
+        (left, top, right, bottom). Returns a z16 array the size of the
+        window, 0 where no depth pixel lands, equal to the same crop of an
+        rs.align'ed depth image.
+        '''
+        left, top, right, bottom = window
+        out = np.full((bottom - top, right - left), EMPTY, np.uint32)
+        if out.size == 0:
+            return out.astype(np.uint16)
+
+        dl, dt, dr, db = self.searchWindow(window)
+        vs, us = np.nonzero(depthImage[dt:db, dl:dr])
+        vs += dt
+        us += dl
+        z16 = depthImage[vs, us]
+        meters = (z16 * depthScale).astype(np.float32)[:, None]
+
+        # Project both corners of each depth pixel's footprint
+        first = projectPoints(self.colorIntrinsics, self.cornerRays[vs, us] * meters +
+                              self.translation)
+        last = projectPoints(self.colorIntrinsics, self.cornerRays[vs + 1, us + 1] * meters +
+                             self.translation)
+        # Rounded the way librealsense does it (truncating toward zero)
+        x0, y0 = np.trunc(first + 0.5).astype(np.int64).T
+        x1, y1 = np.trunc(last + 0.5).astype(np.int64).T
+
+        # rs.align drops pixels whose footprint leaves the color image
+        intr = self.colorIntrinsics
+        keep = (x0 >= 0) & (y0 >= 0) & (x1 < intr.width) & (y1 < intr.height)
+        keep &= (x1 >= left) & (x0 < right) & (y1 >= top) & (y0 < bottom)
+        x0, x1, y0, y1, z16 = (a[keep] for a in (x0, x1, y0, y1, z16))
+        x0, x1 = np.maximum(x0, left) - left, np.minimum(x1, right - 1) - left
+        y0, y1 = np.maximum(y0, top) - top, np.minimum(y1, bottom - 1) - top
+
+        # Footprints are a pixel or two across, splat them one offset at a time
+        flat = out.ravel()
+        width = out.shape[1]
+        spanx, spany = x1 - x0, y1 - y0
+        for dy in range(int(spany.max(initial=-1)) + 1):
+            for dx in range(int(spanx.max(initial=-1)) + 1):
+                hit = (spanx >= dx) & (spany >= dy)
+                np.minimum.at(flat, (y0[hit] + dy) * width + x0[hit] + dx, z16[hit])
+
+        out[out == EMPTY] = 0
+        return out.astype(np.uint16)
+
+    def alignFrame(self, depthImage, depthScale):
+        '''
+        The whole depth image aligned to the color image, like rs.align
+        '''
+        return self.align(depthImage, depthScale,
+                          (0, 0, self.colorIntrinsics.width, self.colorIntrinsics.height))
@@ -0,0 +1,44 @@
+'''
+Draws detections onto frames for viewers.
+
+Nothing in the production path calls this; only visualization tools that
+actually show the frame pay for drawing.
+'''
+
+import cv2
+
+
+class Annotator:
+    '''
+    names - class index to label mapping (the model's names), optional
+    '''
+    boxColor = (0, 255, 0)
+    textColor = (0, 0, 255)
+
+    def __init__(self, names=None):
+        if isinstance(names, (list, tuple)):
+            names = dict(enumerate(names))
+        self.names = names or {}
+
+    def draw(self, image, detections, tube=None, lines=()):
+        '''
+        Returns an annotated copy of image. Every detection gets a labelled
+        box; the reported tube also gets its center marked. lines are extra
+        text rows drawn bottom-left, as in the original overlays.
+        '''
+        out = image.copy()
+        for det in detections:
+            x1, y1, x2, y2 = (int(v) for v in det.box)
+            cv2.rectangle(out, (x1, y1), (x2, y2), self.boxColor, 2)
+            label = f'{self.names.get(det.cls, det.cls)} {det.confidence:.2f}'
+            cv2.putText(out, label, (x1, max(y1 - 5, 10)), cv2.FONT_HERSHEY_SIMPLEX,
+                        .5, self.boxColor, 1)
+
+        if tube is not None:
+            cv2.circle(out, tube.center(), 5, self.textColor, 2)
+
+        bottom = out.shape[0] - 10
+        for i, text in enumerate(reversed(lines)):
+            cv2.putText(out, text, (10, bottom - 20 * i), cv2.FONT_HERSHEY_SIMPLEX,
+                        .5, self.textColor, 1)
+        return out
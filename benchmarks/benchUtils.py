@@ -0,0 +1,121 @@
+'''
+Helpers shared by the benchmark scripts.
+'''
+
+import os
+import sys
+import time
+import tracemalloc
+
+# Let the benchmarks import the vision code from the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+import numpy as np
+
+
+def percentiles(samples):
+    '''
+    Summarizes a list of latencies in seconds as milliseconds
+    '''
+    ms = np.asarray(samples, dtype=np.float64) * 1000
+    return {
+        'count': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+    }
+
+
+def timeCalls(fn, args, repeat=1):
+    '''
+    Calls fn(*a) for every a in args, repeat times over.
+    Returns the list of per-call latencies in seconds and the last results.
+    '''
+    samples = []
+    results = []
+    for _ in range(repeat):
+        results = []
+        for a in args:
+            start = time.perf_counter()
+            results.append(fn(*a))
+            samples.append(time.perf_counter() - start)
+    return samples, results
+
+
+def measure(name, fn, iterations, warmup=3):
+    '''
+    Times fn() over iterations calls, then calls it again under tracemalloc
+    for the peak memory it allocates (kept apart so tracing does not skew the
+    timings). Returns latency percentiles, throughput and peak memory.
+    '''
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    row = percentiles(samples)
+    row['stage'] = name
+    row['throughput_per_s'] = len(samples) / sum(samples)
+    row['peak_kib'] = peak / 1024
+    return row
+
+
+def printTable(rows, columns):
+    '''
+    Prints a list of dicts as an aligned text table
+    '''
+    widths = [max(len(c), *(len(f'{r[c]:.3f}' if isinstance(r[c], float) else str(r[c]))
+                            for r in rows)) for c in columns]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in rows:
+        cells = [f'{r[c]:.3f}' if isinstance(r[c], float) else str(r[c]) for c in columns]
+        print('  '.join(v.ljust(w) for v, w in zip(cells, widths)))
+
+
+class StubDetector:
+    '''
+    Stands in for the network on synthetic frames: finds the dark tube by
+    thresholding and sleeps for latency seconds per image to mimic inference
+    cost. Same interface as the detectors in detector.py.
+    '''
+    names = {0: 'tube'}
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+
+    def __call__(self, images, size=None):
+        import cv2
+        out = []
+        for image in images:
+            if self.latency:
+                time.sleep(self.latency)
+            mask = cv2.inRange(image, (0, 0, 0), (100, 100, 255))
+            points = cv2.findNonZero(mask)
+            if points is None:
+                out.append(np.zeros((0, 6), np.float32))
+                continue
+            x, y, w, h = cv2.boundingRect(points)
+            out.append(np.array([[x, y, x + w, y + h, 0.9, 0]], np.float32))
+        return out
+
+
+def iou(a, b):
+    '''
+    Intersection over union of two x1, y1, x2, y2 boxes
+    '''
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    inter = w * h
+    return inter / ((a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter)
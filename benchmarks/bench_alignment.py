@@ -0,0 +1,224 @@
+'''
+Box-local depth alignment checked against rs.align.
+
+--record saves frames from the camera together with the rs.align'ed depth
+image and how long rs.align took. The check then runs DepthAligner over
+boxes in every recorded frame and compares the result with the same crop of
+the rs.align output, along with the depth the vision system would read from
+it. Exits with status 1 when fewer than --min-match of the box pixels agree.
+
+Without a recording it uses synthetic frames and an assumed camera offset,
+comparing against scalarAlign, a line by line port of the loop rs.align
+runs (align_images in librealsense's src/proc/align.cpp). So do recordings
+made without the rs.align'ed image.
+
+    python3 benchmarks/bench_alignment.py --record frames/ --count 50
+    python3 benchmarks/bench_alignment.py --recorded frames/
+    python3 benchmarks/bench_alignment.py
+'''
+
+import argparse
+import glob
+import math
+import os
+import time
+
+import benchUtils
+import numpy as np
+
+import depthSampler
+from alignment import DepthAligner
+from coordinates import DEFAULT_INTRINSICS, Intrinsics
+from frameSource import SyntheticSource
+
+
+def record(folder, count):
+    '''
+    Saves count camera frames with their rs.align'ed depth image
+    '''
+    import pyrealsense2 as rs
+
+    os.makedirs(folder, exist_ok=True)
+    pipeline = rs.pipeline()
+    config = rs.config()
+    config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
+    config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+    profile = pipeline.start(config)
+    try:
+        depthScale = profile.get_device().first_depth_sensor().get_depth_scale()
+        color = profile.get_stream(rs.stream.color).as_video_stream_profile()
+        depth = profile.get_stream(rs.stream.depth).as_video_stream_profile()
+        aligner = DepthAligner.fromProfiles(depth, color)
+        align = rs.align(rs.stream.color)
+        for i in range(count):
+            frames = pipeline.wait_for_frames()
+            depthImage = np.asanyarray(frames.get_depth_frame().get_data()).copy()
+            start = time.perf_counter()
+            aligned = align.process(frames)
+            alignedDepth = np.asanyarray(aligned.get_depth_frame().get_data()).copy()
+            alignTime = time.perf_counter() - start
+            np.savez_compressed(os.path.join(folder, f'{i:05d}.npz'),
+                                color=np.asanyarray(frames.get_color_frame().get_data()),
+                                depth=depthImage, depthScale=depthScale,
+                                intrinsics=Intrinsics.fromRealSense(color.get_intrinsics()).asArray(),
+                                alignment=aligner.asArray(), alignedDepth=alignedDepth,
+                                alignTime=alignTime)
+    finally:
+        pipeline.stop()
+
+
+def loadRecorded(folder):
+    '''
+    Yields (aligner, depth, depthScale, reference, alignTime) per recorded frame
+    '''
+    aligner = None
+    for path in sorted(glob.glob(os.path.join(folder, '*.npz'))):
+        with np.load(path) as data:
+            if 'alignment' not in data:
+                raise SystemExit(f'{path} has no alignment, record it with --record')
+            if aligner is None:
+                aligner = DepthAligner.fromArray(data['alignment'])
+            reference = data['alignedDepth'] if 'alignedDepth' in data else None
+            alignTime = float(data['alignTime']) if 'alignTime' in data else None
+            yield aligner, data['depth'], float(data['depthScale']), reference, alignTime
+
+
+def synthetic(count):
+    '''
+    Synthetic frames seen through a color camera 1.5 cm to the side of the
+    depth camera and turned half a degree
+    '''
+    color = Intrinsics(640, 480, 390, 390, 322, 238)
+    angle = math.radians(0.5)
+    rotation = [[math.cos(angle), 0, math.sin(angle)], [0, 1, 0],
+                [-math.sin(angle), 0, math.cos(angle)]]
+    aligner = DepthAligner(DEFAULT_INTRINSICS, color, rotation, translation=(0.015, 0, 0))
+    source = SyntheticSource(holeRate=0.05, motion=(2, 1, 1))
+    for _ in range(count):
+        frame = source.read()
+        yield aligner, frame.depth, frame.depthScale, None, None
+
+
+def scalarAlign(aligner, depthImage, depthScale):
+    '''
+    rs.align's depth to color loop (align_images with align_z_to_other's
+    pixel transfer in librealsense), one depth pixel at a time: both
+    corners of the pixel are deprojected at its depth, moved into the color
+    camera and projected; the rectangle between them takes the depth, the
+    nearest one where several land. librealsense computes in float32, this
+    in float64, which can move a footprint edge that falls within rounding
+    of a pixel boundary. Distortion is not ported, the cameras must have
+    none.
+    '''
+    depthIntrin, colorIntrin = aligner.depthIntrinsics, aligner.colorIntrinsics
+    if depthIntrin.coeffs or colorIntrin.coeffs:
+        raise ValueError('scalarAlign does not handle distortion')
+    r = aligner.rotation.tolist()
+    t = aligner.translation.tolist()
+    out = np.zeros((colorIntrin.height, colorIntrin.width), np.uint16)
+
+    def project(x, y, depth):
+        # rs2_deproject_pixel_to_point, rs2_transform_point_to_point and
+        # rs2_project_point_to_pixel without distortion
+        px = (x - depthIntrin.ppx) / depthIntrin.fx * depth
+        py = (y - depthIntrin.ppy) / depthIntrin.fy * depth
+        ox = r[0][0] * px + r[0][1] * py + r[0][2] * depth + t[0]
+        oy = r[1][0] * px + r[1][1] * py + r[1][2] * depth + t[1]
+        oz = r[2][0] * px + r[2][1] * py + r[2][2] * depth + t[2]
+        return (math.trunc(ox / oz * colorIntrin.fx + colorIntrin.ppx + 0.5),
+                math.trunc(oy / oz * colorIntrin.fy + colorIntrin.ppy + 0.5))
+
+    rows = depthImage.tolist()
+    for depthY in range(depthIntrin.height):
+        row = rows[depthY]
+        for depthX in range(depthIntrin.width):
+            z = row[depthX]
+            if not z:
+                continue
+            depth = z * depthScale
+            x0, y0 = project(depthX - 0.5, depthY - 0.5, depth)
+            x1, y1 = project(depthX + 0.5, depthY + 0.5, depth)
+            if x0 < 0 or y0 < 0 or x1 >= colorIntrin.width or y1 >= colorIntrin.height:
+                continue
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    current = out[y, x]
+                    out[y, x] = min(current, z) if current else z
+    return out
+
+
+def randomBoxes(rng, count, width, height):
+    sizes = rng.uniform((40, 20), (200, 120), (count, 2))
+    corners = rng.random((count, 2)) * ((width, height) - sizes)
+    return np.concatenate((corners, corners + sizes), axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--recorded', help='folder saved with --record')
+    parser.add_argument('--record', help='record camera frames into this folder and exit')
+    parser.add_argument('--count', type=int, default=30, help='frames to record or synthesize')
+    parser.add_argument('--boxes', type=int, default=10, help='random boxes per frame')
+    parser.add_argument('--min-match', type=float, default=0.99)
+    opts = parser.parse_args()
+
+    if opts.record:
+        record(opts.record, opts.count)
+        return
+
+    frames = loadRecorded(opts.recorded) if opts.recorded else synthetic(opts.count)
+    rng = np.random.default_rng(0)
+    boxTimes, frameTimes, rsTimes = [], [], []
+    matched = total = 0
+    frameMatched = frameTotal = ported = 0
+    alignedError, rawError = [], []
+    for aligner, depth, depthScale, reference, alignTime in frames:
+        start = time.perf_counter()
+        full = aligner.alignFrame(depth, depthScale)
+        frameTimes.append(time.perf_counter() - start)
+        if alignTime is not None:
+            rsTimes.append(alignTime)
+        if reference is None:
+            reference = scalarAlign(aligner, depth, depthScale)
+            ported += 1
+        frameMatched += np.count_nonzero(full == reference)
+        frameTotal += full.size
+
+        color = aligner.colorIntrinsics
+        for box in randomBoxes(rng, opts.boxes, color.width, color.height):
+            left, top, right, bottom = depthSampler.patchWindow(reference.shape, box)
+            start = time.perf_counter()
+            region = aligner.align(depth, depthScale, (left, top, right, bottom))
+            boxTimes.append(time.perf_counter() - start)
+            matched += np.count_nonzero(region == reference[top:bottom, left:right])
+            total += region.size
+
+            # Depth the vision system reads, against the aligned reference
+            truth, _ = depthSampler.sampleDepth(reference, depthScale, box)
+            if truth:
+                aligned, _ = depthSampler.sampleDepth(depth, depthScale, box, aligner=aligner)
+                raw, _ = depthSampler.sampleDepth(depth, depthScale, box)
+                alignedError.append(abs(aligned - truth))
+                rawError.append(abs(raw - truth))
+
+    rows = [dict(benchUtils.percentiles(boxTimes), stage='box align')]
+    rows.append(dict(benchUtils.percentiles(frameTimes), stage='full frame align'))
+    if rsTimes:
+        rows.append(dict(benchUtils.percentiles(rsTimes), stage='rs.align'))
+    benchUtils.printTable(rows, ['stage', 'count', 'p50_ms', 'p95_ms', 'p99_ms'])
+
+    match = matched / max(total, 1)
+    reference = 'rs.align' if not ported else 'scalarAlign (rs.align ported)'
+    print(f'\nbox pixels equal to {reference}: {match:.4f}')
+    print(f'full frame pixels equal to {reference}: {frameMatched / max(frameTotal, 1):.4f}')
+    if alignedError:
+        print(f'sampled depth error, aligned: {np.mean(alignedError):.3f} cm mean, '
+              f'{np.max(alignedError):.3f} cm max')
+        print(f'sampled depth error, unaligned: {np.mean(rawError):.3f} cm mean, '
+              f'{np.max(rawError):.3f} cm max')
+    if match < opts.min_match:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
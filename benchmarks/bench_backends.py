@@ -0,0 +1,160 @@
+'''
+Side by side latency and accuracy of the inference backends.
+
+Runs every image of a validation folder through each backend and reports
+per-image latency and mAP against the labels. The folder uses the YOLOv5
+layout: images/*.jpg and labels/*.txt with "class cx cy w h" rows in
+0-1 image units. Static int8 quantization calibrates on the images folder;
+the artifacts land in the model cache, so VisionSystem(backend='onnxruntime',
+quantize='static') picks them up afterwards.
+
+    python3 benchmarks/bench_backends.py --yolo ~/OVision2022/yolov5 \
+        --weights ~/OVision2022/yolov5/last.pt --val ~/datasets/tubes/valid
+'''
+
+import argparse
+import glob
+import json
+import os
+import time
+
+import benchUtils
+import cv2
+import numpy as np
+
+import modelCache
+
+DEFAULT_BACKENDS = ['hub', 'torchscript', 'onnxruntime', 'onnxruntime:dynamic',
+                    'onnxruntime:static', 'opencv']
+
+
+def loadValidation(folder):
+    '''
+    Returns (image, truth) pairs, truth rows being class, x1, y1, x2, y2 in pixels
+    '''
+    samples = []
+    for path in sorted(glob.glob(os.path.join(folder, 'images', '*'))):
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        height, width = image.shape[:2]
+        label = os.path.join(folder, 'labels', os.path.splitext(os.path.basename(path))[0] + '.txt')
+        rows = np.loadtxt(label, ndmin=2) if os.path.exists(label) else np.zeros((0, 5))
+        truth = np.zeros((len(rows), 5))
+        if len(rows):
+            truth[:, 0] = rows[:, 0]
+            truth[:, 1] = (rows[:, 1] - rows[:, 3] / 2) * width
+            truth[:, 2] = (rows[:, 2] - rows[:, 4] / 2) * height
+            truth[:, 3] = (rows[:, 1] + rows[:, 3] / 2) * width
+            truth[:, 4] = (rows[:, 2] + rows[:, 4] / 2) * height
+        samples.append((image, truth))
+    return samples
+
+
+def boxIou(box, boxes):
+    '''
+    IoU of one x1, y1, x2, y2 box with each row of boxes
+    '''
+    w = np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+    h = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+    inter = w * h
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / (area + areas - inter + 1e-9)
+
+
+def averagePrecision(predictions, truths, cls, threshold):
+    '''
+    COCO style 101 point average precision of one class at one IoU threshold
+    '''
+    found = [(row[4], i, row[:4]) for i, rows in enumerate(predictions)
+             for row in rows if int(row[5]) == cls]
+    found.sort(key=lambda f: -f[0])
+    targets = [t[t[:, 0] == cls, 1:] for t in truths]
+    total = sum(len(t) for t in targets)
+    if not total:
+        return None
+
+    used = [np.zeros(len(t), bool) for t in targets]
+    hits = np.zeros(len(found))
+    for k, (_, i, box) in enumerate(found):
+        if not len(targets[i]):
+            continue
+        ious = boxIou(box, targets[i])
+        ious[used[i]] = 0
+        best = ious.argmax()
+        if ious[best] >= threshold:
+            used[i][best] = True
+            hits[k] = 1
+
+    if not len(found):
+        return 0.0
+    tp = np.cumsum(hits)
+    recall = tp / total
+    precision = tp / np.arange(1, len(found) + 1)
+
+    # Best precision at or beyond each recall point, 0 where never reached
+    envelope = np.flip(np.maximum.accumulate(np.flip(precision)))
+    index = np.searchsorted(recall, np.linspace(0, 1, 101), side='left')
+    points = np.where(index < len(recall), envelope[np.minimum(index, len(recall) - 1)], 0.0)
+    return float(points.mean())
+
+
+def meanAP(predictions, truths, thresholds):
+    classes = sorted({int(c) for t in truths for c in t[:, 0]})
+    scores = []
+    for threshold in thresholds:
+        aps = [averagePrecision(predictions, truths, c, threshold) for c in classes]
+        aps = [ap for ap in aps if ap is not None]
+        scores.append(np.mean(aps) if aps else 0.0)
+    return float(np.mean(scores))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--yolo', default='/home/herbie/OVision2022/yolov5')
+    parser.add_argument('--weights', default='/home/herbie/OVision2022/yolov5/last.pt')
+    parser.add_argument('--val', required=True, help='validation folder (images/, labels/)')
+    parser.add_argument('--size', type=int, default=640)
+    parser.add_argument('--backends', nargs='+', default=DEFAULT_BACKENDS,
+                        help='backend or backend:quantization')
+    parser.add_argument('--json', help='write the results to this file')
+    opts = parser.parse_args()
+
+    samples = loadValidation(opts.val)
+    truths = [truth for _, truth in samples]
+    print(f'{len(samples)} validation images')
+
+    rows = []
+    for spec in opts.backends:
+        backend, _, quantize = spec.partition(':')
+        try:
+            model = modelCache.loadModel(opts.yolo, opts.weights, sizes=(opts.size,),
+                                         backend=backend, quantize=quantize or None,
+                                         calibration=os.path.join(opts.val, 'images'))
+        except Exception as e:
+            print(f'{spec}: could not load ({e})')
+            continue
+
+        # Warm up, then one image per call like the robot does
+        model([samples[0][0]], size=opts.size)
+        samples_s, predictions = [], []
+        for image, _ in samples:
+            start = time.perf_counter()
+            predictions.append(model([image], size=opts.size)[0])
+            samples_s.append(time.perf_counter() - start)
+
+        row = benchUtils.percentiles(samples_s)
+        row['backend'] = spec
+        row['mAP50'] = meanAP(predictions, truths, [0.5])
+        row['mAP50_95'] = meanAP(predictions, truths, np.arange(0.5, 0.96, 0.05))
+        rows.append(row)
+
+    benchUtils.printTable(rows, ['backend', 'p50_ms', 'p95_ms', 'mean_ms', 'mAP50', 'mAP50_95'])
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Microbenchmark of edge.get_degrees against the original full-frame scan.
+
+Synthetic tubes are drawn at known angles; both versions are timed on the
+same boxes and their angle error is reported.
+
+    python3 benchmarks/bench_edge.py --count 200
+'''
+
+import argparse
+import contextlib
+import io
+from math import atan, degrees
+
+import benchUtils
+import cv2
+import numpy as np
+
+import edge
+from frameSource import SyntheticSource
+
+
+def legacy_get_degrees(top_left, bottom_right, center, img):
+    '''
+    edge.get_degrees before the ROI rewrite, kept verbatim for comparison
+    '''
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    img_out = cv2.Canny(gray, 100, 150)
+    first_white_col, first_white_row = top_left[1], top_left[0]
+    done = 0
+    for row in range(top_left[0], bottom_right[0]):
+        for col in range(top_left[1], bottom_right[1]):
+            if img_out[col][row] > 0:
+                first_white_col, first_white_row = col, row
+                done = 1
+                break
+        if done:
+            break
+
+    tan_triangle = abs(center[1] - first_white_col) / abs(center[0] - first_white_row)
+    degrees_off_axis =  90 - degrees(atan(tan_triangle))
+    if(first_white_col > center[1]):
+        degrees_off_axis = 180 - degrees_off_axis
+    print(f"First white pixel: {first_white_col} {first_white_row}")
+    print(f"Center: {center[0]}, {center[1]}")
+    print(f"Degrees from y-axis = {degrees_off_axis} and {done}")
+    return(degrees_off_axis)
+
+
+def makeCases(count, seed):
+    '''
+    Builds (args, expected angle) pairs for tubes at random angles and places
+    '''
+    rng = np.random.default_rng(seed)
+    cases = []
+    for _ in range(count):
+        angle = rng.uniform(-80, 80)
+        source = SyntheticSource(center=(rng.uniform(200, 440), rng.uniform(150, 330)),
+                                 size=(rng.uniform(100, 200), rng.uniform(25, 45)), angle=angle)
+        img = source.read().color
+        x, y, w, h = cv2.boundingRect(source.tubeCorners())
+        top_left, bottom_right = (x - 4, y - 4), (x + w + 4, y + h + 4)
+        center = ((top_left[0] + bottom_right[0]) // 2, (top_left[1] + bottom_right[1]) // 2)
+        cases.append(((top_left, bottom_right, center, img), (90 - angle) % 180))
+    return cases
+
+
+def angleError(measured, expected):
+    diff = abs(measured - expected) % 180
+    return min(diff, 180 - diff)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--count', type=int, default=200, help='number of synthetic tubes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    opts = parser.parse_args()
+
+    cases = makeCases(opts.count, opts.seed)
+    args = [c[0] for c in cases]
+    expected = [c[1] for c in cases]
+
+    rows = []
+    for name, fn in (('legacy scan', legacy_get_degrees), ('roi pca', edge.get_degrees)):
+        # The legacy version prints on every call; that cost is part of it
+        with contextlib.redirect_stdout(io.StringIO()):
+            samples, results = benchUtils.timeCalls(fn, args, opts.repeat)
+        errors = [angleError(r, e) for r, e in zip(results, expected)]
+        row = benchUtils.percentiles(samples)
+        row['name'] = name
+        row['mean_err_deg'] = float(np.mean(errors))
+        row['max_err_deg'] = float(np.max(errors))
+        rows.append(row)
+
+    benchUtils.printTable(rows, ['name', 'count', 'p50_ms', 'p95_ms', 'p99_ms',
+                                 'mean_err_deg', 'max_err_deg'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Byte budget search of imageEncoder.encodeImage.
+
+Encodes a synthetic frame (with --noise, a harder to compress one) under a
+range of qualities and byte budgets, and checks every result against an
+exhaustive scan of the same settings: the returned quality and scale must
+reproduce the returned bytes, the image must fit the budget whenever some
+setting does, and otherwise it must be the smallest the lowest quality
+gives at any scale. Reports the time and size of each encode.
+
+    python3 benchmarks/bench_image.py
+    python3 benchmarks/bench_image.py --noise 0 --format webp
+'''
+
+import argparse
+import time
+
+import benchUtils
+import numpy as np
+
+from frameSource import SyntheticSource
+from imageEncoder import MIN_QUALITY, MIN_SCALE, SCALE_STEP, encode, encodeImage
+
+
+def scales():
+    '''
+    The scales the budget search goes through, from 1 down
+    '''
+    scale = 1.0
+    while True:
+        yield scale
+        if scale * SCALE_STEP < MIN_SCALE:
+            return
+        scale *= SCALE_STEP
+
+
+def exhaustive(image, fmt, quality, budget):
+    '''
+    Whether any scale and quality fits the budget, and the smallest image
+    the lowest quality gives
+    '''
+    lowest = min(MIN_QUALITY, quality)
+    smallest = None
+    for scale in scales():
+        sizes = [len(encode(image, fmt, q, scale)) for q in range(lowest, quality + 1)]
+        if min(sizes) <= budget:
+            return True, None
+        if smallest is None or sizes[0] < smallest:
+            smallest = sizes[0]
+    return False, smallest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--noise', type=float, default=40, help='pixel noise standard deviation')
+    parser.add_argument('--format', default='jpg', help='jpg or webp')
+    parser.add_argument('--repeat', type=int, default=5, help='timed encodes per case')
+    opts = parser.parse_args()
+
+    image = SyntheticSource().read().color.astype(np.float32)
+    image += np.random.default_rng(0).normal(0, opts.noise, image.shape)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+
+    rows, failures = [], []
+    for quality in (80, 30, 5):
+        for budget in (None, 20000, 3000, 200):
+            data, used, scale = encodeImage(image, None, 1.0, quality, opts.format, False, budget)
+            start = time.perf_counter()
+            for _ in range(opts.repeat):
+                encodeImage(image, None, 1.0, quality, opts.format, False, budget)
+            elapsed = (time.perf_counter() - start) / opts.repeat
+
+            case = f'quality={quality} budget={budget}'
+            if encode(image, opts.format, used, scale) != data:
+                failures.append(f'{case}: quality {used} and scale {scale:.3f} give other bytes')
+            if budget:
+                fits, smallest = exhaustive(image, opts.format, quality, budget)
+                if fits and len(data) > budget:
+                    failures.append(f'{case}: {len(data)} bytes although some setting fits')
+                if not fits and len(data) != smallest:
+                    failures.append(f'{case}: {len(data)} bytes, smallest possible {smallest}')
+            rows.append({'case': case, 'bytes': len(data), 'quality': used,
+                         'scale': scale, 'ms': elapsed * 1000})
+
+    benchUtils.printTable(rows, ['case', 'bytes', 'quality', 'scale', 'ms'])
+    if failures:
+        raise SystemExit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
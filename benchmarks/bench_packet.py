@@ -0,0 +1,132 @@
+'''
+Packet encode and verify throughput, old code against i2c_packet.py.
+
+Times building and checking packets with the original I2CPacket functions
+and with PacketCodec under both checksum versions, and counts how many
+corruptions of a valid packet each checksum misses: random byte changes,
+two swapped bytes, and one byte raised while another is lowered by the
+same amount.
+
+    python3 benchmarks/bench_packet.py
+    python3 benchmarks/bench_packet.py --count 200000
+'''
+
+import argparse
+import random
+import struct
+import time
+
+import benchUtils
+
+from i2c_packet import CHECKSUM_CRC32, CHECKSUM_SUM, I2CPacket, PacketCodec, verify
+
+
+def legacy_create_pkt(data, size, status, sequence, ID):
+    '''
+    I2CPacket.create_pkt before the shared codec, kept verbatim for comparison
+    '''
+    if size > I2CPacket.data_len:
+        return False
+    pkt_array = bytearray(struct.pack(I2CPacket.struct_format,
+                            data, size, status[:1].encode(),
+                                      0, sequence, ID[:1].encode()))
+    pkt_array[247:251] = sum(pkt_array).to_bytes(4, 'little')
+    pkt = bytes(pkt_array)
+    return pkt
+
+
+def legacy_verify_pkt(pkt):
+    '''
+    I2CPacket.verify_pkt before the shared codec
+    '''
+    pkt_array = bytearray(pkt)
+    provided = int.from_bytes(pkt_array[247:251], 'little', signed=False)
+    pkt_array[247:251] = bytearray(4)
+    calculated = sum(pkt_array)
+    return calculated == provided
+
+
+def rate(fn, count):
+    '''
+    Calls per second of fn() over count calls
+    '''
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return count / (time.perf_counter() - start)
+
+
+def corruptions(pkt, rng):
+    '''
+    A few corrupted copies of pkt; the checksum field is left alone
+    '''
+    positions = [i for i in range(I2CPacket.size) if not 247 <= i < 251]
+    damaged = bytearray(pkt)
+    for i in rng.sample(positions, 3):
+        damaged[i] = (damaged[i] + rng.randrange(1, 256)) % 256
+    yield 'random', damaged
+
+    i, j = rng.sample(positions, 2)
+    swapped = bytearray(pkt)
+    if swapped[i] != swapped[j]:
+        swapped[i], swapped[j] = swapped[j], swapped[i]
+        yield 'swap', swapped
+
+    i, j = rng.sample(positions, 2)
+    step = rng.randrange(1, 256)
+    offset = bytearray(pkt)
+    if offset[i] + step < 256 and offset[j] - step >= 0:
+        offset[i] += step
+        offset[j] -= step
+        yield 'offset', offset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--count', type=int, default=100000, help='calls per measurement')
+    parser.add_argument('--packets', type=int, default=2000, help='packets to corrupt')
+    opts = parser.parse_args()
+
+    rng = random.Random(0)
+    data = bytes(rng.randrange(256) for _ in range(I2CPacket.data_len))
+    pkt = legacy_create_pkt(data, len(data), 'd', 7, 'J')
+    codecs = {version: PacketCodec(version) for version in (CHECKSUM_SUM, CHECKSUM_CRC32)}
+    if bytes(codecs[CHECKSUM_SUM].encode(data, 'd', 7, 'J')) != pkt:
+        raise SystemExit('Version 1 packets differ from the original ones')
+    packets = {version: bytes(codec.encode(data, 'd', 7, 'J')) for version, codec in codecs.items()}
+
+    rows = [{
+        'codec': 'original',
+        'encode_per_s': rate(lambda: legacy_create_pkt(data, len(data), 'd', 7, 'J'), opts.count),
+        'verify_per_s': rate(lambda: legacy_verify_pkt(pkt), opts.count),
+    }]
+    for version, codec in codecs.items():
+        good = packets[version]
+        rows.append({
+            'codec': f'version {version}',
+            'encode_per_s': rate(lambda: codec.encode(data, 'd', 7, 'J'), opts.count),
+            'verify_per_s': rate(lambda: codec.verify(good), opts.count),
+        })
+
+    # Corruptions each checksum lets through
+    missed = {version: {} for version in codecs}
+    for _ in range(opts.packets):
+        payload = bytes(rng.randrange(256) for _ in range(rng.randrange(I2CPacket.data_len + 1)))
+        for version, codec in codecs.items():
+            good = bytes(codec.encode(payload, 'd', rng.randrange(1 << 16), 'P'))
+            for kind, damaged in corruptions(good, random.Random(rng.random())):
+                tally = missed[version].setdefault(kind, [0, 0])
+                tally[0] += verify(damaged, version)
+                tally[1] += 1
+    for row, version in zip(rows[1:], codecs):
+        for kind, (undetected, total) in missed[version].items():
+            row[f'missed_{kind}'] = f'{undetected}/{total}'
+    for kind in missed[CHECKSUM_SUM]:
+        rows[0][f'missed_{kind}'] = rows[1][f'missed_{kind}']
+
+    benchUtils.printTable(rows, ['codec', 'encode_per_s', 'verify_per_s'] +
+                          [f'missed_{kind}' for kind in missed[CHECKSUM_SUM]])
+
+
+if __name__ == '__main__':
+    main()
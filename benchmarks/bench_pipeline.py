@@ -0,0 +1,93 @@
+'''
+Offline benchmark of the vision and coordinate hot path.
+
+Drives VisionSystem with recorded or synthetic RGB-D frames and a stub
+detector (or the real model) and times each stage: capture, detection,
+depth sampling, orientation, the whole processOneFrame, coordinate
+translation, the consensus check and a full collectTubeLocation. Reports
+p50/p95/p99 latency, throughput and peak allocated memory per stage and
+writes them as JSON so runs can be compared.
+
+    python3 benchmarks/bench_pipeline.py --out bench.json
+    python3 benchmarks/bench_pipeline.py --recorded frames/ --weights last.pt --out bench.json
+'''
+
+import argparse
+import json
+import platform
+import time
+
+import benchUtils
+
+import control
+import depthSampler
+from frameSource import RecordedSource, SyntheticSource
+from visionSystem import VisionSystem
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--recorded', help='folder of frames saved by frameSource.recordFrames')
+    parser.add_argument('--yolo', default='/home/herbie/OVision2022/yolov5')
+    parser.add_argument('--weights', help='use the real model instead of the stub')
+    parser.add_argument('--backend', default='torchscript')
+    parser.add_argument('--stub-latency', type=float, default=0.0,
+                        help='seconds per image for the stub detector')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--hole-rate', type=float, default=0.05,
+                        help='fraction of missing depth in synthetic frames')
+    parser.add_argument('--out', help='write results as JSON to this file')
+    opts = parser.parse_args()
+
+    if opts.recorded:
+        source = RecordedSource(opts.recorded)
+    else:
+        source = SyntheticSource(holeRate=opts.hole_rate, motion=(0.2, 0.1, 0.1))
+
+    model = None if opts.weights else benchUtils.StubDetector(opts.stub_latency)
+    vis = VisionSystem(opts.yolo, opts.weights, source=source, streaming=False, model=model,
+                       backend=opts.backend)
+    vis.warmUp()
+
+    # Recorded and synthetic sources cost nothing to start, so the one-shot
+    # capture path measures only reading frames
+    frame = source.read()
+    tube = vis.checkForTube(frame.color)
+    if tube is None:
+        raise SystemExit('No tube found in the first frame, nothing to benchmark')
+    centerx, centery = tube.center()
+    data = vis.getTubeData(frame, tube)
+    samples = [control.translateCoordinates(*data[:3]) + (data[3],)] * 5
+
+    stages = [
+        ('capture', source.read),
+        ('detect', lambda: vis.detect([frame.color])),
+        ('depth', lambda: depthSampler.sampleDepth(frame.depth, frame.depthScale, tube.box,
+                                                   aligner=source.aligner)),
+        ('orientation', lambda: vis.getTubeOrientation(frame.color, tube, centerx, centery)),
+        ('processOneFrame', vis.processOneFrame),
+        ('translateCoordinates', lambda: control.translateCoordinates(*data[:3])),
+        ('checkTubeLocationValidity', lambda: control.checkTubeLocationValidity(samples)),
+        ('collectTubeLocation', lambda: control.collectTubeLocation(vis)),
+    ]
+
+    rows = []
+    for name, fn in stages:
+        iterations = opts.iterations
+        if name == 'collectTubeLocation':
+            iterations = max(opts.iterations // 10, 5)
+        rows.append(benchUtils.measure(name, fn, iterations))
+
+    benchUtils.printTable(rows, ['stage', 'count', 'p50_ms', 'p95_ms', 'p99_ms',
+                                 'throughput_per_s', 'peak_kib'])
+    if opts.out:
+        with open(opts.out, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'machine': platform.node(), 'python': platform.python_version(),
+                       'source': opts.recorded or 'synthetic',
+                       'model': opts.weights or f'stub {opts.stub_latency}s',
+                       'stages': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
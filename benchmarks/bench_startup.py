@@ -0,0 +1,56 @@
+'''
+Cold versus warm model startup time.
+
+Each run is a fresh Python process that loads the model through modelCache
+and does the warm-up inference, like control.py does before sending Ready.
+The first run uses an empty cache directory (cold), the rest reuse the
+artifact it exported (warm).
+
+    python3 benchmarks/bench_startup.py --yolo ~/OVision2022/yolov5 --weights last.pt
+'''
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+
+import benchUtils
+
+CHILD = '''
+import json, sys, time
+start = time.monotonic()
+sys.path.append({root!r})
+import modelCache, numpy as np
+model = modelCache.loadModel({yolo!r}, {weights!r}, {cacheDir!r})
+loaded = time.monotonic()
+blank = np.zeros((480, 640, 3), np.uint8)
+model([blank])
+print(json.dumps({{'warm': model.warm, 'load_s': loaded - start,
+                  'first_inference_s': time.monotonic() - loaded,
+                  'total_s': time.monotonic() - start}}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--yolo', default='/home/herbie/OVision2022/yolov5')
+    parser.add_argument('--weights', default='/home/herbie/OVision2022/yolov5/last.pt')
+    parser.add_argument('--runs', type=int, default=3, help='warm runs')
+    opts = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as cacheDir:
+        code = CHILD.format(root=benchUtils.ROOT, yolo=opts.yolo, weights=opts.weights, cacheDir=cacheDir)
+        for _ in range(opts.runs + 1):
+            out = subprocess.run([sys.executable, '-c', code], check=True,
+                                 capture_output=True, text=True).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            result['name'] = 'warm' if result['warm'] else 'cold'
+            rows.append(result)
+
+    benchUtils.printTable(rows, ['name', 'load_s', 'first_inference_s', 'total_s'])
+
+
+if __name__ == '__main__':
+    main()
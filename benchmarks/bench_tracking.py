@@ -0,0 +1,84 @@
+'''
+Frame rate gain versus accuracy loss of detect-then-track.
+
+Runs a frame sequence through the detector on every frame (the reference)
+and through TrackingDetector with several keyframe intervals, then reports
+frames per second and how far the tracked boxes are from the reference.
+Uses a synthetic moving tube and a stub detector unless a recording and
+real weights are given.
+
+    python3 benchmarks/bench_tracking.py
+    python3 benchmarks/bench_tracking.py --recorded frames/ --yolo ~/OVision2022/yolov5 --weights last.pt
+'''
+
+import argparse
+import time
+
+import benchUtils
+import numpy as np
+
+from frameSource import RecordedSource, SyntheticSource
+from tracker import TrackingDetector
+
+
+def run(detector, frames):
+    '''
+    Returns the per-frame best box (or None) and the total time
+    '''
+    boxes = []
+    start = time.perf_counter()
+    for frame in frames:
+        rows = detector([frame.color])[0]
+        boxes.append(rows[np.argmax(rows[:, 4])][:4] if len(rows) else None)
+    return boxes, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--recorded', help='folder of frames saved by frameSource.recordFrames')
+    parser.add_argument('--yolo', help='local YOLOv5 repository (with --weights)')
+    parser.add_argument('--weights')
+    parser.add_argument('--frames', type=int, default=150)
+    parser.add_argument('--stub-latency', type=float, default=0.05,
+                        help='seconds per image for the stub detector')
+    parser.add_argument('--every', type=int, nargs='+', default=[2, 3, 5, 10])
+    opts = parser.parse_args()
+
+    if opts.recorded:
+        source = RecordedSource(opts.recorded, loop=False)
+    else:
+        source = SyntheticSource(center=(200, 200), motion=(1.5, 0.8, 0.3))
+    frames = []
+    while len(frames) < opts.frames:
+        frame = source.read()
+        if frame is None:
+            break
+        frames.append(frame)
+
+    if opts.weights:
+        import modelCache
+        detector = modelCache.loadModel(opts.yolo, opts.weights)
+    else:
+        detector = benchUtils.StubDetector(opts.stub_latency)
+
+    reference, elapsed = run(detector, frames)
+    rows = [{'mode': 'every frame', 'fps': len(frames) / elapsed, 'keyframes': len(frames),
+             'mean_iou': 1.0, 'min_iou': 1.0, 'missed': 0}]
+
+    for every in opts.every:
+        # Frames are replayed faster than real time, so never expire tracks
+        tracking = TrackingDetector(detector, every, maxGap=float('inf'))
+        boxes, elapsed = run(tracking, frames)
+        ious = [benchUtils.iou(r, b) for r, b in zip(reference, boxes)
+                if r is not None and b is not None]
+        missed = sum(1 for r, b in zip(reference, boxes) if r is not None and b is None)
+        rows.append({'mode': f'track, detect every {every}', 'fps': len(frames) / elapsed,
+                     'keyframes': tracking.keyframes,
+                     'mean_iou': float(np.mean(ious)) if ious else 0.0,
+                     'min_iou': float(np.min(ious)) if ious else 0.0, 'missed': missed})
+
+    benchUtils.printTable(rows, ['mode', 'fps', 'keyframes', 'mean_iou', 'min_iou', 'missed'])
+
+
+if __name__ == '__main__':
+    main()
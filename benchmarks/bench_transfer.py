@@ -0,0 +1,168 @@
+'''
+Image transfer throughput over a simulated I2C bus.
+
+Runs the real Jetson (Nano_I2C.Nano_I2CBus behind commandLoop.CommandLoop)
+and Pi (i2c_bus.I2CBus) code against a temp file standing in for the
+slave eeprom. Every Pi side transaction takes as long as its bytes would
+on an I2C bus at --clock Hz. Compares the single-slot stop-and-wait
+transfer with windowed transfers over a multi-slot eeprom. With
+--interrupt, the bus also drops out partway through every transfer, and
+the Pi resumes it afterwards (bus_kib is what the resume moved).
+
+    python3 benchmarks/bench_transfer.py
+    python3 benchmarks/bench_transfer.py --size 30000 --clock 100000 --windows 4 8 15
+    python3 benchmarks/bench_transfer.py --interrupt 0.5
+'''
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import benchUtils
+
+from commandLoop import CommandLoop, parseOptions
+from i2c_bus import I2CBus
+from i2c_packet import LATEST_VERSION
+from Nano_I2C import Nano_I2CBus
+
+
+class SimulatedDevice:
+    '''
+    Stands in for pylibi2c.I2CDevice: reads and writes the eeprom file, each
+    transaction taking its time on the bus (9 clocks a byte, plus the
+    address bytes). With failAfter, the bus fails once that many bytes
+    have crossed it.
+    '''
+    def __init__(self, path, clock, addressBytes=2, failAfter=None):
+        self.fd = os.open(path, os.O_RDWR)
+        self.clock = clock
+        self.overhead = 1 + addressBytes
+        self.failAfter = failAfter
+        self.busTime = 0.0
+        self.busBytes = 0
+
+    def transfer(self, size):
+        if self.failAfter is not None and self.busBytes >= self.failAfter:
+            raise OSError('Simulated bus failure')
+        self.busBytes += size + self.overhead
+        seconds = (size + self.overhead) * 9 / self.clock
+        self.busTime += seconds
+        time.sleep(seconds)
+
+    def read(self, address, size):
+        self.transfer(size)
+        return os.pread(self.fd, size, address)
+
+    def write(self, address, data):
+        self.transfer(len(data))
+        return os.pwrite(self.fd, data, address)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def run(folder, size, clock, slots, window, timewait, checksum, failAfter=None):
+    '''
+    Sends one file of size bytes, after an attempt that fails once
+    failAfter bytes crossed the bus if given; returns the elapsed and bus
+    busy seconds and the bus bytes of the (resumed) transfer
+    '''
+    eeprom = os.path.join(folder, f'eeprom-{slots}')
+    with open(eeprom, 'wb') as f:
+        f.write(bytes(256 * slots))
+    with open(os.path.join(folder, 'image.jpg'), 'rb') as f:
+        content = f.read()
+    received = os.path.join(folder, 'received')
+    os.makedirs(received, exist_ok=True)
+
+    jetson = Nano_I2CBus(eeprom, slots)
+    loop = CommandLoop(jetson)
+
+    def img(arguments):
+        options = parseOptions(arguments)
+        window = int(options.get('window', 0))
+        with loop.lock:
+            if 'resume' in options:
+                jetson.file_resume(options['resume'], window)
+            else:
+                jetson.file_send('image.jpg', window, content)
+    loop.register('img', img, background=True)
+    server = threading.Thread(target=loop.serve, daemon=True)
+    server.start()
+
+    addressBytes = 2 if slots > 1 else 1
+    if failAfter:
+        broken = SimulatedDevice(eeprom, clock, addressBytes, failAfter)
+        pi = I2CBus(slots=slots, device=broken)
+        pi.timewait = timewait
+        pi.negotiate(checksum)
+        if pi.read_file(window, received):
+            raise SystemExit('The transfer was not interrupted')
+        broken.close()
+
+    # A Pi that just restarted
+    device = SimulatedDevice(eeprom, clock, addressBytes)
+    pi = I2CBus(slots=slots, device=device)
+    pi.timewait = timewait
+    pi.negotiate(checksum)
+    device.busTime, device.busBytes = 0.0, 0
+    start = time.perf_counter()
+    ok = pi.read_file(window, received, resume=bool(failAfter))
+    elapsed = time.perf_counter() - start
+
+    loop.stop()
+    server.join()
+    jetson.close()
+    device.close()
+
+    with open(os.path.join(received, 'image.jpg'), 'rb') as b:
+        if not ok or b.read() != content:
+            raise SystemExit(f'Transfer with window {window} came out wrong')
+    os.remove(os.path.join(received, 'image.jpg'))
+    return elapsed, device.busTime, device.busBytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=10000, help='file size in bytes')
+    parser.add_argument('--clock', type=int, default=400000, help='I2C clock in Hz')
+    parser.add_argument('--slots', type=int, default=16, help='eeprom slots for windowed runs')
+    parser.add_argument('--windows', type=int, nargs='+', default=[2, 4, 8, 15])
+    parser.add_argument('--timewait', type=float, default=I2CBus.timewait,
+                        help='Pi poll delay of the stop-and-wait protocol')
+    parser.add_argument('--checksum', type=int, default=LATEST_VERSION,
+                        help='packet checksum version, see i2c_packet.py')
+    parser.add_argument('--interrupt', type=float, default=None,
+                        help='also fail every transfer this fraction of the way (of its bus '
+                        'traffic) and resume it')
+    opts = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        cwd = os.getcwd()
+        os.chdir(folder)         # Nano_I2CBus writes its logfile here
+        try:
+            with open(os.path.join(folder, 'image.jpg'), 'wb') as f:
+                f.write(os.urandom(opts.size))
+            runs = [(1, 0)] + [(opts.slots, window) for window in opts.windows]
+            for slots, window in runs:
+                mode = f'window {window}' if window else 'stop-and-wait'
+                failAfter = None
+                for interrupt in [None] + ([opts.interrupt] if opts.interrupt else []):
+                    elapsed, busTime, busBytes = run(folder, opts.size, opts.clock, slots,
+                                                     window, opts.timewait, opts.checksum,
+                                                     failAfter)
+                    rows.append({'mode': f'{mode} resumed at {interrupt:.0%}' if interrupt else mode,
+                                 'seconds': elapsed, 'kib_per_s': opts.size / 1024 / elapsed,
+                                 'bus_busy': busTime / elapsed, 'bus_kib': busBytes / 1024})
+                    failAfter = int(busBytes * (opts.interrupt or 0))
+        finally:
+            os.chdir(cwd)
+
+    benchUtils.printTable(rows, ['mode', 'seconds', 'kib_per_s', 'bus_busy', 'bus_kib'])
+
+
+if __name__ == '__main__':
+    main()
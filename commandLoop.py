@@ -0,0 +1,170 @@
+'''
+Command loop for the Pi link.
+
+Commands are dispatched to handlers registered by name instead of an
+if/elif chain followed by a fixed sleep. The eeprom buffer is polled with an
+adaptive backoff: right after a command it is checked every millisecond or
+so, and the interval grows while the link is idle, so an idle loop costs
+almost no CPU and a new command is still picked up quickly.
+
+Long commands (like img) run on a worker thread so the loop keeps polling
+and answering short ones meanwhile. Every write to the bus goes through one
+lock, so replies never land in the middle of a file transfer.
+
+The proto command, answered by the loop itself, lets the Pi switch both
+ends to a later packet checksum (see i2c_packet.py).
+'''
+
+import queue
+import threading
+import time
+import traceback
+
+from Nano_I2C import Backoff, I2CPacket
+from i2c_packet import CHECKSUM_SUM, LATEST_VERSION
+
+
+def parseOptions(arguments):
+    '''
+    'key=value key2=value2' command arguments as a dict of strings
+    '''
+    options = {}
+    for word in arguments.split():
+        key, _, value = word.partition('=')
+        options[key] = value
+    return options
+
+
+class CommandLoop:
+    '''
+    Reads commands from a Nano_I2CBus and runs their handlers.
+    A handler is called with the text after the command name and returns
+    the reply (str or bytes), or None when it replies itself (through
+    reply()). Handlers registered with background=True run one at a time on
+    a worker thread.
+    '''
+    def __init__(self, bus, backoff=None):
+        self.bus = bus
+        self.backoff = backoff or Backoff()
+        self.handlers = {}
+        self.lock = threading.RLock()
+        self.jobs = queue.Queue()
+        self.worker = None
+        self.running = False
+        self.lastCommand = None
+        self.writesAtCommand = 0
+        self.register('proto', self.protocol)
+
+    def register(self, name, handler, background=False):
+        self.handlers[name] = (handler, background)
+        return self
+
+    def command(self, name, background=False):
+        '''
+        Decorator form of register()
+        '''
+        def decorate(handler):
+            self.register(name, handler, background)
+            return handler
+        return decorate
+
+    def protocol(self, arguments):
+        '''
+        proto N: the Pi asks for checksum version N. The reply, still under
+        the old checksum, names the version both ends use from then on.
+        '''
+        try:
+            requested = int(arguments)
+        except ValueError:
+            requested = CHECKSUM_SUM
+        version = max(min(requested, LATEST_VERSION), CHECKSUM_SUM)
+        with self.lock:
+            self.reply(f'proto {version}')
+            self.bus.codec.version = version
+
+    def reply(self, response, status='d', sequence=0):
+        if isinstance(response, str):
+            response = response.encode()
+        with self.lock:
+            return self.bus.write_pkt(response, status, sequence)
+
+    def poll(self):
+        '''
+        Returns (name, arguments) of a new command in the buffer, or None.
+        A command stays in the buffer until we write over it, so the same
+        packet is only taken once.
+        '''
+        # The bus belongs to a background command while it transfers
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            data = self.bus.poll_pkt()
+            if data is None:
+                return None
+            if data == self.lastCommand and self.bus.writes == self.writesAtCommand:
+                return None
+            pkt = I2CPacket.parse_pkt(data)
+            if (pkt[I2CPacket.id_index].decode(errors='ignore') != self.bus.pkt_targ_id or
+                    pkt[I2CPacket.stat_index] != b'c'):
+                return None
+            self.lastCommand, self.writesAtCommand = data, self.bus.writes
+        finally:
+            self.lock.release()
+
+        text = pkt[I2CPacket.data_index][:pkt[I2CPacket.dlen_index]]
+        name, _, arguments = text.decode(errors='replace').strip('\0').partition(' ')
+        return name, arguments.strip()
+
+    def dispatch(self, name, arguments):
+        handler, background = self.handlers.get(name, (None, False))
+        if handler is None:
+            self.reply('Command not recognized')
+        elif background:
+            self.jobs.put((name, handler, arguments))
+        else:
+            self.run(name, handler, arguments)
+
+    def run(self, name, handler, arguments):
+        start = time.monotonic()
+        try:
+            response = handler(arguments)
+        except Exception:
+            traceback.print_exc()
+            response = 'error'
+        if response is not None:
+            self.reply(response)
+        print(f'{name} handled in {(time.monotonic() - start) * 1000:.0f} ms')
+
+    def _work(self):
+        while self.running:
+            try:
+                name, handler, arguments = self.jobs.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.run(name, handler, arguments)
+
+    def start(self):
+        self.running = True
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.running = False
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def serve(self):
+        '''
+        Polls and dispatches until stop() is called
+        '''
+        self.start()
+        while self.running:
+            command = self.poll()
+            if command is None:
+                self.backoff.wait()
+                continue
+            self.backoff.reset()
+            name, arguments = command
+            print('Command received:', f'{name} {arguments}'.strip())
+            self.dispatch(name, arguments)
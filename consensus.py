@@ -0,0 +1,78 @@
+'''
+Streaming consensus over tube location samples.
+
+Each new (x, y, z, angle) sample is compared against the earlier ones by
+full 3D distance as soon as it arrives. Once some sample has enough
+neighbours within tolerance to make a quorum, that group is averaged and
+returned, so a cord command stops capturing as soon as the samples agree
+instead of always waiting for a fixed number of frames.
+'''
+
+import numpy as np
+
+
+class TubeConsensus:
+    '''
+        quorum    - samples (including the center one) that must agree
+        tolerance - cm between a sample and the center for them to agree
+    '''
+    def __init__(self, quorum=3, tolerance=10.0, capacity=8):
+        self.quorum = quorum
+        self.tolerance = tolerance
+        self.samples = np.empty((capacity, 4))
+        self.near = np.zeros((capacity, capacity), bool)
+        self.neighbours = np.zeros(capacity, int)
+        self.count = 0
+        self.result = None
+
+    def _grow(self):
+        capacity = len(self.samples) * 2
+        samples = np.empty((capacity, 4))
+        samples[:self.count] = self.samples[:self.count]
+        near = np.zeros((capacity, capacity), bool)
+        near[:self.count, :self.count] = self.near[:self.count, :self.count]
+        neighbours = np.zeros(capacity, int)
+        neighbours[:self.count] = self.neighbours[:self.count]
+        self.samples, self.near, self.neighbours = samples, near, neighbours
+
+    def add(self, sample):
+        '''
+        Adds an (x, y, z, angle) sample. Returns the agreed location once a
+        quorum is reached (see check), None before that.
+        '''
+        if self.count == len(self.samples):
+            self._grow()
+        n = self.count
+        self.samples[n] = sample
+        self.count += 1
+
+        # Distances from the new sample to all earlier ones in one go
+        close = np.linalg.norm(self.samples[:n, :3] - self.samples[n, :3], axis=1) < self.tolerance
+        self.near[n, :n] = close
+        self.near[:n, n] = close
+        self.neighbours[:n] += close
+        self.neighbours[n] = np.count_nonzero(close)
+        return self.check()
+
+    def check(self):
+        '''
+        The mean of the best agreeing group as (x, y, z, angle) with z
+        negated, like the original consensus; None if no quorum yet
+        '''
+        if not self.count:
+            return None
+        best = int(np.argmax(self.neighbours[:self.count]))
+        if self.neighbours[best] + 1 < self.quorum:
+            return None
+
+        members = self.near[best, :self.count].copy()
+        members[best] = True
+        x, y, z, angle = self.samples[:self.count][members].mean(axis=0)
+        self.result = (float(x), float(y), float(-z), float(angle))
+        return self.result
+
+    def largestGroup(self):
+        '''
+        Size of the biggest agreeing group so far
+        '''
+        return int(self.neighbours[:self.count].max()) + 1 if self.count else 0
@@ -1,145 +1,306 @@
-import math
+import threading
 import cv2
-import numpy as np
 from Nano_I2C import *
 from visionSystem import VisionSystem
+from consensus import TubeConsensus
+from coordinates import cameraToRobot
+from localizer import BackgroundLocalizer
+from commandLoop import CommandLoop, parseOptions
+from imageEncoder import FORMATS, encodeImage
 
-#Old Offset in centimeters
-#offset_x = 2.9
-#offset_y = 4.9
-#offset_z = 23.544
+# Tube location consensus: samples that must agree, how close in cm, and
+# how many good samples to try before giving up
+consensus_quorum = 3
+consensus_tolerance = 10
+consensus_samples = 5
 
-# New Offset in centimeters
-offset_x = 7.9
-offset_y = 6.1
-offset_z = 23.544
-camera_angle = math.radians(60)
+# Keep locating the tube while waiting for commands, and how old (seconds)
+# a background result may be to answer cord with. Off by default: it keeps
+# the network running while the robot is idle
+background_localize = False
+estimate_max_age = 1.0
 
-def get3Dlocation(realWorldCords):
-    return (realWorldCords[0] ** 2 + realWorldCords[1] ** 2 + realWorldCords[2] ** 2) ** 0.5
+# Packet slots of the slave eeprom: 1 for the 256 byte slave-24c02, 16 for
+# a slave-24c32, which allows windowed image transfers (see Nano_I2C.py)
+eeprom_slots = 1
+
+# img defaults: JPEG quality, and the most bytes to send (0 for no limit),
+# met by lowering the quality and then the size (see imageEncoder.py)
+image_quality = 80
+image_budget = 20000
+
+# Inference backend, see modelCache.py
+model_backend = 'torchscript'
+model_quantize = None
 
 def translateCoordinates(x, y, depth):
-        #print(f'X: {x} Y: {y} depth: {depth}')
-        camera_hyp = (x ** 2 + y ** 2) ** 0.5
-        center_depth = (depth ** 2 - camera_hyp ** 2) ** 0.5
-        #real_z = depth * math.cos(camera_angle + math.atan(y/center_depth))
-        groundhyp = depth * math.sin(camera_angle + math.atan(-y/center_depth))
-        
-        real_z = (depth**2 - groundhyp ** 2) ** .5
-        #print(math.atan(y/center_depth))
-        #print(groundhyp)
-        real_y = (groundhyp ** 2 - x ** 2) ** .5
-        return x + offset_x, real_y + offset_y, real_z - offset_z
-
-def checkTubeLocationValidity(realWorldCords):
-    match = [0] * 5
-    threshold = 10
-    matchAmount = 0
-    result = (0, 0, 0, 0)
-    for i in range(5):
-        for j in range(5):
-            if j != i :
-                if abs(get3Dlocation(realWorldCords[i]) - get3Dlocation(realWorldCords[j])) < threshold:
-                    match[j] = 1
-        for k in range(5):
-            if match[k] == 1:
-                result = tuple(sum(x) for x in zip(result, realWorldCords[k]))
-                matchAmount+=1
-                match[k] = 0
-        if matchAmount >= 3:
-            result = tuple(sum(x) for x in zip(result, realWorldCords[i]))
-            result = tuple(x/(matchAmount+1) for x in result)
-            result = result[:2] + (-result[2],) + result[3:]
+    '''
+    Camera frame position and depth in cm to robot coordinates, see coordinates.py
+    '''
+    return tuple(cameraToRobot(x, y, depth).tolist())
+
+def checkTubeLocationValidity(realWorldCords, quorum=None, tolerance=None):
+    '''
+    Consensus over a finished list of samples, see consensus.TubeConsensus.
+    Returns -2 when no quorum agrees.
+    '''
+    engine = TubeConsensus(quorum or consensus_quorum, tolerance or consensus_tolerance)
+    for sample in realWorldCords:
+        result = engine.add(sample)
+        if result is not None:
             return result
-        else:
-            matchAmount = 0
-            result = (0, 0, 0, 0)
     return -2
 
+def tubeReply(tube):
+    '''
+    A measured tube as the (x, y, z, angle) a cord reply is made of, with z
+    negated like TubeConsensus does
+    '''
+    x, y, z = tube.robot
+    return x, y, -z, tube.orientation
+
 def collectTubeLocation(vis):
+    start = time.perf_counter()
     consecutiveBad = 0
     consecutiveNone = 0
     good = 0
     cameraCords = 0
-    realWorldCords = []
-    while(good < 5 and consecutiveBad < 10 and consecutiveNone < 10):
-        data = vis.processOneFrame()
-        if(data[2] == - 1):
-            consecutiveNone+=1
-        elif(data[2] == 0):
-            consecutiveBad+=1
-            cameraCords+=data[0]/10
+    engine = TubeConsensus(consensus_quorum, consensus_tolerance)
+    result = None
+    while(result is None and good < consensus_samples and consecutiveBad < 10 and consecutiveNone < 10):
+        # Ask for just enough frames to complete a quorum, as one batch
+        needed = min(consensus_quorum - engine.largestGroup(), consensus_samples - good)
+        for tube in vis.locateFrames(max(needed, 1)):
+            if(tube is None):
+                consecutiveNone+=1
+                vis.timer.count('none')
+            elif(tube.depth == 0):
+                consecutiveBad+=1
+                vis.timer.count('bad')
+                cameraCords+=tube.realx/10
+            else:
+                vis.timer.count('good')
+                consensusStart = time.perf_counter()
+                result = engine.add(tube.robot + (tube.orientation,))
+                vis.timer.record('consensus', consensusStart)
+                good+=1
+                consecutiveBad = 0
+                consecutiveNone = 0
+            if(result is not None or consecutiveBad >= 10 or consecutiveNone >= 10):
+                break
+    if(result is None):
+        if(consecutiveNone >= 10):
+            result = -1
+        elif(consecutiveBad >= 10):
+            result = cameraCords
         else:
-            realWorldCords.append(translateCoordinates(data[0], data[1], data[2]) + (data[3],))
-            #print(realWorldCords[good])
-            #realWorldCords.append(translateCoordinates(data[0],data[1],data[2]) + tuple(0))
-            good+=1
-            consecutiveBad = 0
-            consecutiveNone = 0
-    if(consecutiveNone >= 10):
-        return -1
-    elif(consecutiveBad >= 10):
-        return cameraCords
+            result = -2
+            vis.timer.count('errors')
+    vis.timer.record('cord', start)
+    return result
+
+def locateTube(vis, background=False):
+    '''
+    A fresh collectTubeLocation result, remembered with the scene it was
+    found in so the same question about that scene gets the same answer.
+    A background run is timed as a whole under its own stage, and nothing
+    inside it (captures, inference, counters) reaches the stats, so they
+    describe the Pi's cord commands only.
+    '''
+    if background:
+        start = time.perf_counter()
+        with vis.timer.muted():
+            result = collectTubeLocation(vis)
+        vis.timer.record('background', start)
     else:
-        return checkTubeLocationValidity(realWorldCords)#tuple(x/5 for x in realWorldCords)
+        result = collectTubeLocation(vis)
+    scene = vis.scenes.current()
+    if scene is not None and isinstance(result, tuple):
+        # The reported tube is the scene's most confident one
+        scene.reply, scene.cursor = result, 1
+    return result
+
+def optionNumber(options, key, convert, default, minimum):
+    '''
+    Numeric command option converted with convert, or ValueError
+    '''
+    try:
+        value = convert(options.get(key, default))
+    except ValueError:
+        raise ValueError(f'{key} must be a number') from None
+    if value < minimum:
+        raise ValueError(f'{key} must be at least {minimum}')
+    return value
+
+def imageOptions(options):
+    '''
+    Checks and converts the img options before anything is captured.
+    Raises ValueError naming the first bad option.
+    '''
+    fmt = options.get('format', 'jpg')
+    if fmt not in FORMATS:
+        raise ValueError(f'format must be one of {",".join(FORMATS)}')
+    roi = options.get('roi') or None
+    if roi is not None and roi != 'tube':
+        try:
+            roi = tuple(float(v) for v in roi.split(','))
+        except ValueError:
+            roi = ()
+        if len(roi) != 4:
+            raise ValueError('roi must be tube or x1,y1,x2,y2')
+    scale = optionNumber(options, 'scale', float, 1, 0)
+    if not 0 < scale <= 10:
+        raise ValueError('scale must be above 0 and at most 10')
+    return {
+        'roi': roi,
+        'scale': scale,
+        'quality': optionNumber(options, 'quality', int, image_quality, 1),
+        'fmt': fmt,
+        'gray': options.get('gray', '0') not in ('0', 'false', 'no'),
+        'budget': optionNumber(options, 'budget', int, image_budget, 0),
+    }
+
+def imageBox(vis, frame, roi):
+    '''
+    Box for the img roi option (checked by imageOptions): 'tube' for the most
+    confident tube (from the cached scene, or found in frame), or
+    (x1, y1, x2, y2) in pixels
+    '''
+    if roi != 'tube':
+        return roi
+    scene = vis.latestScene()
+    if scene is not None and scene.tubes:
+        return scene.tubes[0].box
+    tube = vis.checkForTube(frame.color)
+    return tube.box if tube is not None else None
+
+def formatLocation(result):
+    '''
+    Reply text for a collectTubeLocation result
+    '''
+    if result == -2:
+        return 'error'
+    if result == -1:
+        return 'none'
+    if not isinstance(result, tuple):
+        return f'turn: {"left" if result < 0 else "right"}'
+    return "x{:.1f}y{:.1f}z{:.1f}a{:.1f}".format(*result)
+
+def registerCommands(loop, vis, visLock, localizer):
+    '''
+    Command handlers for the Pi, see commandLoop.py
+    '''
+    @loop.command('cord')
+    def cord(arguments):
+        # Answered from the background estimate when it is recent enough
+        result = localizer.latest() if localizer is not None else None
+        if result is None:
+            with visLock:
+                # The same question about an unchanged scene gets the same answer
+                scene = vis.latestScene()
+                if scene is not None and scene.reply is not None:
+                    result = scene.reply
+                else:
+                    started = time.monotonic()
+                    result = locateTube(vis)
+                    if localizer is not None:
+                        localizer.publish(result, started)
+        response = formatLocation(result)
+        print(response)
+        return response
+
+    @loop.command('next')
+    def nextTube(arguments):
+        # Next tube of the last scene, captured again only if it went stale
+        with visLock:
+            scene = vis.latestScene() or vis.captureScene()
+            tube = scene.next() if scene is not None else None
+        response = 'none' if tube is None else formatLocation(tubeReply(tube))
+        print(response)
+        return response
+
+    @loop.command('stats')
+    def stats(arguments):
+        # Per stage "name:calls,p50,max" in ms and the sample counters
+        response = vis.timer.packet(I2CPacket.data_len)
+        print(response.decode())
+        return response
+
+    @loop.command('img', background=True)
+    def img(arguments):
+        # img [roi=tube|x1,y1,x2,y2] [scale=0.5] [quality=60] [format=jpg|webp]
+        #     [gray] [budget=bytes] [window=N]
+        # img resume=NAME [window=N] picks up an interrupted transfer
+        options = parseOptions(arguments)
+        # Bad options get an end packet before the filename, like a missing
+        # frame, so the Pi gives up instead of taking the reply for a name
+        try:
+            window = optionNumber(options, 'window', int, 0, 0)
+            settings = None if 'resume' in options else imageOptions(options)
+        except ValueError as error:
+            loop.reply(f'Bad option: {error}', 't')
+            return
+        if 'resume' in options:
+            with loop.lock:
+                loop.bus.file_resume(options['resume'], window)
+            return
+
+        with visLock:
+            frame = vis.captureFrame()
+            if frame is None:
+                # An end packet before the filename: nothing is coming
+                loop.reply('No frame', 't')
+                return
+            box = imageBox(vis, frame, settings.pop('roi'))
+
+        fmt = settings['fmt']
+        try:
+            data, quality, scale = encodeImage(frame.color, box, **settings)
+        except (ValueError, cv2.error) as error:
+            loop.reply(f'Encoding failed: {error}', 't')
+            return
+        print(f'img: {len(data)} bytes, quality {quality}, scale {scale:.2f}')
+
+        # timestamped name for the Pi to save it under. It also names the
+        # transfer for resuming, so two images in a second get different ones
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        filename, copy = stamp + '.' + fmt.upper(), 1
+        while filename in loop.bus.transfers:
+            copy += 1
+            filename = f'{stamp}-{copy}.{fmt.upper()}'
+
+        # send image to Pi, keeping the bus until the transfer is over.
+        # Pis that can take several packets at a time ask for a window
+        with loop.lock:
+            loop.bus.file_send(filename, window, data)
 
 def main():
     # Initialize the I2C bus
-    i2c = Nano_I2CBus()
+    i2c = Nano_I2CBus(slots=eeprom_slots)
     # Initialize the Vision System
-    vis = VisionSystem()
-    
-    # Send ready command to Pi
-    i2c.write_pkt('Ready'.encode(), 'd', 0)
-
-    while True:
-        # wait for packet to be recieved
-        pkt = i2c.wait_response()
+    start = time.monotonic()
+    vis = VisionSystem(streaming=True, backend=model_backend, quantize=model_quantize)
+    warmup = vis.warmUp()
+    print(f'Vision ready in {time.monotonic() - start:.1f}s '
+          f'({"cached" if vis.model.warm else "cold"} model load {vis.model.loadTime:.1f}s, '
+          f'warm-up {warmup:.1f}s)')
 
-        if not pkt:
-            continue
+    # Held by whoever is using the vision system, the background localizer
+    # included
+    visLock = threading.Lock()
+    localizer = None
+    if background_localize:
+        localizer = BackgroundLocalizer(lambda: locateTube(vis, background=True), visLock, estimate_max_age,
+                                        keep=lambda result: result != -2).start()
 
-        # If the packet isn't the target ID (pi) and it isn't a command
-        if (pkt[I2CPacket.id_index].decode() != i2c.pkt_targ_id) or (pkt[I2CPacket.stat_index] != b'c'):
-            continue
+    loop = CommandLoop(i2c)
+    registerCommands(loop, vis, visLock, localizer)
 
-        print('Command received:')
+    # Send ready command to Pi
+    loop.reply('Ready')
 
-        data = pkt[I2CPacket.data_index].decode().strip('\0')
-        print(data)
-        
-        # Read command and respond back to Pi
-        if data == 'cord':
-            result = collectTubeLocation(vis)
-            if result == -2:
-                response = 'error'.encode()
-            elif result == -1:
-                response = 'none'.encode()
-            elif not isinstance(result, tuple):
-                response = (f'turn: {"left" if result < 0 else "right"}').encode()
-            else:
-                s = "x{:.1f}y{:.1f}z{:.1f}a{:.1f}"
-                response = s.format(*result)
-            
-            # Reply back to the Pi with a given response
-            i2c.write_pkt(response.encode(), 'd', 0)
-            print(response)
-                
-        elif data ==  'img':
-            result = vis.captureImage()
-            
-            # timestamp the filename and create the image
-            filename = time.strftime("%Y%m%d-%H%M%S") + '.JPG'
-            cv2.imwrite(filename, np.asanyarray(result[0].get_data()))
-            
-            # send image to Pi
-            i2c.file_send(filename)
-                
-        else: #Unkown Command
-            response = 'Command not recognized'.encode()
-            i2c.write_pkt(response, 'd', 0)
-
-        time.sleep(2)
+    # Runs until the process is stopped
+    loop.serve()
 
 if __name__ == '__main__':
     main()
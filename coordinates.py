@@ -0,0 +1,136 @@
+'''
+Pixel plus depth to robot coordinates.
+
+The camera's intrinsics are read once and every pixel's viewing ray is
+precomputed in robot axes, with the 60 degree camera tilt folded in. A
+pixel (or an array of them) with its depth then maps to robot coordinates
+with one multiply and add:
+
+    robot = depth * table[v, u] + offset
+
+Camera axes are x right, y down, z forward (z is the D405 depth value).
+Robot axes are x right, y forward along the ground and z down, shifted by
+the camera's mounting offset, matching the old translateCoordinates output.
+'''
+
+import math
+
+import numpy as np
+
+#Old Offset in centimeters
+#offset_x = 2.9
+#offset_y = 4.9
+#offset_z = 23.544
+
+# New Offset in centimeters
+CAMERA_OFFSET = (7.9, 6.1, 23.544)
+
+# Camera tilt from straight down
+CAMERA_ANGLE = math.radians(60)
+
+
+class Intrinsics:
+    '''
+    Pinhole camera parameters in pixels, with optional distortion coefficients
+    '''
+    __slots__ = ('width', 'height', 'fx', 'fy', 'ppx', 'ppy', 'coeffs')
+
+    def __init__(self, width, height, fx, fy, ppx, ppy, coeffs=None):
+        self.width = width
+        self.height = height
+        self.fx = fx
+        self.fy = fy
+        self.ppx = ppx
+        self.ppy = ppy
+        self.coeffs = coeffs
+
+    @classmethod
+    def fromRealSense(cls, intr):
+        '''
+        From a pyrealsense2.intrinsics object
+        '''
+        coeffs = list(intr.coeffs) if any(intr.coeffs) else None
+        return cls(intr.width, intr.height, intr.fx, intr.fy, intr.ppx, intr.ppy, coeffs)
+
+    def asArray(self):
+        coeffs = self.coeffs or [0.0] * 5
+        return np.array([self.width, self.height, self.fx, self.fy, self.ppx, self.ppy,
+                         *coeffs])
+
+    @classmethod
+    def fromArray(cls, values):
+        width, height, fx, fy, ppx, ppy = values[:6]
+        coeffs = [float(c) for c in values[6:11]]
+        return cls(int(width), int(height), fx, fy, ppx, ppy, coeffs if any(coeffs) else None)
+
+
+# What the code assumed before reading intrinsics from the camera
+DEFAULT_INTRINSICS = Intrinsics(640, 480, 386, 386, 320, 240)
+
+
+def cameraToRobotMatrix(cameraAngle=CAMERA_ANGLE):
+    '''
+    Rotation taking camera axes to robot axes for a camera tilted cameraAngle
+    from straight down
+    '''
+    c, s = math.cos(cameraAngle), math.sin(cameraAngle)
+    return np.array([[1, 0, 0],
+                     [0, -c, s],
+                     [0, s, c]])
+
+
+def robotShift(offset=CAMERA_OFFSET):
+    return np.array([offset[0], offset[1], -offset[2]])
+
+
+def cameraToRobot(x, y, depth, cameraAngle=CAMERA_ANGLE, offset=CAMERA_OFFSET):
+    '''
+    Camera frame point(s) in cm to robot coordinates; arrays broadcast.
+    Returns an (..., 3) array.
+    '''
+    points = np.stack(np.broadcast_arrays(x, y, depth), axis=-1).astype(np.float64)
+    return points @ cameraToRobotMatrix(cameraAngle).T + robotShift(offset)
+
+
+class RobotGeometry:
+    '''
+    Per-pixel ray lookup table for one camera stream
+    '''
+    def __init__(self, intrinsics=DEFAULT_INTRINSICS, cameraAngle=CAMERA_ANGLE,
+                 offset=CAMERA_OFFSET):
+        self.intrinsics = intrinsics
+        self.shift = robotShift(offset).astype(np.float32)
+
+        # Camera rays at unit depth, undistorted if the camera reports distortion
+        u, v = np.meshgrid(np.arange(intrinsics.width, dtype=np.float64),
+                           np.arange(intrinsics.height, dtype=np.float64))
+        if intrinsics.coeffs:
+            import cv2
+            camera = np.array([[intrinsics.fx, 0, intrinsics.ppx],
+                               [0, intrinsics.fy, intrinsics.ppy],
+                               [0, 0, 1]])
+            pixels = np.stack((u.ravel(), v.ravel()), axis=-1)[:, None, :]
+            normalized = cv2.undistortPoints(pixels, camera, np.array(intrinsics.coeffs))
+            rayx = normalized[:, 0, 0].reshape(u.shape)
+            rayy = normalized[:, 0, 1].reshape(u.shape)
+        else:
+            rayx = (u - intrinsics.ppx) / intrinsics.fx
+            rayy = (v - intrinsics.ppy) / intrinsics.fy
+        self.cameraRays = np.stack((rayx, rayy, np.ones_like(rayx)), axis=-1).astype(np.float32)
+
+        # Same rays in robot axes
+        self.table = self.cameraRays @ cameraToRobotMatrix(cameraAngle).T.astype(np.float32)
+
+    def toCamera(self, u, v, depth):
+        '''
+        Pixel(s) and depth(s) in cm to camera frame points, shape (..., 3)
+        '''
+        u, v, depth = np.asarray(u), np.asarray(v), np.asarray(depth, np.float32)
+        return depth[..., None] * self.cameraRays[v, u]
+
+    def toRobot(self, u, v, depth):
+        '''
+        Pixel(s) and depth(s) in cm to robot coordinates, shape (..., 3)
+        '''
+        u, v, depth = np.asarray(u), np.asarray(v), np.asarray(depth, np.float32)
+        return depth[..., None] * self.table[v, u] + self.shift
@@ -0,0 +1,57 @@
+'''
+Depth lookup over a detection box.
+
+A single depth pixel is often a hole (0) on the D405, which used to throw the
+whole frame away. sampleDepth looks at a patch centered in the box, ignores
+invalid pixels and takes the median of the rest. With a DepthAligner the patch
+is first mapped from the depth image into the color image (see alignment.py).
+'''
+
+import numpy as np
+
+
+def patchWindow(shape, box, patch=0.5):
+    '''
+    The (left, top, right, bottom) patch centered in box, clipped to an
+    image of the given shape
+    '''
+    height, width = shape[:2]
+    x1, y1, x2, y2 = (float(v) for v in box[:4])
+    centerx, centery = (x1 + x2) / 2, (y1 + y2) / 2
+    halfw = max((x2 - x1) * patch / 2, 1)
+    halfh = max((y2 - y1) * patch / 2, 1)
+
+    return (max(int(centerx - halfw), 0), max(int(centery - halfh), 0),
+            min(int(centerx + halfw) + 1, width), min(int(centery + halfh) + 1, height))
+
+
+def sampleDepth(depthImage, depthScale, box, patch=0.5, tolerance=2.0, aligner=None):
+    '''
+    depthImage - HxW z16 depth image, 0 meaning no data
+    depthScale - meters per depth unit
+    box        - (x1, y1, x2, y2) in color image pixels
+    patch      - size of the sampled patch as a fraction of the box
+    tolerance  - cm from the median for a pixel to count as agreeing
+    aligner    - alignment.DepthAligner mapping the depth image onto the color
+                 image, or None when the two are already aligned
+
+    Returns (depth in cm, confidence). Confidence is between 0 and 1: the
+    fraction of the patch with valid depth times the fraction of valid pixels
+    that agree with the median. Returns (0, 0) when nothing in the patch is valid.
+    '''
+    if aligner is None:
+        left, top, right, bottom = patchWindow(depthImage.shape, box, patch)
+        region = depthImage[top:bottom, left:right]
+    else:
+        color = aligner.colorIntrinsics
+        window = patchWindow((color.height, color.width), box, patch)
+        region = aligner.align(depthImage, depthScale, window)
+
+    valid = region[region > 0]
+    if valid.size == 0:
+        return 0.0, 0.0
+
+    cm = valid * (depthScale * 100)
+    depth = float(np.median(cm))
+    agreeing = np.count_nonzero(np.abs(cm - depth) < tolerance)
+    return depth, float(agreeing / region.size)
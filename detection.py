@@ -0,0 +1,59 @@
+'''
+Compact result type handed out by the vision layer.
+'''
+
+
+class Detection:
+    '''
+    One detected object.
+        box             - (x1, y1, x2, y2) in full frame pixels
+        confidence      - model confidence
+        cls             - model class index
+        depth           - distance in cm, 0 if unknown
+        depthConfidence - confidence of the depth reading (see depthSampler)
+        realx, realy    - camera frame position in cm
+        orientation     - angle from the y-axis in degrees
+        robot           - (x, y, z) robot coordinates in cm, None if unknown
+    Depth, position and orientation are filled in by VisionSystem.measureTube,
+    robot coordinates by VisionSystem.toRobot.
+    '''
+    __slots__ = ('box', 'confidence', 'cls', 'depth', 'depthConfidence',
+                 'realx', 'realy', 'orientation', 'robot')
+
+    def __init__(self, box, confidence, cls):
+        self.box = box
+        self.confidence = confidence
+        self.cls = cls
+        self.depth = 0
+        self.depthConfidence = 0.0
+        self.realx = 0
+        self.realy = 0
+        self.orientation = 0
+        self.robot = None
+
+    @classmethod
+    def fromRows(cls, rows):
+        '''
+        Builds Detections from model output rows of x1, y1, x2, y2, conf, class.
+        Accepts torch tensors, numpy arrays or lists.
+        '''
+        if hasattr(rows, 'tolist'):
+            rows = rows.tolist()
+        return [cls(tuple(row[:4]), row[4], int(row[5])) for row in rows]
+
+    def center(self):
+        '''
+        Box center in whole pixels
+        '''
+        return int((self.box[0] + self.box[2]) / 2), int((self.box[1] + self.box[3]) / 2)
+
+    def asTuple(self):
+        '''
+        The (x, y, depth, orientation) tuple processOneFrame reports
+        '''
+        return self.realx, self.realy, self.depth, self.orientation
+
+    def __repr__(self):
+        return (f'Detection(box={tuple(round(v, 1) for v in self.box)}, '
+                f'confidence={self.confidence:.2f}, cls={self.cls}, depth={self.depth:.1f}, '
+                f'orientation={self.orientation})')
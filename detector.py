@@ -0,0 +1,238 @@
+'''
+Object detectors used by the vision system.
+
+Every detector is called as detector(images, size=None) with a list of BGR
+images and returns one numpy array per image with rows of
+x1, y1, x2, y2, confidence, class in image pixels. detector.names maps class
+indices to labels.
+'''
+
+import json
+
+import cv2
+import numpy as np
+
+
+def letterbox(image, size, color=(114, 114, 114)):
+    '''
+    Resizes image to fit in a size x size square, keeping its aspect ratio,
+    and pads the rest. Returns the padded image, the scale and the (x, y) padding.
+    '''
+    height, width = image.shape[:2]
+    ratio = min(size / height, size / width)
+    newWidth, newHeight = int(round(width * ratio)), int(round(height * ratio))
+    if (newWidth, newHeight) != (width, height):
+        image = cv2.resize(image, (newWidth, newHeight), interpolation=cv2.INTER_LINEAR)
+
+    padx, pady = (size - newWidth) / 2, (size - newHeight) / 2
+    top, bottom = int(round(pady - 0.1)), int(round(pady + 0.1))
+    left, right = int(round(padx - 0.1)), int(round(padx + 0.1))
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+    return image, ratio, (left, top)
+
+
+def toBlob(images, size):
+    '''
+    Letterboxes a list of BGR images into one float32 NCHW RGB batch scaled to 0-1.
+    Returns the batch and the (scale, padding) of every image.
+    '''
+    padded = []
+    metas = []
+    for image in images:
+        image, ratio, pad = letterbox(image, size)
+        padded.append(image)
+        metas.append((ratio, pad))
+    batch = np.stack(padded)[..., ::-1].transpose(0, 3, 1, 2)
+    return np.ascontiguousarray(batch, dtype=np.float32) / 255, metas
+
+
+def nonMaxSuppression(pred, confThres=0.25, iouThres=0.45, maxDet=300):
+    '''
+    Filters one image's raw YOLOv5 output (rows of x, y, w, h, objectness,
+    class scores...) down to x1, y1, x2, y2, confidence, class rows.
+    Boxes only suppress boxes of the same class.
+    '''
+    pred = pred[pred[:, 4] > confThres]
+    if not len(pred):
+        return np.zeros((0, 6), np.float32)
+
+    scores = pred[:, 5:] * pred[:, 4:5]
+    cls = scores.argmax(1)
+    conf = scores[np.arange(len(scores)), cls]
+    keep = conf > confThres
+    pred, cls, conf = pred[keep], cls[keep], conf[keep]
+    if not len(pred):
+        return np.zeros((0, 6), np.float32)
+
+    boxes = np.empty((len(pred), 4), np.float32)
+    boxes[:, :2] = pred[:, :2] - pred[:, 2:4] / 2
+    boxes[:, 2:] = pred[:, :2] + pred[:, 2:4] / 2
+
+    # Offset boxes by class so different classes never overlap
+    shifted = boxes + cls[:, None] * 4096.0
+    areas = (shifted[:, 2] - shifted[:, 0]) * (shifted[:, 3] - shifted[:, 1])
+    order = conf.argsort()[::-1]
+    selected = []
+    while order.size and len(selected) < maxDet:
+        i = order[0]
+        selected.append(i)
+        rest = order[1:]
+        xx1 = np.maximum(shifted[i, 0], shifted[rest, 0])
+        yy1 = np.maximum(shifted[i, 1], shifted[rest, 1])
+        xx2 = np.minimum(shifted[i, 2], shifted[rest, 2])
+        yy2 = np.minimum(shifted[i, 3], shifted[rest, 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iouThres]
+
+    return np.concatenate((boxes[selected], conf[selected, None],
+                           cls[selected, None].astype(np.float32)), axis=1)
+
+
+def scaleBoxes(dets, ratio, pad, shape):
+    '''
+    Maps boxes from letterboxed model input back to the original image in place
+    '''
+    dets[:, [0, 2]] = (dets[:, [0, 2]] - pad[0]) / ratio
+    dets[:, [1, 3]] = (dets[:, [1, 3]] - pad[1]) / ratio
+    dets[:, [0, 2]] = dets[:, [0, 2]].clip(0, shape[1])
+    dets[:, [1, 3]] = dets[:, [1, 3]].clip(0, shape[0])
+    return dets
+
+
+def pickSize(sizes, size):
+    '''
+    The smallest of sizes that is at least size, or the largest one
+    '''
+    for available in sizes:
+        if available >= size:
+            return available
+    return sizes[-1]
+
+
+class HubDetector:
+    '''
+    The YOLOv5 torch.hub model, pre and post-processing included.
+    Runs at any input size. AutoShape takes numpy images as RGB, so the BGR
+    frames are flipped first, like toBlob does for the exported networks.
+    '''
+    sizes = None
+
+    def __init__(self, model):
+        self.model = model
+        self.names = model.names
+
+    def __call__(self, images, size=None):
+        images = [np.ascontiguousarray(image[..., ::-1]) for image in images]
+        results = self.model(images, size=size) if size else self.model(images)
+        return [xyxy.cpu().numpy() for xyxy in results.xyxy]
+
+
+class ExportedDetector:
+    '''
+    Base for exported YOLOv5 networks, one per input size. Exported graphs
+    have a fixed input size, so a requested size is rounded up to the nearest
+    exported one (see sizes). Subclasses load a file and run a batch; the
+    letterboxing and NMS here are shared by every backend.
+    '''
+    def __init__(self, paths, confThres=0.25, iouThres=0.45):
+        self.models = {}
+        for path in paths:
+            model, config = self.load(path)
+            self.models[config['size']] = model
+            self.names = {int(k): v for k, v in config['names'].items()}
+        self.sizes = sorted(self.models)
+        self.size = self.sizes[-1]
+        self.confThres = confThres
+        self.iouThres = iouThres
+
+    def load(self, path):
+        '''
+        Returns the loaded network and its config (size and names)
+        '''
+        raise NotImplementedError
+
+    def run(self, model, batch):
+        '''
+        Runs an NCHW float32 batch, returns the raw (N, anchors, 5 + classes) output
+        '''
+        raise NotImplementedError
+
+    def __call__(self, images, size=None):
+        size = pickSize(self.sizes, size) if size else self.size
+        batch, metas = toBlob(images, size)
+        pred = self.run(self.models[size], batch)
+
+        out = []
+        for p, (ratio, pad), image in zip(pred, metas, images):
+            dets = nonMaxSuppression(p, self.confThres, self.iouThres)
+            out.append(scaleBoxes(dets, ratio, pad, image.shape))
+        return out
+
+
+def readSidecar(path):
+    '''
+    Config stored next to an ONNX export as <path>.json
+    '''
+    with open(path + '.json') as f:
+        return json.load(f)
+
+
+class TorchScriptDetector(ExportedDetector):
+    '''
+    TorchScript exports of the YOLOv5 network. Only the traced networks are
+    loaded, so the YOLOv5 repository is never imported.
+    '''
+    def load(self, path):
+        import torch
+        self.torch = torch
+        extra = {'config.txt': ''}
+        model = torch.jit.load(path, map_location='cpu', _extra_files=extra)
+        model.eval()
+        return model, json.loads(extra['config.txt'])
+
+    def run(self, model, batch):
+        with self.torch.no_grad():
+            try:
+                pred = self._first(model(self.torch.from_numpy(batch)))
+            except RuntimeError:
+                # Traced at batch size 1; fall back to one image at a time
+                pred = self.torch.cat([self._first(model(self.torch.from_numpy(b[None])))
+                                       for b in batch])
+        return pred.numpy()
+
+    @staticmethod
+    def _first(pred):
+        return pred[0] if isinstance(pred, (tuple, list)) else pred
+
+
+class OnnxRuntimeDetector(ExportedDetector):
+    '''
+    ONNX exports run through ONNX Runtime on the CPU. Also runs the int8
+    quantized exports.
+    '''
+    def load(self, path):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = onnxruntime.InferenceSession(path, options,
+                                               providers=['CPUExecutionProvider'])
+        return session, readSidecar(path)
+
+    def run(self, model, batch):
+        return model.run(None, {model.get_inputs()[0].name: batch})[0]
+
+
+class OpenCVDnnDetector(ExportedDetector):
+    '''
+    ONNX exports run through OpenCV's DNN module, no extra runtime needed
+    '''
+    def load(self, path):
+        net = cv2.dnn.readNetFromONNX(path)
+        net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        return net, readSidecar(path)
+
+    def run(self, model, batch):
+        model.setInput(batch)
+        return model.forward()
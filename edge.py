@@ -1,27 +1,39 @@
 import cv2
-from math import atan, degrees
+import numpy as np
+from math import atan2, degrees
+
+# Fewer edge pixels than this and the fit is not trusted
+MIN_EDGE_PIXELS = 10
+
 #top left (x,y) representing top left corner of tube box
 #bottom right (x,y) same as above
 #center (x,y) same as above
 def get_degrees(top_left, bottom_right, center, img):
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    img_out = cv2.Canny(gray, 100, 150)
-    first_white_col, first_white_row = top_left[1], top_left[0]
-    done = 0
-    for row in range(top_left[0], bottom_right[0]):
-        for col in range(top_left[1], bottom_right[1]):
-            if img_out[col][row] > 0:
-                first_white_col, first_white_row = col, row
-                done = 1
-                break
-        if done:
-            break
-    
-    tan_triangle = abs(center[1] - first_white_col) / abs(center[0] - first_white_row)
-    degrees_off_axis =  90 - degrees(atan(tan_triangle))
-    if(first_white_col > center[1]):
-        degrees_off_axis = 180 - degrees_off_axis
-    print(f"First white pixel: {first_white_col} {first_white_row}")
-    print(f"Center: {center[0]}, {center[1]}")
-    print(f"Degrees from y-axis = {degrees_off_axis} and {done}")
-    return(degrees_off_axis)
+    '''
+    Returns the tube's angle from the y-axis in degrees, between 0 and 180.
+    Only the box is run through Canny, and the tube axis is the principal
+    component of the edge pixels found there. If the box has too few edges the
+    box diagonal through the center is used instead.
+    '''
+    height, width = img.shape[:2]
+    x0, x1 = max(top_left[0], 0), min(bottom_right[0], width)
+    y0, y1 = max(top_left[1], 0), min(bottom_right[1], height)
+
+    ux, uy = center[0] - top_left[0], center[1] - top_left[1]
+    if x1 > x0 and y1 > y0:
+        roi = img[y0:y1, x0:x1]
+        if roi.ndim == 3:
+            roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+        ys, xs = np.nonzero(cv2.Canny(roi, 100, 150))
+
+        if len(xs) >= MIN_EDGE_PIXELS:
+            # Principal axis of the edge pixels
+            points = np.stack((xs, ys)).astype(np.float32)
+            points -= points.mean(axis=1, keepdims=True)
+            _, vectors = np.linalg.eigh(points @ points.T)
+            ux, uy = vectors[0, 1], vectors[1, 1]
+
+    # Point the axis to the right so the angle lands in [0, 180]
+    if ux < 0 or (ux == 0 and uy < 0):
+        ux, uy = -ux, -uy
+    return 90 - degrees(atan2(uy, ux))
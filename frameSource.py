@@ -0,0 +1,343 @@
+'''
+Frame sources for the vision system.
+
+A frame source hands out FramePair objects (color image, z16 depth image and
+the depth scale needed to turn it into meters). The RealSense D405 is the
+production source; RecordedSource and SyntheticSource stand in for the camera
+in benchmarks and bench testing without the robot.
+
+CaptureEngine keeps a source running on a background thread and holds the
+newest few frames in a ring buffer so callers never pay for pipeline start-up
+or auto-exposure settling.
+'''
+
+import collections
+import glob
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from alignment import DepthAligner
+from coordinates import Intrinsics
+
+
+class FramePair:
+    '''
+    A color/depth capture taken at the same time.
+        color      - HxWx3 uint8 BGR image
+        depth      - HxW uint16 z16 depth image (0 means no data)
+        depthScale - meters per depth unit
+        timestamp  - time.monotonic() when the frame was read
+        index      - increasing frame number from the source
+    '''
+    __slots__ = ('color', 'depth', 'depthScale', 'timestamp', 'index')
+
+    def __init__(self, color, depth, depthScale, timestamp, index):
+        self.color = color
+        self.depth = depth
+        self.depthScale = depthScale
+        self.timestamp = timestamp
+        self.index = index
+
+
+class FrameSource:
+    '''
+    Base class for anything that produces FramePairs.
+    read() returns the next FramePair, or None once the source is exhausted.
+    intrinsics describes the color stream once known (None means the
+    defaults in coordinates.py). aligner maps the depth image onto the color
+    image when the two are not aligned (see alignment.py).
+    '''
+    intrinsics = None
+    aligner = None
+
+    def start(self):
+        pass
+
+    def read(self):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class RealSenseSource(FrameSource):
+    '''
+    Intel RealSense camera (D405 on the robot).
+    Frames are copied out of librealsense so they can be buffered without
+    starving the driver's frame pool. A frameset missing its depth or color
+    frame is skipped; read() only gives up (raising) after attempts of them
+    in a row, as None would mean the camera is done for good.
+    '''
+    attempts = 5
+
+    def __init__(self, width=640, height=480, fps=30):
+        import pyrealsense2 as rs
+        self.rs = rs
+        self.pipeline = rs.pipeline()
+        self.config = rs.config()
+        self.config.enable_stream(rs.stream.depth, width, height, rs.format.z16, fps)
+        self.config.enable_stream(rs.stream.color, width, height, rs.format.bgr8, fps)
+        self.profile = None
+        self.depthScale = 0.001
+        self.index = 0
+
+    def start(self):
+        self.profile = self.pipeline.start(self.config)
+        depthSensor = self.profile.get_device().first_depth_sensor()
+        self.depthScale = depthSensor.get_depth_scale()
+        color = self.profile.get_stream(self.rs.stream.color).as_video_stream_profile()
+        depth = self.profile.get_stream(self.rs.stream.depth).as_video_stream_profile()
+        self.intrinsics = Intrinsics.fromRealSense(color.get_intrinsics())
+        # The ray tables only need building once
+        if self.aligner is None:
+            self.aligner = DepthAligner.fromProfiles(depth, color)
+
+    def read(self):
+        for _ in range(self.attempts):
+            frames = self.pipeline.wait_for_frames()
+            depth_frame = frames.get_depth_frame()
+            color_frame = frames.get_color_frame()
+            if depth_frame and color_frame:
+                break
+        else:
+            raise RuntimeError(f'{self.attempts} incomplete framesets in a row')
+        self.index += 1
+        return FramePair(np.asanyarray(color_frame.get_data()).copy(),
+                         np.asanyarray(depth_frame.get_data()).copy(),
+                         self.depthScale, time.monotonic(), self.index)
+
+    def stop(self):
+        self.pipeline.stop()
+
+
+class RecordedSource(FrameSource):
+    '''
+    Replays frames saved by recordFrames(): a folder of .npz files, each holding
+    'color', 'depth', 'depthScale' and optionally 'intrinsics' and 'alignment'.
+    With fps set the replay is paced like the camera, otherwise frames are
+    returned as fast as they are asked for.
+    '''
+    def __init__(self, folder, loop=True, fps=None):
+        self.files = sorted(glob.glob(os.path.join(folder, '*.npz')))
+        if not self.files:
+            raise FileNotFoundError(f'No recorded frames in {folder}')
+        self.loop = loop
+        self.period = 1 / fps if fps else 0
+        self.frames = [None] * len(self.files)
+        self.position = 0
+        self.index = 0
+        self.lastRead = 0
+        with np.load(self.files[0]) as data:
+            if 'intrinsics' in data:
+                self.intrinsics = Intrinsics.fromArray(data['intrinsics'])
+            if 'alignment' in data:
+                self.aligner = DepthAligner.fromArray(data['alignment'])
+
+    def read(self):
+        if self.position >= len(self.files):
+            if not self.loop:
+                return None
+            self.position = 0
+
+        # Cache decoded frames so replay speed is not limited by disk
+        if self.frames[self.position] is None:
+            with np.load(self.files[self.position]) as data:
+                self.frames[self.position] = (data['color'], data['depth'],
+                                              float(data['depthScale']))
+        color, depth, depthScale = self.frames[self.position]
+        self.position += 1
+
+        if self.period:
+            delay = self.lastRead + self.period - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.lastRead = time.monotonic()
+
+        self.index += 1
+        return FramePair(color, depth, depthScale, time.monotonic(), self.index)
+
+
+class SyntheticSource(FrameSource):
+    '''
+    Draws a dark tube on a light background with a matching depth image.
+        center     - tube center in pixels
+        size       - tube (length, width) in pixels
+        angle      - tube angle in degrees
+        depth      - tube distance in cm (the floor is farther away)
+        holeRate   - fraction of depth pixels zeroed out, like real depth holes
+        motion     - (dx, dy, dangle) applied every frame
+    '''
+    def __init__(self, center=(320, 240), size=(160, 40), angle=30.0, depth=30.0,
+                 holeRate=0.0, motion=(0, 0, 0), width=640, height=480,
+                 depthScale=0.0001, seed=0):
+        self.center = center
+        self.size = size
+        self.angle = angle
+        self.depth = depth
+        self.holeRate = holeRate
+        self.motion = motion
+        self.width = width
+        self.height = height
+        self.depthScale = depthScale
+        self.rng = np.random.default_rng(seed)
+        self.index = 0
+
+    def tubeCorners(self):
+        '''
+        Corners of the tube in the current frame, as an int32 4x2 array
+        '''
+        rect = (tuple(float(c) for c in self.center), self.size, self.angle)
+        return np.int32(cv2.boxPoints(rect))
+
+    def read(self):
+        corners = self.tubeCorners()
+
+        color = np.full((self.height, self.width, 3), 200, np.uint8)
+        cv2.fillPoly(color, [corners], (40, 40, 160))
+
+        units = 0.01 / self.depthScale
+        depth = np.full((self.height, self.width), int((self.depth + 15) * units), np.uint16)
+        cv2.fillPoly(depth, [corners], int(self.depth * units))
+        if self.holeRate:
+            depth[self.rng.random(depth.shape) < self.holeRate] = 0
+
+        self.index += 1
+        frame = FramePair(color, depth, self.depthScale, time.monotonic(), self.index)
+
+        dx, dy, dangle = self.motion
+        self.center = (self.center[0] + dx, self.center[1] + dy)
+        self.angle += dangle
+        return frame
+
+
+def restartSource(source):
+    try:
+        source.stop()
+    except Exception:
+        # It may not have been running after a failed start
+        pass
+    source.start()
+
+
+def readFrame(source, attempts=3, delay=0.5):
+    '''
+    source.read() that survives transient camera errors (a wait_for_frames
+    timeout, a USB hiccup): the source is restarted and read again, up to
+    attempts times, before the last error is raised. Returns None only once
+    the source is exhausted.
+    '''
+    for attempt in range(attempts):
+        try:
+            return source.read()
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            print('Camera error, restarting it:', e)
+            time.sleep(delay)
+            try:
+                restartSource(source)
+            except Exception as e:
+                print('Camera restart failed:', e)
+
+
+def recordFrames(source, folder, count):
+    '''
+    Saves count frames from source into folder for later use with RecordedSource
+    '''
+    os.makedirs(folder, exist_ok=True)
+    source.start()
+    try:
+        extra = {}
+        if source.intrinsics is not None:
+            extra['intrinsics'] = source.intrinsics.asArray()
+        if source.aligner is not None:
+            extra['alignment'] = source.aligner.asArray()
+        for i in range(count):
+            frame = source.read()
+            if frame is None:
+                break
+            np.savez_compressed(os.path.join(folder, f'{i:05d}.npz'), color=frame.color,
+                                depth=frame.depth, depthScale=frame.depthScale, **extra)
+    finally:
+        source.stop()
+
+
+class CaptureEngine:
+    '''
+    Keeps a frame source streaming on a background thread.
+    The newest bufferSize frames are kept in a ring buffer; older frames are
+    dropped as new ones arrive. Camera errors restart the source (see
+    readFrame); if that does not help the engine stops with error set, and
+    restart() brings it back.
+    '''
+    def __init__(self, source, bufferSize=4):
+        self.source = source
+        self.frames = collections.deque(maxlen=bufferSize)
+        self.lock = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.error = None
+
+    def start(self):
+        if self.running:
+            return
+        self.source.start()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.running = False
+        self.thread.join()
+        self.thread = None
+        self.source.stop()
+
+    def _run(self):
+        try:
+            while self.running:
+                frame = readFrame(self.source)
+                if frame is None:
+                    break
+                with self.lock:
+                    self.frames.append(frame)
+                    self.lock.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.lock:
+                self.running = False
+                self.lock.notify_all()
+
+    def restart(self):
+        '''
+        Starts the engine again after the source failed or ran out
+        '''
+        if self.thread is not None:
+            self.running = False
+            self.thread.join()
+            self.thread = None
+        self.error = None
+        restartSource(self.source)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def latest(self, after=-1, timeout=1.0):
+        '''
+        Returns the newest frame with an index greater than after.
+        Only waits when no such frame has arrived yet, which does not happen
+        once the consumer is slower than the camera.
+        Returns None on timeout or if the source stopped.
+        '''
+        with self.lock:
+            self.lock.wait_for(lambda: (self.frames and self.frames[-1].index > after)
+                               or not self.running, timeout)
+            if self.frames and self.frames[-1].index > after:
+                return self.frames[-1]
+            return None
@@ -4,86 +4,11 @@ The Jetson's I2C address is hardcoded to 0x64 currently
 The Pi provides the I2C bus as a device: "/dev/i2c-1"
 '''
 
-import pylibi2c
+import os
 import time
-import struct
+import hashlib
 
-class I2CPacket:
-    '''
-    Contains functions that aim to abstract away all the functionality
-    related to packets, mainly building it and verifying packet integrity
-
-    Packet structure:
-    Size of data                - Python type
-    245 byte for data           - bytes
-    1 byte for data length      - integer
-    1 byte for status messages  - bytes
-    4 bytes for parity          - integer
-    4 bytes for sequence number - integer
-    1 byte for sender ID        - bytes
-    '''
-
-    struct_format: str = '=245sBcIIc'
-    data_len: int = 245
-    data_index: int = 0
-    dlen_index: int = 1
-    stat_index: int = 2
-    par_index: int = 3
-    seq_index: int = 4
-    id_index: int = 5
-
-    def create_pkt(data: bytes, size: int, status: str,
-                   sequence: int, ID: str):
-        '''
-        Builds a packet containing the specified data. Adds in checksum.
-
-        Returns bytes object for writing.
-        '''
-        # Check lengths of input. Return false if packing cannot be done
-        if size > I2CPacket.data_len:
-            return False
-
-        # Create packet with zero checksum for calculation
-        pkt_array = bytearray(struct.pack(I2CPacket.struct_format,
-                                            data, size, status[:1].encode(),
-                                            0, sequence, ID[:1].encode()))
-
-        # Find checksum and stick individual bytes into place
-        pkt_array[247:251] = sum(pkt_array).to_bytes(4, 'little')
-
-        # Convert back into bytes object for returning
-        return bytes(pkt_array)
-
-    def parse_pkt(pkt: bytes):
-        '''
-        Unpacks packet, returns resulting tuple
-        '''
-        return struct.unpack(I2CPacket.struct_format, pkt)
-
-    def verify_pkt(pkt: bytes):
-        '''
-        Given a packet, calculates checksum, checks with provided checksum of
-        packet.
-
-        Returns True if they match, False if they do not.
-        '''
-        # Convert to byte array
-        pkt_array = bytearray(pkt)
-
-        # Extract checksum from packet
-        provided = int.from_bytes(pkt_array[247:251], 'little', signed=False)
-
-        # Substitute checksum with all zeros
-        pkt_array[247:251] = bytearray(4)
-
-        # Calculate checksum
-        calculated = sum(pkt_array)
-
-        # Return True if matching, False otherwise
-        if calculated == provided:
-            return True
-        else:
-            return False
+from i2c_packet import I2CPacket, PacketCodec, LATEST_VERSION
 
 class I2CBus:
     '''
@@ -92,22 +17,33 @@ class I2CBus:
 
     blocksize: int = 256    # Max bytes capable of sending
     timewait: float = 0.2
+    polltime: float = 0.001 # Delay between slot reads in windowed transfers
 
     pkt_self_id: str = 'P'
     pkt_targ_id: str = 'J'
 
-    def __init__(self, target = 0x64, dev = '/dev/i2c-1'):
+    def __init__(self, target = 0x64, dev = '/dev/i2c-1', slots = 1, device = None):
         '''
         Initializes the bus using the imported library.
 
         Default device address for Jetson is 0x64
         Default device for I2C on Pi is i2c-1
+        slots is the number of 256 byte packet slots of the Jetson's eeprom;
+        more than one (e.g. 16 for a slave-24c32) needs two byte addresses
+        and allows windowed file transfers.
+        device replaces the pylibi2c device, e.g. with a simulated bus.
         '''
         self.target = target # I2C address of the target (Jetson)
         self.dev = dev       # I2C bus being used on Pi
-        self.bus = pylibi2c.I2CDevice(self.dev, self.target)
-
-    def write_msg(self, data):
+        self.slots = slots
+        if device is None:
+            import pylibi2c
+            device = pylibi2c.I2CDevice(self.dev, self.target,
+                                        iaddr_bytes=2 if slots > 1 else 1)
+        self.bus = device
+        self.codec = PacketCodec()   # Checksum version 1 until negotiate()
+
+    def write_msg(self, data, slot: int = 0):
         '''
         Takes a string, converts it to bytes to send across I2C to the
         specified target.
@@ -133,9 +69,9 @@ class I2CBus:
             except:
                 return False
 
-        return self.bus.write(0x0, data)
+        return self.bus.write(slot * self.blocksize, data)
 
-    def read_msg(self, size: int = blocksize):
+    def read_msg(self, size: int = blocksize, slot: int = 0):
         '''
         Reads the message stored on the Jetson's I2C buffer.
 
@@ -145,20 +81,22 @@ class I2CBus:
         if size > self.blocksize:
             raise ValueError
 
-        data = self.bus.read(0x0, size)
+        data = self.bus.read(slot * self.blocksize, size)
 
         # Read requested size, return bytes object
         return data
 
-    def write_pkt(self, data: bytes, status: str, sequence: int):
+    def write_pkt(self, data: bytes, status: str, sequence: int, slot: int = 0):
         '''
         Builds a packet around the requested data, sends it over I2C to the
         Jetson.
         '''
-        pkt = I2CPacket.create_pkt(data, len(data), status, sequence, self.pkt_self_id)
+        pkt = self.codec.encode(data, status, sequence, self.pkt_self_id)
+        if pkt is None:
+            return False
 
         # Return status of write
-        return self.write_msg(pkt)
+        return self.write_msg(bytes(pkt), slot)
 
     def read_pkt(self):
         '''
@@ -174,7 +112,7 @@ class I2CBus:
             data = self.read_msg()
 
             # Check its integrity (checksum)
-            if not I2CPacket.verify_pkt(data):
+            if not self.codec.verify(data):
                 time.sleep(self.timewait)
                 continue
 
@@ -211,7 +149,11 @@ class I2CBus:
             # If the sender doesn't match the target, try again
             if sender != self.pkt_self_id:
                 # Check its integrity (checksum)
-                if I2CPacket.verify_pkt(data):
+                if self.codec.verify(data):
+                    return pkt
+
+                # The Jetson restarted and went back to the first checksum
+                if sender == self.pkt_targ_id and self.codec.fallback(data):
                     return pkt
 
             time.sleep(self.timewait)
@@ -229,15 +171,12 @@ class I2CBus:
         '''
         i = 0
 
-        # Create packet
-        pkt = I2CPacket.create_pkt(data, len(data), status, sequence,
-                                   self.pkt_self_id)
-        
         # Sent packet and wait for a response
         # Catch external IO errors 5 times before relenting
         while i < 5:
-            # Write packet, return false if it fails
-            if self.write_msg(pkt) < 0:
+            # Write packet (built again each time, in case the checksum
+            # version changed), return false if it fails
+            if self.write_pkt(data, status, sequence) < 0:
                 i += 1
                 continue
 
@@ -262,54 +201,207 @@ class I2CBus:
 
         raise OSError('Could not establish communication with device')
 
-    def read_file(self):
+    def negotiate(self, version: int = LATEST_VERSION):
+        '''
+        Asks the Jetson for checksum version (see i2c_packet.py) and
+        switches to the one it agrees to. Jetsons that do not know the
+        proto command keep version 1.
+
+        Returns the version in use
+        '''
+        pkt = self.send_and_wait(f'proto {version}'.encode(), 'c', 0)
+        reply = pkt[I2CPacket.data_index].decode(errors='ignore').strip('\0').split() if pkt else []
+        if len(reply) == 2 and reply[0] == 'proto' and reply[1].isdigit():
+            self.codec.version = int(reply[1])
+        return self.codec.version
+
+    def request_file(self, cmd: str):
+        '''
+        Sends an img command and returns the Jetson's first reply. Older
+        Jetsons that do not take arguments get a plain img instead.
+        '''
+        pkt = self.send_and_wait(cmd.encode(), 'c', 0)
+        if pkt and cmd != 'img' and pkt[I2CPacket.data_index].startswith(b'Command not recognized'):
+            pkt = self.send_and_wait(b'img', 'c', 0)
+        return pkt
+
+    def partial_file(self, folder: str):
+        '''
+        Name of the newest file in folder whose transfer was interrupted
+        (kept as name.part), or None
+        '''
+        parts = [entry for entry in os.scandir(folder) if entry.name.endswith('.part')]
+        if not parts:
+            return None
+        return max(parts, key=lambda entry: entry.stat().st_mtime).name[:-len('.part')]
+
+    def read_file(self, window: int = 0, folder: str = '.', options: str = '',
+                  resume: bool = False):
         '''
         Reads the contents of a file from the Jetson. Works in tandem with the
             monitor on the Jetson's side of the comm channel, as we can only
             receive the file 256 bytes at a time.
+        With window above 1 and a multi-slot eeprom, asks the Jetson for a
+            windowed transfer (see read_file_windowed); Jetsons that do not
+            know it fall back to one packet at a time.
+        options are passed on to the Jetson's img command, e.g.
+            'roi=tube scale=0.5 quality=60 gray budget=8000'.
+        The file is written into folder, as name.part until all of it has
+            arrived and matches the digest in the end packet. An interrupted
+            transfer leaves the .part file, and read_file(resume=True) then
+            asks the Jetson (which keeps its last few files) for the rest of
+            it only. If there is none, or the Jetson no longer has it, a new
+            file is requested.
         '''
-        sequence = 0
-        
+        window = min(window, self.slots - 1)
+        windowed = f'window={window}' if window > 1 else ''
+
         # Send command and wait for response with filename
-        cmd = 'img'
-        pkt = self.send_and_wait(cmd.encode(), 'c', sequence)
-        
-        # Return false on packet error
+        pkt = None
+        resuming = self.partial_file(folder) if resume else None
+        if resuming:
+            pkt = self.request_file(' '.join(filter(None, ['img', 'resume=' + resuming, windowed])))
+            if pkt and pkt[I2CPacket.data_index].startswith(b'Unknown transfer'):
+                pkt = None
+        if pkt is None:
+            pkt = self.request_file(' '.join(filter(None, ['img', options, windowed])))
+
+        # Return false on packet error, or an end packet in place of the
+        # filename (the Jetson had no image to send)
         if not pkt:
             return False
+        if pkt[I2CPacket.stat_index] == b't':
+            print('No file:', pkt[I2CPacket.data_index].decode(errors='replace').strip('\0'))
+            return False
         
         # filename
-        file = pkt[I2CPacket.data_index].decode().strip('\0')
-            
+        file = os.path.basename(pkt[I2CPacket.data_index].decode().strip('\0'))
+        path = os.path.join(folder, file)
+        part = path + '.part'
+
+        # Pick up where the interrupted transfer stopped; a part the Jetson
+        # did not continue is not coming back
+        offset = 0
+        if resuming == file:
+            offset = os.path.getsize(part) // I2CPacket.data_len
+            os.truncate(part, offset * I2CPacket.data_len)
+            print('Resuming at chunk', offset)
+        elif resuming and os.path.exists(os.path.join(folder, resuming + '.part')):
+            os.remove(os.path.join(folder, resuming + '.part'))
+
+        with open(part, 'ab' if offset else 'wb') as new_file:
+            try:
+                if pkt[I2CPacket.stat_index] == b'w':
+                    end = self.read_file_windowed(new_file, pkt[I2CPacket.seq_index], offset)
+                else:
+                    end = self.read_chunks(new_file, offset)
+            except OSError:
+                end = False
+
+        if not end:
+            print('Transmission interrupted, read_file(resume=True) continues it')
+            return False
+        return self.finish_file(part, path, end)
+
+    def read_chunks(self, new_file, offset: int = 0):
+        '''
+        Receives a file one packet at a time, from chunk offset on. Every
+        ready packet carries the sequence number of the chunk needed next,
+        so a chunk that did not arrive is asked for again, not the file.
+        Returns the end packet, False on packet error
+        '''
         print('Transmission starting')
+        sequence = offset
+
+        # While the Jetson does not terminate the transmission
+        while True:
+            # Send 'ready' and wait for next packet
+            pkt = self.send_and_wait(b'', 'r', sequence)
+
+            # Return false on packet error
+            if not pkt:
+                return False
 
-        # Open file for writing
-        with open(file, 'wb') as new_file:
+            if pkt[I2CPacket.stat_index] == b't':
+                return pkt
 
-            # While the Jetson does not terminate the transmission
-            while pkt[I2CPacket.stat_index] != b't':
-                # Send 'ready' and wait for next packet
-                pkt = self.send_and_wait(b'', 'r', sequence)
+            # Not the chunk asked for: ask again
+            if pkt[I2CPacket.stat_index] != b'd' or pkt[I2CPacket.seq_index] != sequence:
+                continue
 
-                # Return false on packet error
-                if not pkt:
-                    return False
-                
-                # Grab relevant data
-                data = pkt[I2CPacket.data_index]
-                data_len = pkt[I2CPacket.dlen_index]
+            # Write data to new file
+            new_file.write(pkt[I2CPacket.data_index][:pkt[I2CPacket.dlen_index]])
 
-                # Write data to new file
-                new_file.write(data[:data_len])
+            # Increment packet number
+            sequence += 1
 
-                # Increment packet number
-                sequence += 1
+    def read_file_windowed(self, new_file, window: int, offset: int = 0):
+        '''
+        Receives a windowed transfer from chunk offset on: packet n arrives
+        in slot 1 + n % window and the Jetson keeps sending ahead until
+        window packets are unacknowledged. Acknowledgements go in slot 0 as
+        'a' packets holding the next sequence number needed, sent every half
+        window, and again whenever the next packet has not shown up yet.
+        Returns the end packet, False on timeout
+        '''
+        print('Windowed transmission starting')
+        expected = offset
+        timeout = time.time() + 3
+
+        # Ready for the first packet needed
+        self.write_pkt(b'', 'a', expected)
+        acked = expected
+
+        while timeout > time.time():
+            data = self.read_msg(slot=1 + expected % window)
+            pkt = I2CPacket.parse_pkt(data) if len(data) == self.blocksize else None
+
+            # The slot still holds an older packet, or is being written
+            if (pkt is None or pkt[I2CPacket.seq_index] != expected or
+                    pkt[I2CPacket.id_index] != self.pkt_targ_id.encode() or
+                    not self.codec.verify(data)):
+                if acked != expected:
+                    self.write_pkt(b'', 'a', expected)
+                    acked = expected
+                time.sleep(self.polltime)
+                continue
+
+            expected += 1
+            timeout = time.time() + 3
+            if pkt[I2CPacket.stat_index] == b't':
+                # Let the Jetson know everything arrived
+                self.write_pkt(b'', 'a', expected)
+                return pkt
+
+            new_file.write(pkt[I2CPacket.data_index][:pkt[I2CPacket.dlen_index]])
+            if expected - acked >= max(window // 2, 1):
+                self.write_pkt(b'', 'a', expected)
+                acked = expected
+
+        return False
+
+    def finish_file(self, part: str, path: str, end):
+        '''
+        Checks the received file against the SHA-256 in the end packet and
+        gives it its name. On a mismatch the file is removed, as only a new
+        transfer can fix it. Older Jetsons send no digest.
+        '''
+        words = end[I2CPacket.data_index][:end[I2CPacket.dlen_index]].split()
+        if len(words) == 2 and words[0] == b'end':
+            with open(part, 'rb') as received:
+                digest = hashlib.sha256(received.read()).hexdigest().encode()
+            if digest != words[1]:
+                print('File digest mismatch')
+                os.remove(part)
+                return False
 
-        return True  
+        os.replace(part, path)
+        return True
 
 # Used for testing sending commands and recieving data with the jetson nano
 def main():
     bus = I2CBus()
+    print('Checksum version', bus.negotiate())
 
     # test writing a command to get cordinates
     bus.write_pkt(b'cord', 'c', 0)
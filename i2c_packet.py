@@ -0,0 +1,136 @@
+'''
+Packet format shared by the Jetson (Nano_I2C.py) and the Pi (i2c_bus.py).
+Copy this file next to i2c_bus.py on the Pi.
+
+Packets are packed with one precompiled struct into a buffer that is reused
+for every packet, and checked in place through a memoryview, without
+copying them to blank out the checksum field.
+
+Two checksums are known, by protocol version:
+    1 - sum of all the bytes (the original protocol)
+    2 - CRC32, which also catches swapped bytes and errors that cancel out
+        in the sum, at the same cost
+Both ends start at version 1; the Pi asks for a later one with the proto
+command (see commandLoop.py and I2CBus.negotiate).
+'''
+
+import struct
+import zlib
+
+CHECKSUM_SUM: int = 1
+CHECKSUM_CRC32: int = 2
+LATEST_VERSION: int = CHECKSUM_CRC32
+
+class I2CPacket:
+    '''
+    Contains functions that aim to abstract away all the functionality
+    related to packets, mainly building it and verifying packet integrity
+    Packet structure:
+    Size of data                - Python type
+    245 byte for data           - bytes
+    1 byte for data length      - integer
+    1 byte for status messages  - bytes
+    4 bytes for checksum        - integer
+    4 bytes for sequence number - integer
+    1 byte for sender ID        - bytes
+    '''
+
+    struct_format: str = '=245sBcIIc'
+    layout: struct.Struct = struct.Struct(struct_format)
+    size: int = layout.size
+    data_len: int = 245
+    data_index: int = 0
+    dlen_index: int = 1
+    stat_index: int = 2
+    par_index: int = 3
+    seq_index: int = 4
+    id_index: int = 5
+
+    def create_pkt(data: bytes, size: int, status: str,
+                   sequence: int, ID: str):
+        '''
+        Builds a packet containing the specified data, with a version 1
+        checksum. Returns bytes object for writing, False if data does not
+        fit.
+        '''
+        if size > I2CPacket.data_len:
+            return False
+        return bytes(PacketCodec().encode(data[:size], status, sequence, ID))
+
+    def parse_pkt(pkt: bytes):
+        '''
+        Unpacks packet, returns resulting tuple
+        '''
+        return I2CPacket.layout.unpack(pkt)
+
+    def verify_pkt(pkt: bytes):
+        '''
+        Given a packet, checks its version 1 checksum.
+        Returns True if it matches, False if it does not.
+        '''
+        return verify(pkt, CHECKSUM_SUM)
+
+# The checksum field sits between the status byte and the sequence number
+checksum_field: struct.Struct = struct.Struct('<I')
+checksum_start: int = 247
+checksum_end: int = checksum_start + checksum_field.size
+
+def byte_sum(view: memoryview):
+    # The low half of an Adler-32 is 1 + the byte sum modulo 65521, and 256
+    # bytes add up to at most 65280: the exact sum, without a Python loop
+    return (zlib.adler32(view[checksum_end:], zlib.adler32(view[:checksum_start])) & 0xffff) - 1
+
+def crc32(view: memoryview):
+    return zlib.crc32(view[checksum_end:], zlib.crc32(view[:checksum_start]))
+
+checksums = {CHECKSUM_SUM: byte_sum, CHECKSUM_CRC32: crc32}
+
+def verify(pkt: bytes, version: int):
+    '''
+    True if pkt holds the checksum of the given version of its other bytes
+    '''
+    if len(pkt) != I2CPacket.size:
+        return False
+    view = memoryview(pkt)
+    return checksums[version](view) == checksum_field.unpack_from(view, checksum_start)[0]
+
+class PacketCodec:
+    '''
+    Builds and checks packets for one end of the link.
+    encode() returns the same buffer every time, so write it out before
+    encoding the next packet, and do not encode from two threads at once.
+    version is the checksum in use and changes when the ends agree on
+    another one.
+    '''
+
+    def __init__(self, version: int = CHECKSUM_SUM):
+        self.version = version
+        self.buffer = bytearray(I2CPacket.size)
+        self.view = memoryview(self.buffer)
+
+    def encode(self, data: bytes, status: str, sequence: int, ID: str):
+        '''
+        Packs a packet into the buffer and returns the buffer, or None if
+        data does not fit.
+        '''
+        if len(data) > I2CPacket.data_len:
+            return None
+        I2CPacket.layout.pack_into(self.buffer, 0, data, len(data), status[:1].encode(),
+                                   0, sequence, ID[:1].encode())
+        checksum_field.pack_into(self.buffer, checksum_start,
+                                 checksums[self.version](self.view))
+        return self.buffer
+
+    def verify(self, pkt: bytes):
+        return verify(pkt, self.version)
+
+    def fallback(self, pkt: bytes):
+        '''
+        For a packet from the other end that failed verify(): a packet that
+        checks out under version 1 means the other end restarted and is back
+        to version 1, so this end goes back too. Returns True in that case.
+        '''
+        if self.version == CHECKSUM_SUM or not verify(pkt, CHECKSUM_SUM):
+            return False
+        self.version = CHECKSUM_SUM
+        return True
@@ -0,0 +1,100 @@
+'''
+In-memory image encoding for the img command.
+
+Every byte of an image sent to the Pi crosses the I2C link, so images can be
+cropped to a box, scaled down, turned gray and encoded at a chosen JPEG or
+WebP quality. With a byte budget the quality (and if need be the scale) is
+lowered until the image fits.
+'''
+
+import cv2
+
+FORMATS = {
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+}
+
+# Lowest settings tried to meet a byte budget
+MIN_QUALITY = 10
+MIN_SCALE = 0.1
+SCALE_STEP = 0.7
+
+
+def cropBox(image, box, margin=0.25):
+    '''
+    image cropped to box (x1, y1, x2, y2) grown by margin of its size on
+    each side, clipped to the image
+    '''
+    height, width = image.shape[:2]
+    x1, y1, x2, y2 = box[:4]
+    marginx, marginy = (x2 - x1) * margin, (y2 - y1) * margin
+    left, top = max(int(x1 - marginx), 0), max(int(y1 - marginy), 0)
+    right, bottom = min(int(x2 + marginx) + 1, width), min(int(y2 + marginy) + 1, height)
+    if right <= left or bottom <= top:
+        return image
+    return image[top:bottom, left:right]
+
+
+def encode(image, fmt, quality, scale):
+    if scale != 1:
+        size = (max(int(image.shape[1] * scale), 1), max(int(image.shape[0] * scale), 1))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    extension, flag = FORMATS[fmt]
+    ok, data = cv2.imencode(extension, image, [flag, int(quality)])
+    if not ok:
+        raise ValueError(f'Could not encode the image as {fmt}')
+    return data.tobytes()
+
+
+def encodeImage(image, box=None, scale=1.0, quality=80, fmt='jpg', gray=False, budget=None):
+    '''
+    Encodes a BGR image in memory.
+        box     - (x1, y1, x2, y2) to crop to, with some margin
+        scale   - resize factor
+        quality - JPEG or WebP quality, 1 to 100
+        fmt     - 'jpg' or 'webp'
+        gray    - drop the color
+        budget  - maximum size in bytes, met by lowering the quality, then
+                  the scale
+    Returns (bytes, quality, scale) with the settings actually used. When
+    even the lowest settings do not fit the budget, returns the smallest
+    image found.
+    '''
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown image format {fmt}')
+    if box is not None:
+        image = cropBox(image, box)
+    if gray and image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    quality = min(max(int(quality), 1), 100)
+
+    data = encode(image, fmt, quality, scale)
+    if not budget or len(data) <= budget:
+        return data, quality, scale
+
+    # Lowest quality tried: MIN_QUALITY, or the one asked for if lower
+    lowest = min(MIN_QUALITY, quality)
+    smallest = None
+    high = quality - 1
+    while True:
+        # If even the lowest quality does not fit at this scale, no other
+        # will; else search for the highest one that does
+        attempt = encode(image, fmt, lowest, scale)
+        if len(attempt) <= budget:
+            best, low = (attempt, lowest), lowest + 1
+            while low <= high:
+                middle = (low + high) // 2
+                attempt = encode(image, fmt, middle, scale)
+                if len(attempt) <= budget:
+                    best, low = (attempt, middle), middle + 1
+                else:
+                    high = middle - 1
+            return best[0], best[1], scale
+        # Smallest image so far, with the settings that made it
+        if smallest is None or len(attempt) < len(smallest[0]):
+            smallest = (attempt, lowest, scale)
+
+        if scale * SCALE_STEP < MIN_SCALE:
+            return smallest
+        scale *= SCALE_STEP
+        high = quality
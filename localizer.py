@@ -0,0 +1,96 @@
+'''
+Speculative tube localization while the robot waits for commands.
+
+control.py used to leave the camera idle until a cord command arrived and
+only then start capturing and running the network. BackgroundLocalizer
+keeps running the consensus location on a background thread instead, so a
+cord command can be answered from a result that is at most maxAge old, and
+only falls back to an on-demand run when there is none.
+'''
+
+import threading
+import time
+
+
+class BackgroundLocalizer:
+    '''
+    Runs locate() over and over on a background thread, keeping the newest
+    result.
+        locate - function returning a fresh result (control.locateTube)
+        lock   - held around every locate() call; anything else using the
+                 vision system must hold it too
+        maxAge - seconds a result stays usable
+        idle   - seconds between runs, leaving room for other users of the lock
+        keep   - function telling which results are worth keeping
+    '''
+    def __init__(self, locate, lock=None, maxAge=1.0, idle=0.05, keep=lambda result: True):
+        self.locate = locate
+        self.lock = lock or threading.Lock()
+        self.maxAge = maxAge
+        self.idle = idle
+        self.keep = keep
+        self.state = threading.Lock()
+        self.result = None
+        self.timestamp = 0
+        self.running = False
+        self.thread = None
+        self.runs = 0
+        self.hits = 0
+        self.misses = 0
+        self.error = None
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.running = False
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        while self.running:
+            try:
+                with self.lock:
+                    started = time.monotonic()
+                    result = self.locate()
+                self.runs += 1
+                self.publish(result, started)
+            except Exception as e:
+                # Keep going; the on-demand path will report the problem
+                self.error = e
+                time.sleep(1)
+            time.sleep(self.idle)
+
+    def publish(self, result, timestamp):
+        '''
+        Offers a result found at timestamp (time.monotonic()), from the
+        background thread or from an on-demand run
+        '''
+        if not self.keep(result):
+            return
+        with self.state:
+            if timestamp >= self.timestamp:
+                self.result, self.timestamp = result, timestamp
+
+    def latest(self):
+        '''
+        The newest result if it is at most maxAge old, else None
+        '''
+        with self.state:
+            result, age = self.result, time.monotonic() - self.timestamp
+        if result is None or age > self.maxAge:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def summary(self):
+        return {'runs': self.runs, 'hits': self.hits, 'misses': self.misses,
+                'error': repr(self.error) if self.error else None}
@@ -0,0 +1,187 @@
+'''
+Serves annotated frames as an MJPEG stream over HTTP, for watching the
+vision system over SSH without an X display on the Jetson.
+
+    http://<jetson>:<port>/             page showing the stream
+    http://<jetson>:<port>/stream.mjpg  the stream itself
+    http://<jetson>:<port>/frame.jpg    the newest frame
+
+publish() only hands the newest frame to the encoder thread, so the vision
+loop never waits on JPEG encoding or on the network. Nothing is encoded while
+no client is connected, and every client is sent the newest JPEG when it is
+ready for one, so a slow client skips frames instead of holding anyone up.
+'''
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+
+BOUNDARY = b'frame'
+
+PAGE = b'''<html><head><title>Tube detection</title></head>
+<body style="margin:0;background:#000"><img src="/stream.mjpg"></body></html>'''
+
+
+class MjpegServer:
+    '''
+    MJPEG stream of the frames passed to publish()
+        port, host - where to listen
+        quality    - JPEG quality, 0 to 100
+        timeout    - seconds a client may take to accept a frame before it is
+                     disconnected
+    '''
+    def __init__(self, port=8080, host='0.0.0.0', quality=80, timeout=5.0):
+        self.quality = quality
+        self.timeout = timeout
+        self.lock = threading.Condition()
+        self.frame = None
+        self.frameIndex = 0
+        self.jpeg = None
+        self.jpegIndex = 0
+        self.clients = 0
+        self.running = False
+        self.encoder = None
+        self.serverThread = None
+
+        self.httpd = ThreadingHTTPServer((host, port), StreamHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stream = self
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        self.encoder = threading.Thread(target=self._encode, daemon=True)
+        self.encoder.start()
+        self.serverThread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.serverThread.start()
+        return self
+
+    def stop(self):
+        if not self.running:
+            return
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.encoder.join()
+        self.serverThread.join()
+
+    def watching(self):
+        '''
+        True while at least one client is connected, so callers can skip
+        drawing frames nobody will see
+        '''
+        return self.clients > 0
+
+    def publish(self, image):
+        '''
+        Offers a BGR frame to the stream. Replaces any frame still waiting to
+        be encoded; does nothing when no one is watching.
+        '''
+        if image is None or not self.clients:
+            return
+        with self.lock:
+            self.frame = image
+            self.frameIndex += 1
+            self.lock.notify_all()
+
+    def _encode(self):
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        encoded = 0
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: not self.running or self.frameIndex > encoded)
+                if not self.running:
+                    return
+                image, encoded = self.frame, self.frameIndex
+                self.frame = None
+            if image is None:
+                continue
+
+            ok, jpeg = cv2.imencode('.jpg', image, params)
+            if not ok:
+                continue
+            with self.lock:
+                self.jpeg = jpeg.tobytes()
+                self.jpegIndex += 1
+                self.lock.notify_all()
+
+    def nextJpeg(self, after, timeout=1.0):
+        '''
+        Returns (index, jpeg) for the newest JPEG newer than after, or
+        (after, None) on timeout or shutdown
+        '''
+        with self.lock:
+            self.lock.wait_for(lambda: not self.running or self.jpegIndex > after, timeout)
+            if not self.running or self.jpegIndex <= after:
+                return after, None
+            return self.jpegIndex, self.jpeg
+
+    def connect(self, change):
+        with self.lock:
+            self.clients += change
+            if not self.clients:
+                self.frame = None
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server.stream
+        if self.path == '/':
+            self.reply('text/html', PAGE)
+        elif self.path == '/frame.jpg':
+            # Counts as watching until a fresh frame has been encoded
+            server.connect(1)
+            try:
+                _, jpeg = server.nextJpeg(server.jpegIndex, server.timeout)
+            finally:
+                server.connect(-1)
+            if jpeg is None:
+                self.send_error(503, 'No frame yet')
+            else:
+                self.reply('image/jpeg', jpeg)
+        elif self.path == '/stream.mjpg':
+            self.stream(server)
+        else:
+            self.send_error(404)
+
+    def reply(self, contentType, body):
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, server):
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Type',
+                         'multipart/x-mixed-replace; boundary=' + BOUNDARY.decode())
+        self.end_headers()
+        # A client that stops reading is dropped instead of blocking its thread forever
+        self.connection.settimeout(server.timeout)
+
+        server.connect(1)
+        try:
+            sent = server.jpegIndex
+            while server.running:
+                index, jpeg = server.nextJpeg(sent)
+                if jpeg is None:
+                    continue
+                # Frames encoded while this one was being sent are skipped
+                sent = index
+                self.wfile.write(b'--' + BOUNDARY + b'\r\n'
+                                 b'Content-Type: image/jpeg\r\n'
+                                 b'Content-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n')
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+        except OSError:
+            pass
+        finally:
+            server.connect(-1)
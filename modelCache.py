@@ -0,0 +1,230 @@
+'''
+Caches exports of the YOLOv5 weights for the inference backends.
+
+torch.hub.load imports the whole YOLOv5 repository and rebuilds the model
+from the .pt file on every boot. The first load exports the network for the
+chosen backend, to an artifact named after a hash of the weights file; later
+boots load only that artifact. Changing the weights file changes the hash,
+so a stale artifact is never used.
+
+Backends:
+    torchscript - traced network run by PyTorch (default)
+    onnxruntime - ONNX export run by ONNX Runtime, optionally int8 quantized
+    opencv      - ONNX export run by OpenCV's DNN module
+    hub         - the torch.hub model itself, nothing cached
+'''
+
+import copy
+import glob
+import hashlib
+import json
+import os
+import time
+
+from detector import (HubDetector, OnnxRuntimeDetector, OpenCVDnnDetector,
+                      TorchScriptDetector, readSidecar, toBlob)
+
+BACKENDS = {
+    'torchscript': TorchScriptDetector,
+    'onnxruntime': OnnxRuntimeDetector,
+    'opencv': OpenCVDnnDetector,
+}
+
+# Int8 quantization modes, only run by the onnxruntime backend
+QUANTIZE_MODES = ('dynamic', 'static')
+
+
+def weightsHash(path):
+    '''
+    Short sha256 of a weights file
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def artifactPath(weights, cacheDir, size, key=None, suffix='.torchscript'):
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    key = key or weightsHash(weights)
+    return os.path.join(cacheDir, f'{stem}-{key}-{size}{suffix}')
+
+
+def artifactSuffix(backend, quantize=None):
+    if backend == 'torchscript':
+        return '.torchscript'
+    return f'-int8{quantize}.onnx' if quantize else '.onnx'
+
+
+def prepareNetwork(hubModel, size):
+    '''
+    Returns a CPU copy of the bare network inside a torch.hub YOLOv5 model,
+    set up for export, and the config (input size and class names) saved
+    with it. The artifacts are loaded onto the CPU, and on the Jetson's CUDA
+    build torch.hub puts the model on the GPU, where tracing it with a CPU
+    input fails. The copy also leaves the hub model as it was, for the
+    fallback when an export fails.
+    '''
+    # AutoShape -> DetectMultiBackend -> DetectionModel
+    net = copy.deepcopy(hubModel.model.model).float().cpu()
+    net.eval()
+    for m in net.modules():
+        if type(m).__name__ == 'Detect':
+            m.inplace = False
+            m.export = True
+
+    names = hubModel.names
+    if isinstance(names, (list, tuple)):
+        names = dict(enumerate(names))
+    return net, {'size': size, 'names': {str(k): v for k, v in names.items()}}
+
+
+def exportTorchScript(hubModel, path, size):
+    '''
+    Traces the network and saves it with the config it needs at load time
+    '''
+    import torch
+
+    net, config = prepareNetwork(hubModel, size)
+    dummy = torch.zeros(1, 3, size, size)
+    with torch.no_grad():
+        traced = torch.jit.trace(net, dummy, strict=False)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    traced.save(tmp, _extra_files={'config.txt': json.dumps(config)})
+    os.replace(tmp, path)
+
+
+def writeSidecar(path, config):
+    with open(path + '.json', 'w') as f:
+        json.dump(config, f)
+
+
+def exportOnnx(hubModel, path, size):
+    '''
+    Exports the network to ONNX with a dynamic batch size. The config goes
+    into <path>.json next to it.
+    '''
+    import torch
+
+    net, config = prepareNetwork(hubModel, size)
+    dummy = torch.zeros(1, 3, size, size)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(net, dummy, tmp, opset_version=12, do_constant_folding=True,
+                          input_names=['images'], output_names=['output0'],
+                          dynamic_axes={'images': {0: 'batch'}, 'output0': {0: 'batch'}})
+    writeSidecar(path, config)
+    os.replace(tmp, path)
+
+
+def calibrationImages(folder):
+    return sorted(glob.glob(os.path.join(folder, '*.jpg')) +
+                  glob.glob(os.path.join(folder, '*.png')))
+
+
+def quantizeOnnx(src, dst, mode, calibration=None, limit=100):
+    '''
+    Writes an int8 version of an ONNX export.
+        dynamic - weights quantized ahead of time, activations at run time
+        static  - weights and activations quantized with ranges measured on
+                  the images in the calibration folder
+    '''
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_dynamic, quantize_static)
+
+    config = readSidecar(src)
+    tmp = dst + '.tmp'
+    if mode == 'dynamic':
+        quantize_dynamic(src, tmp, weight_type=QuantType.QUInt8)
+    elif mode == 'static':
+        files = calibrationImages(calibration) if calibration else []
+        if not files:
+            raise ValueError('Static quantization needs a folder of calibration images')
+
+        class Reader(CalibrationDataReader):
+            def __init__(self):
+                self.files = iter(files[:limit])
+
+            def get_next(self):
+                path = next(self.files, None)
+                if path is None:
+                    return None
+                import cv2
+                batch, _ = toBlob([cv2.imread(path)], config['size'])
+                return {'images': batch}
+
+        quantize_static(src, tmp, Reader(), quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    else:
+        raise ValueError(f'Unknown quantization mode {mode}')
+    writeSidecar(dst, config)
+    os.replace(tmp, dst)
+
+
+def exportArtifact(hubModel, weights, cacheDir, size, key, backend, quantize, calibration):
+    path = artifactPath(weights, cacheDir, size, key, artifactSuffix(backend, quantize))
+    if backend == 'torchscript':
+        exportTorchScript(hubModel, path, size)
+        return
+
+    onnxPath = artifactPath(weights, cacheDir, size, key, '.onnx')
+    if not os.path.exists(onnxPath):
+        exportOnnx(hubModel, onnxPath, size)
+    if quantize:
+        quantizeOnnx(onnxPath, path, quantize, calibration)
+
+
+def loadModel(directoryOfNNWeights, nameOfWeights, cacheDir=None, sizes=(640,),
+              backend='torchscript', quantize=None, calibration=None):
+    '''
+    Returns a detector for the weights at the given input sizes on the given
+    backend, loading the cached artifacts when there are some and creating
+    the missing ones otherwise. quantize ('dynamic' or 'static') picks an
+    int8 variant on the onnxruntime backend; static quantization calibrates
+    on the images in the calibration folder. Falls back to the torch.hub
+    model if an export fails.
+    The detector's loadTime and warm attributes tell how long this took and
+    whether the cache was used.
+    '''
+    if backend != 'hub' and backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}')
+    if quantize and (backend != 'onnxruntime' or quantize not in QUANTIZE_MODES):
+        raise ValueError(f'{quantize} quantization is not available on {backend}')
+
+    start = time.monotonic()
+    if backend == 'hub':
+        import torch
+        model = HubDetector(torch.hub.load(directoryOfNNWeights, 'custom', path=nameOfWeights,
+                                           source='local'))
+        model.loadTime, model.warm = time.monotonic() - start, False
+        return model
+
+    if cacheDir is None:
+        cacheDir = os.path.join(os.path.dirname(os.path.abspath(nameOfWeights)), 'model_cache')
+    key = weightsHash(nameOfWeights)
+    suffix = artifactSuffix(backend, quantize)
+    paths = {size: artifactPath(nameOfWeights, cacheDir, size, key, suffix)
+             for size in sorted(set(sizes))}
+
+    missing = [size for size, path in paths.items() if not os.path.exists(path)]
+    if missing:
+        import torch
+        hubModel = torch.hub.load(directoryOfNNWeights, 'custom', path=nameOfWeights,
+                                  source='local')
+        try:
+            for size in missing:
+                exportArtifact(hubModel, nameOfWeights, cacheDir, size, key, backend,
+                               quantize, calibration)
+        except Exception as e:
+            print(f'{backend} export failed ({e}), using the torch.hub model')
+            model = HubDetector(hubModel)
+            model.loadTime, model.warm = time.monotonic() - start, False
+            return model
+
+    model = BACKENDS[backend](list(paths.values()))
+    model.loadTime, model.warm = time.monotonic() - start, not missing
+    return model
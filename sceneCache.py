@@ -0,0 +1,110 @@
+'''
+Snapshots of everything detected in one capture.
+
+A capture usually sees more than one tube, but the vision system used to
+keep only the one it reported. A Scene keeps all of them with their robot
+coordinates, so the Pi can ask for the next tube, or ask the same question
+again, without another capture and inference. SceneCache hands the last
+Scene back until it is older than its time to live or the camera image has
+visibly changed since.
+'''
+
+import time
+
+import cv2
+import numpy as np
+
+# Size of the grayscale thumbnail compared to tell whether the scene changed
+THUMBNAIL_SIZE = (32, 24)
+
+
+def thumbnail(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+class Scene:
+    '''
+    The measured tubes of one frame, most confident first. Only tubes with
+    depth (and so robot coordinates) are kept.
+        tubes      - list of Detections
+        timestamp  - time.monotonic() of the capture
+        frameIndex - index of the captured frame
+        cursor     - how many tubes next() has handed out
+        reply      - the answer already given for this scene, if any
+    '''
+    __slots__ = ('tubes', 'timestamp', 'frameIndex', 'thumbnail', 'cursor', 'reply')
+
+    def __init__(self, frame, detections):
+        self.tubes = sorted((tube for tube in detections if tube.robot is not None),
+                            key=lambda tube: tube.confidence, reverse=True)
+        self.timestamp = frame.timestamp
+        self.frameIndex = frame.index
+        self.thumbnail = thumbnail(frame.color)
+        self.cursor = 0
+        self.reply = None
+
+    def age(self):
+        return time.monotonic() - self.timestamp
+
+    def next(self):
+        '''
+        The next tube not handed out yet, or None once all have been
+        '''
+        if self.cursor >= len(self.tubes):
+            return None
+        self.cursor += 1
+        return self.tubes[self.cursor - 1]
+
+
+class SceneCache:
+    '''
+    Holds the newest Scene.
+        ttl             - seconds a Scene stays usable
+        changeThreshold - mean gray level difference of the thumbnails above
+                          which a newer frame is a different scene
+    '''
+    def __init__(self, ttl=2.0, changeThreshold=6.0):
+        self.ttl = ttl
+        self.changeThreshold = changeThreshold
+        self.scene = None
+        self.hits = 0
+        self.misses = 0
+
+    def store(self, scene):
+        '''
+        Keeps scene as the newest. When it shows the same scene as the one it
+        replaces, the tubes already handed out and the reply carry over.
+        '''
+        previous = self.scene
+        if (previous is not None and previous.age() <= self.ttl and
+                np.abs(scene.thumbnail - previous.thumbnail).mean() <= self.changeThreshold):
+            scene.cursor = max(scene.cursor, previous.cursor)
+            if scene.reply is None:
+                scene.reply = previous.reply
+        self.scene = scene
+        return scene
+
+    def invalidate(self):
+        self.scene = None
+
+    def changed(self, scene, frame):
+        if frame.index == scene.frameIndex:
+            return False
+        difference = np.abs(thumbnail(frame.color) - scene.thumbnail).mean()
+        return difference > self.changeThreshold
+
+    def current(self, frame=None):
+        '''
+        The cached Scene, or None when there is none, it expired, or frame (a
+        newer capture, if given) shows the scene has changed
+        '''
+        scene = self.scene
+        if scene is not None and (scene.age() > self.ttl or
+                                  (frame is not None and self.changed(scene, frame))):
+            self.scene = scene = None
+        if scene is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return scene
@@ -0,0 +1,138 @@
+'''
+Runs a chain of processing stages on their own threads.
+
+Stages are connected by small bounded queues that drop their oldest item
+when full. A slow stage therefore never makes the stages before it wait, and
+the item it picks up next is always a recent one, so latency stays bounded
+and the frame rate is set by the slowest stage instead of the sum of all.
+'''
+
+import collections
+import threading
+import time
+
+
+class DropOldestQueue:
+    '''
+    Bounded FIFO that discards its oldest item instead of blocking put()
+    '''
+    def __init__(self, maxsize=2):
+        self.items = collections.deque(maxlen=maxsize)
+        self.lock = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.lock:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.lock.notify()
+
+    def get(self, timeout=None):
+        '''
+        Returns the oldest item, or None on timeout or once closed and empty
+        '''
+        with self.lock:
+            self.lock.wait_for(lambda: self.items or self.closed, timeout)
+            return self.items.popleft() if self.items else None
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+
+class Stage:
+    '''
+    One pipeline step. work(item) returns the item for the next stage, or None
+    to pass nothing on. The first stage has no inbox and work() is called
+    with no arguments to produce items; it returning None ends the input.
+    '''
+    def __init__(self, name, work, inbox, outbox):
+        self.name = name
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.count = 0
+        self.busy = 0.0
+        self.error = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while self.running:
+                if self.inbox is None:
+                    start = time.perf_counter()
+                    result = self.work()
+                    if result is None:
+                        break
+                else:
+                    item = self.inbox.get(timeout=0.5)
+                    if item is None:
+                        if self.inbox.closed:
+                            break
+                        continue
+                    start = time.perf_counter()
+                    result = self.work(item)
+                self.busy += time.perf_counter() - start
+                self.count += 1
+                if result is not None:
+                    self.outbox.put(result)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.outbox.close()
+
+
+class StagePipeline:
+    '''
+    Chain of stages; items from the last stage come out of output.
+
+        pipeline = StagePipeline()
+        pipeline.add('capture', source.read)
+        pipeline.add('infer', infer)
+        pipeline.start()
+        result = pipeline.output.get()
+    '''
+    def __init__(self, queueSize=2):
+        self.queueSize = queueSize
+        self.stages = []
+        self.output = DropOldestQueue(queueSize)
+
+    def add(self, name, work):
+        inbox = self.output if self.stages else None
+        self.output = DropOldestQueue(self.queueSize)
+        self.stages.append(Stage(name, work, inbox, self.output))
+        return self
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.running = False
+        for stage in self.stages:
+            stage.outbox.close()
+        for stage in self.stages:
+            stage.thread.join()
+
+    def errors(self):
+        return [(stage.name, stage.error) for stage in self.stages if stage.error]
+
+    def stats(self):
+        '''
+        Per stage: items handled, mean busy time and items dropped from its
+        inbox because it fell behind
+        '''
+        return {stage.name: {'count': stage.count,
+                             'mean_ms': stage.busy / stage.count * 1000 if stage.count else 0.0,
+                             'dropped': stage.inbox.dropped if stage.inbox else 0}
+                for stage in self.stages}
@@ -0,0 +1,105 @@
+'''
+Low cost timing of the vision hot path.
+
+Every stage keeps its most recent durations in a preallocated ring, so
+recording is a subtraction and two array stores, and nothing runs while
+the robot is idle. Percentiles are only worked out when someone asks for
+a summary (the Pi's stats command).
+'''
+
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+
+class StageTimer:
+    '''
+        stages   - names of the timed stages
+        counters - names of the event counters
+        size     - durations kept per stage
+    Usage on the hot path:
+        start = time.perf_counter()
+        ...
+        timer.record('inference', start)
+    '''
+    def __init__(self, stages, counters=(), size=128):
+        self.stages = list(stages)
+        self.slot = {name: i for i, name in enumerate(self.stages)}
+        self.size = size
+        self.samples = array('d', bytes(8 * size * len(self.stages)))
+        self.totals = [0] * len(self.stages)
+        self.counters = dict.fromkeys(counters, 0)
+        self.local = threading.local()
+
+    @contextmanager
+    def muted(self):
+        '''
+        Nothing the calling thread records or counts inside the block is
+        kept. Other threads are not affected.
+        '''
+        self.local.muted = True
+        try:
+            yield
+        finally:
+            self.local.muted = False
+
+    def record(self, stage, start):
+        '''
+        Records the time since start (a time.perf_counter() value) for stage.
+        Returns the current time so consecutive stages can be chained.
+        '''
+        now = time.perf_counter()
+        if getattr(self.local, 'muted', False):
+            return now
+        i = self.slot[stage]
+        self.samples[i * self.size + self.totals[i] % self.size] = now - start
+        self.totals[i] += 1
+        return now
+
+    def count(self, counter, amount=1):
+        if getattr(self.local, 'muted', False):
+            return
+        self.counters[counter] += amount
+
+    def recent(self, stage):
+        '''
+        The stored durations of stage in seconds, oldest first
+        '''
+        i = self.slot[stage]
+        total = self.totals[i]
+        ring = self.samples[i * self.size:(i + 1) * self.size]
+        if total <= self.size:
+            return list(ring[:total])
+        split = total % self.size
+        return list(ring[split:]) + list(ring[:split])
+
+    def summary(self):
+        '''
+        Per stage: total calls and p50, p95 and max of the stored durations in ms
+        '''
+        out = {}
+        for stage in self.stages:
+            recent = sorted(self.recent(stage))
+            if not recent:
+                out[stage] = {'calls': 0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+                continue
+            out[stage] = {'calls': self.totals[self.slot[stage]],
+                          'p50_ms': recent[len(recent) // 2] * 1000,
+                          'p95_ms': recent[min(int(len(recent) * 0.95), len(recent) - 1)] * 1000,
+                          'max_ms': recent[-1] * 1000}
+        return out
+
+    def packet(self, limit=245):
+        '''
+        Compact text summary for an I2C packet: "stage:calls,p50,max;" per
+        timed stage in whole ms, then "counter=value" pairs, cut to limit bytes
+        '''
+        parts = [f'{stage[:3]}:{s["calls"]},{s["p50_ms"]:.0f},{s["max_ms"]:.0f}'
+                 for stage, s in self.summary().items() if s['calls']]
+        parts += [f'{name}={value}' for name, value in self.counters.items()]
+        return ';'.join(parts).encode()[:limit]
+
+    def reset(self):
+        self.totals = [0] * len(self.stages)
+        self.counters = dict.fromkeys(self.counters, 0)
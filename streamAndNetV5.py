@@ -1,122 +1,195 @@
-import pyrealsense2 as rs
-import numpy as np
-import cv2
+'''
+Visualizes the object detection live from the camera.
+
+    python3 streamAndNetV5.py              # window with annotated frames
+    python3 streamAndNetV5.py --no-display # headless, prints tube data only
+    python3 streamAndNetV5.py --serve 8080 # headless, annotated MJPEG stream on port 8080
+    python3 streamAndNetV5.py --pipelined  # capture/infer/post-process threads
+    python3 streamAndNetV5.py --track 5    # network on every 5th frame, tracking between
+    python3 streamAndNetV5.py --adaptive 80 # input size picked per frame for 80 ms inference
+'''
+
+import argparse
 import time
-import torch
-import math
-import edge
+
+import cv2
+
+from adaptiveResolution import ResolutionController
+from annotator import Annotator
+from frameSource import readFrame
+from mjpegServer import MjpegServer
+from stagePipeline import StagePipeline
+from visionSystem import VisionSystem
 
 #MAIN
 
-HEIGHT_OF_CAMERA = 45.0
-
-# Build Neural Net
-model = torch.hub.load('/home/herbie/OVision2022/pyrealsense/librealsense-2.51.1/build/', 'custom', path='best.pt', source='local')
-
-# Set up pipeline
-pipeline = rs.pipeline()
-config = rs.config()
-
-config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
-
-# Start streaming
-pipeline.start(config)
-
-try:
-    while True:
-
-        # Wait for a coherent pair of frames: depth and color
-        frames = pipeline.wait_for_frames()
-        depth_frame = frames.get_depth_frame()
-        color_frame = frames.get_color_frame()
-        if not depth_frame or not color_frame:
-            continue
-
-        # Convert images to numpy arrays
-        depth_image = np.asanyarray(depth_frame.get_data())
-        color_image = np.asanyarray(color_frame.get_data())
-
-        # Apply colormap on depth image (image must be converted to 8-bit per pixel first)
-        depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=0.03), cv2.COLORMAP_JET)
-
-        image = color_image.copy()
-        results = model(image)
-        results.render()
-        print(image.shape)
-        print(color_image.shape)
-        if len(results.xyxy) > 0 and len(results.xyxy[0]) > 0:
-            centery = int((results.xyxy[0][0][1] + results.xyxy[0][0][3])/2)
-            centerx = int((results.xyxy[0][0][0] + results.xyxy[0][0][2])/2)
-            depth = depth_frame.get_distance(centerx, centery) * 100
-            
-            if (depth > 0): 
-                real_x = (centerx - 320) * depth / 386
-                groundhyp = (depth ** 2 - HEIGHT_OF_CAMERA ** 2) ** .5
-                real_y = (groundhyp ** 2 - real_x ** 2) ** .5
-                #real_y = (centery - 240) * depth_frame.get_distance(centerx, centery) /386
-                #real_z = math.sqrt(pow(real_x, 2) + pow(real_y, 2))
-                #real_depth_angle = math.asin(real_z / depth_frame.get_distance(centerx, centery))
-                #real_xy_angle = math.atan(-real_y/real_x)
-
-                xdist = (results.xyxy[0][0][0] - results.xyxy[0][0][2])
-                ydist = (results.xyxy[0][0][1] - results.xyxy[0][0][3])
-                ratio = xdist / ydist
-                if (ratio > 3):
-                    orient = "Orientation: 90.00"
-                elif (ratio < .55):
-                    orient = "Orientation: 0.00"
-                else:
-                    print("EDGE!! \n")
-                    print(results.xyxy[0][0])
-                    orient = "Orientation: " + str(round(edge.get_degrees((int(results.xyxy[0][0][0]), int(results.xyxy[0][0][1])), (int(results.xyxy[0][0][2]), int(results.xyxy[0][0][3])), (centerx, centery), color_image), 2))
-                    
-                print("Ratio: " + str(ratio) + "\n")
-                cv2.putText(results.ims[0],
-                        "X-Coord: " + str(round(real_x, 2)),
-                        (10, 410),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        .5,
-                        (0, 0, 255),
-                        1)
-                if (not isinstance(real_y, complex)): 
-                    cv2.putText(results.ims[0],
-                        "Y-Coord: " + str(round(real_y, 2)),
-                        (10, 430),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        .5,
-                        (0, 0, 255),
-                        1)       
-                cv2.putText(results.ims[0],
-                        "   Depth: " + str(round(depth, 2)),
-                        (10, 450),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        .5,
-                        (0, 0, 255),
-                        1)       
-                cv2.putText(results.ims[0],
-                        orient,
-                        (10, 470),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        .5,
-                        (0, 0, 255),
-                        1)       
-                #print("\nreal coords:", real_x, real_y, depth, "\n\n")
-                cv2.circle(results.ims[0], (centerx, centery), 5, (0,0,255), 2)
-                
-                #print("x coordinate: " + str((centerx - 320) * depth_frame.get_distance(centerx, centery) /386))
-                #print("y coordinate: " + str((centery - 240) * depth_frame.get_distance(centerx, centery) /386))
-                #print("Tube is " + str(depth_frame.get_distance(centerx, centery)) + " m away")
-                #print("Rotate " + str(real_xy_angle * 180 / math.pi) + " degrees in the xy plane and " + str(real_depth_angle * 180 / math.pi) + "degrees in the z plane")
-            
-        
-        images = np.hstack((image, depth_colormap))
-        # Show images
-        cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
-        cv2.imshow('RealSense', results.ims[0])
-
-        cv2.waitKey(1)
-finally:
-
-    # Stop streaming
-    pipeline.stop()
+def describeTube(tube):
+    '''
+    Text overlay lines for the reported tube
+    '''
+    lines = []
+    if tube is None or tube.depth <= 0:
+        return lines
+
+    lines.append("X-Coord: " + str(round(tube.robot[0], 2)))
+    lines.append("Y-Coord: " + str(round(tube.robot[1], 2)))
+    lines.append("   Depth: " + str(round(tube.depth, 2)))
+    lines.append("Orientation: " + str(round(tube.orientation, 2)))
+    return lines
+
+
+def wantsImage(opts, server):
+    '''
+    Whether to draw the annotated frame: only when someone is looking
+    '''
+    if server is not None:
+        return server.watching()
+    return not opts.no_display
+
+
+def show(image, lines, opts, server):
+    '''
+    Shows an annotated frame (in a window or on the MJPEG stream), and prints
+    the tube data when there is no window
+    '''
+    if server is not None:
+        server.publish(image)
+    if opts.no_display or server is not None:
+        if lines:
+            print(', '.join(line.strip() for line in lines))
+        return
+    cv2.namedWindow('RealSense', cv2.WINDOW_AUTOSIZE)
+    cv2.imshow('RealSense', image)
+    cv2.waitKey(1)
+
+
+def runSerial(vis, annotator, opts, server):
+    '''
+    Capture, inference, depth math and display one after another
+    '''
+    vis.startStreaming()
+    lastReport = time.monotonic()
+    try:
+        while True:
+            if vis.resolution is not None and time.monotonic() - lastReport > 5:
+                lastReport = time.monotonic()
+                print(vis.resolution.summary()['sizes'])
+
+            frame, detections, tube = vis.detectOneFrame()
+            if frame is None:
+                continue
+
+            lines = describeTube(tube)
+
+            image = None
+            if wantsImage(opts, server):
+                image = annotator.draw(frame.color, detections, tube, lines)
+            show(image, lines, opts, server)
+    finally:
+
+        # Stop streaming
+        vis.stopStreaming()
+
+
+def runPipelined(vis, annotator, opts, server):
+    '''
+    Capture, inference and post-processing each on their own thread, joined by
+    drop-oldest queues, so the frame rate is set by the slowest stage
+    '''
+    def infer(frame):
+        return frame, vis.detect([frame.color])[0]
+
+    def post(item):
+        frame, detections = item
+        tube = vis.selectTube(detections)
+        if tube is not None:
+            vis.measureTube(frame, tube)
+            vis.observeTube(tube)
+            if tube.depth > 0:
+                vis.toRobot([tube])
+        lines = describeTube(tube)
+        image = None
+        if wantsImage(opts, server):
+            image = annotator.draw(frame.color, detections, tube, lines)
+        return image, lines
+
+    pipeline = StagePipeline(opts.queue_size)
+    # Camera errors restart the camera instead of ending the capture stage
+    def capture():
+        return readFrame(vis.source)
+
+    pipeline.add('capture', capture).add('infer', infer).add('post', post)
+
+    vis.source.start()
+    pipeline.start()
+    lastReport = time.monotonic()
+    try:
+        while True:
+            result = pipeline.output.get(timeout=1.0)
+            if result is None:
+                if pipeline.output.closed:
+                    print('Pipeline stopped:', pipeline.errors())
+                    break
+                continue
+            show(*result, opts, server)
+
+            if time.monotonic() - lastReport > 5:
+                lastReport = time.monotonic()
+                print(pipeline.stats())
+                if vis.resolution is not None:
+                    print(vis.resolution.summary()['sizes'])
+    finally:
+        pipeline.stop()
+        vis.source.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Live tube detection viewer')
+    parser.add_argument('--yolo', default='/home/herbie/OVision2022/pyrealsense/librealsense-2.51.1/build/',
+                        help='local YOLOv5 repository')
+    parser.add_argument('--weights', default='best.pt')
+    parser.add_argument('--no-display', action='store_true',
+                        help='do not draw or show frames')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='serve annotated frames as an MJPEG stream instead of a window')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='run capture, inference and post-processing on separate threads')
+    parser.add_argument('--queue-size', type=int, default=2,
+                        help='frames held between pipelined stages before the oldest is dropped')
+    parser.add_argument('--track', type=int, default=1, metavar='N',
+                        help='run the network every N frames and track boxes in between')
+    parser.add_argument('--adaptive', type=float, metavar='MS',
+                        help='pick the input size per frame to stay under MS ms of inference')
+    parser.add_argument('--backend', default='torchscript',
+                        choices=['torchscript', 'onnxruntime', 'opencv', 'hub'])
+    parser.add_argument('--quantize', choices=['dynamic', 'static'],
+                        help='int8 model, onnxruntime backend only')
+    opts = parser.parse_args()
+
+    resolution = None
+    if opts.adaptive:
+        resolution = ResolutionController(latencyTarget=opts.adaptive / 1000)
+
+    # Build Neural Net
+    vis = VisionSystem(opts.yolo, opts.weights, trackEvery=opts.track, resolution=resolution,
+                       backend=opts.backend, quantize=opts.quantize)
+    vis.warmUp()
+    annotator = Annotator(getattr(vis.model, 'names', None))
+
+    server = None
+    if opts.serve:
+        server = MjpegServer(opts.serve).start()
+        print(f'Streaming on http://0.0.0.0:{opts.serve}/')
+
+    try:
+        if opts.pipelined:
+            runPipelined(vis, annotator, opts, server)
+        else:
+            runSerial(vis, annotator, opts, server)
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
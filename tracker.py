@@ -0,0 +1,138 @@
+'''
+Detect-then-track.
+
+The tube barely moves between consecutive frames, so the network only needs
+to run on keyframes. In between, boxes are carried forward with pyramidal
+Lucas-Kanade optical flow on a few corner features inside each box. When
+too few features survive the forward-backward check the track is dropped
+and the next frame is run through the detector again.
+'''
+
+import time
+
+import cv2
+import numpy as np
+
+
+class BoxTracker:
+    '''
+    Optical flow tracker for a set of boxes
+        maxPoints     - features tracked per box
+        minPoints     - fewer surviving features than this loses the track
+        minConfidence - lowest fraction of surviving features to keep a track
+        fbThreshold   - forward-backward error in pixels for a feature to survive
+    '''
+    lkParams = dict(winSize=(15, 15), maxLevel=2,
+                    criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+    def __init__(self, maxPoints=30, minPoints=3, minConfidence=0.5, fbThreshold=1.0):
+        self.maxPoints = maxPoints
+        self.minPoints = minPoints
+        self.minConfidence = minConfidence
+        self.fbThreshold = fbThreshold
+        self.prevGray = None
+        self.tracks = []
+
+    def init(self, gray, rows):
+        '''
+        Starts tracking the boxes in rows (x1, y1, x2, y2, conf, class)
+        '''
+        self.prevGray = gray
+        self.tracks = []
+        height, width = gray.shape
+        for row in rows:
+            x1, y1 = max(int(row[0]), 0), max(int(row[1]), 0)
+            x2, y2 = min(int(row[2]), width), min(int(row[3]), height)
+            if x2 <= x1 or y2 <= y1:
+                continue
+            mask = np.zeros_like(gray)
+            mask[y1:y2, x1:x2] = 255
+            points = cv2.goodFeaturesToTrack(gray, self.maxPoints, 0.01, 3, mask=mask)
+            if points is None or len(points) < self.minPoints:
+                # A box that cannot be tracked means detecting every frame
+                self.tracks = []
+                return
+            self.tracks.append((points.astype(np.float32), np.array(row, np.float32)))
+
+    def update(self, gray):
+        '''
+        Moves every box to the new frame.
+        Returns the moved rows with confidence scaled by the fraction of
+        features that survived, or None if any track was lost.
+        '''
+        if not self.tracks:
+            return None
+
+        tracks = []
+        for points, row in self.tracks:
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(self.prevGray, gray, points, None,
+                                                        **self.lkParams)
+            back, backStatus, _ = cv2.calcOpticalFlowPyrLK(gray, self.prevGray, moved, None,
+                                                           **self.lkParams)
+            error = np.linalg.norm((points - back).reshape(-1, 2), axis=1)
+            good = (status.ravel() == 1) & (backStatus.ravel() == 1) & (error < self.fbThreshold)
+
+            confidence = good.sum() / len(points)
+            if good.sum() < self.minPoints or confidence < self.minConfidence:
+                return None
+
+            old, new = points[good].reshape(-1, 2), moved[good].reshape(-1, 2)
+            dx, dy = np.median(new - old, axis=0)
+
+            # Scale from the change in spread of the features
+            oldSpread = np.linalg.norm(old - old.mean(axis=0), axis=1)
+            newSpread = np.linalg.norm(new - new.mean(axis=0), axis=1)
+            scale = np.median(newSpread[oldSpread > 0] / oldSpread[oldSpread > 0]) \
+                if np.any(oldSpread > 0) else 1.0
+
+            centerx, centery = (row[0] + row[2]) / 2 + dx, (row[1] + row[3]) / 2 + dy
+            halfw, halfh = (row[2] - row[0]) * scale / 2, (row[3] - row[1]) * scale / 2
+            newRow = np.array([centerx - halfw, centery - halfh, centerx + halfw, centery + halfh,
+                               row[4] * confidence, row[5]], np.float32)
+            tracks.append((new.reshape(-1, 1, 2), newRow))
+
+        self.prevGray = gray
+        self.tracks = tracks
+        return np.stack([row for _, row in tracks])
+
+
+class TrackingDetector:
+    '''
+    Wraps a detector (see detector.py) so it only runs every keyEvery frames
+    and boxes are tracked in between. Results have the detector's format,
+    so the depth and orientation code does not know the difference.
+    Frames more than maxGap seconds apart are always detected.
+    '''
+    def __init__(self, detector, keyEvery=5, maxGap=0.5, tracker=None):
+        self.detector = detector
+        self.names = detector.names
+        self.keyEvery = keyEvery
+        self.maxGap = maxGap
+        self.tracker = tracker or BoxTracker()
+        self.sinceKeyframe = 0
+        self.lastTime = 0
+        self.keyframes = 0
+        self.tracked = 0
+
+    def __call__(self, images, size=None):
+        out = []
+        for image in images:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            now = time.monotonic()
+
+            rows = None
+            if self.sinceKeyframe < self.keyEvery - 1 and now - self.lastTime < self.maxGap:
+                rows = self.tracker.update(gray)
+
+            if rows is None:
+                rows = self.detector([image], size)[0]
+                self.tracker.init(gray, rows)
+                self.sinceKeyframe = 0
+                self.keyframes += 1
+            else:
+                self.sinceKeyframe += 1
+                self.tracked += 1
+
+            self.lastTime = now
+            out.append(rows)
+        return out
@@ -4,27 +4,112 @@ sys.path.append(".")
 sys.path.append("/usr/local/lib")
 sys.path.append("/usr/local/lib/python3.8/pyrealsense2")
 
-import pyrealsense2 as rs
 import numpy as np
 import cv2
 import time
-import torch
 import math
 import edge
+import frameSource
+import depthSampler
+import modelCache
+import coordinates
+from detection import Detection
+from sceneCache import Scene, SceneCache
+from tracker import TrackingDetector
+from stageTimer import StageTimer
+
+# Stages and counters kept by VisionSystem.timer; control.py adds the
+# consensus and cord timings and the sample counters
+TIMED_STAGES = ('capture', 'inference', 'depth', 'orientation', 'consensus', 'cord',
+                'background')
+COUNTERS = ('frames', 'good', 'bad', 'none', 'errors')
 
 
 class VisionSystem:
     def __init__(self, directoryOfNNWeights='/home/herbie/OVision2022/yolov5',
-                 nameOfWeights="/home/herbie/OVision2022/yolov5/last.pt"):
-        self.model = torch.hub.load(directoryOfNNWeights, 'custom',
-                                    path=nameOfWeights,
-                                    source='local')
-        self.pipeline = rs.pipeline()
-        self.config = rs.config()
-        
-       
-        self.config.enable_stream(rs.stream.depth, 640, 480, rs.format.z16, 30)
-        self.config.enable_stream(rs.stream.color, 640, 480, rs.format.bgr8, 30)
+                 nameOfWeights="/home/herbie/OVision2022/yolov5/last.pt",
+                 source=None, streaming=False, bufferSize=4, minDepthConfidence=0.1,
+                 model=None, cacheDir=None, trackEvery=1, roiSize=None, roiMargin=0.5,
+                 resolution=None, backend='torchscript', quantize=None, sceneTtl=2.0):
+        '''
+        The model is loaded through modelCache, so only the first boot with a
+        given weights file imports YOLOv5. backend and quantize pick the
+        inference backend (see modelCache.py). A ready made detector can be
+        passed as model instead (see detector.py).
+        With trackEvery above 1 the model only runs every trackEvery frames and
+        boxes are tracked with optical flow in between (see tracker.py).
+        With roiSize set, frames after a hit are cropped around the previous
+        tube (grown by roiMargin of its size on each side) and run at roiSize.
+        resolution is an adaptiveResolution.ResolutionController that picks
+        the input size of full frame calls.
+        source defaults to the RealSense camera; any frameSource.FrameSource
+        (recorded or synthetic frames) can be passed in instead.
+        With streaming the source is kept running on a background thread,
+        otherwise it is started and stopped for every capture.
+        Depth readings with a confidence below minDepthConfidence count as no depth.
+        Every tube of the last frame looked at is kept as a Scene for sceneTtl
+        seconds (see sceneCache.py).
+        '''
+        if roiSize and trackEvery > 1:
+            raise ValueError('ROI crops and tracking cannot be combined')
+        if model is None:
+            sizes = {640}
+            if roiSize:
+                sizes.add(roiSize)
+            if resolution is not None:
+                sizes.update(resolution.sizes)
+            model = modelCache.loadModel(directoryOfNNWeights, nameOfWeights, cacheDir, sizes,
+                                         backend, quantize)
+        if trackEvery > 1:
+            model = TrackingDetector(model, trackEvery)
+        self.model = model
+        self.source = source if source is not None else frameSource.RealSenseSource()
+        self.bufferSize = bufferSize
+        self.engine = None
+        self.lastFrameIndex = -1
+        self.minDepthConfidence = minDepthConfidence
+        self.roiSize = roiSize
+        self.roiMargin = roiMargin
+        self.roiBox = None
+        self.resolution = resolution
+        self.timer = StageTimer(TIMED_STAGES, COUNTERS)
+        self.geometry = None
+        self.scenes = SceneCache(sceneTtl)
+        if streaming:
+            self.startStreaming()
+
+    def warmUp(self, runs=2):
+        '''
+        Runs the model on blank frames so the first real request does not pay
+        for lazy initialization. With a resolution controller every one of
+        its sizes is warmed up, as the first call at a new input shape is slow
+        and would make the controller avoid that size.
+        Returns the time taken in seconds.
+        '''
+        start = time.monotonic()
+        blank = np.zeros((480, 640, 3), np.uint8)
+        sizes = self.resolution.sizes if self.resolution is not None else [None]
+        for size in sizes:
+            for _ in range(runs):
+                if size is None:
+                    self.model([blank])
+                else:
+                    self.model([blank], size=size)
+        return time.monotonic() - start
+
+    def startStreaming(self):
+        '''
+        Keeps the camera running so captures no longer pay for start up and
+        auto-exposure settling
+        '''
+        if self.engine is None:
+            self.engine = frameSource.CaptureEngine(self.source, self.bufferSize)
+            self.engine.start()
+
+    def stopStreaming(self):
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine = None
 
     def processOneFrame(self):
         '''
@@ -34,56 +119,307 @@ class VisionSystem:
             int, int, 0, int -> found a tube but couldnt get depth info
             -1, -1, -1, -1 -> no tube found
         '''
-        color_frame, depth_frame = self.captureImage()
-        results = self.checkForTube(color_frame)
-        return self.getTubeData(color_frame, depth_frame, results)
+        frame, _, tube = self.detectOneFrame()
+        if tube is None:
+            return -1, -1, -1, -1
+        return tube.asTuple()
+
+    def detectOneFrame(self):
+        '''
+        Captures and processes one frame.
+        Returns the frame, every Detection in it and the measured tube
+        (None if there is no frame or no tube).
+        '''
+        frame = self.captureFrame()
+        if frame is None:
+            return None, [], None
+        detections = self.detect([frame.color])[0]
+        tube = self.selectTube(detections)
+        if tube is not None:
+            self.measureTube(frame, tube)
+            self.observeTube(tube)
+            if tube.depth > 0:
+                self.toRobot([tube])
+        return frame, detections, tube
+
+    def processFrames(self, n):
+        '''
+        Captures n frames and runs them through the model as a single batch.
+        Returns a list with one processOneFrame style tuple per frame.
+        '''
+        return [tube.asTuple() if tube is not None else (-1, -1, -1, -1)
+                for tube in self.locateFrames(n)]
+
+    def locateFrames(self, n):
+        '''
+        Captures n frames, runs them through the model as a single batch and
+        measures the tube in each. Tubes with depth also get robot coordinates,
+        converted together in one step.
+        Returns one Detection (or None where there is no tube) per frame.
+        The other tubes of the last frame are measured too and cached as a Scene.
+        '''
+        frames = self.captureFrames(n)
+        if not frames:
+            return [None]
+        detections = self.detect([frame.color for frame in frames])
+        tubes = [self.selectTube(dets) for dets in detections]
+        others = [tube for tube in detections[-1] if tube is not tubes[-1]]
+        for frame, tube in zip(frames, tubes):
+            if tube is not None:
+                self.measureTube(frame, tube)
+        for tube in others:
+            self.measureTube(frames[-1], tube)
+        if tubes[-1] is not None:
+            self.observeTube(tubes[-1])
+        self.toRobot([tube for tube in tubes + others if tube is not None and tube.depth > 0])
+        self.scenes.store(Scene(frames[-1], detections[-1]))
+        return tubes
+
+    def captureScene(self):
+        '''
+        Captures one frame and measures every tube in it.
+        Returns the new Scene, also kept in self.scenes, or None without a frame.
+        '''
+        frame = self.captureFrame()
+        if frame is None:
+            return None
+        detections = self.detect([frame.color])[0]
+        for tube in detections:
+            self.measureTube(frame, tube)
+        tube = self.selectTube(detections)
+        if tube is not None:
+            self.observeTube(tube)
+        self.toRobot([tube for tube in detections if tube.depth > 0])
+        return self.scenes.store(Scene(frame, detections))
+
+    def latestScene(self):
+        '''
+        The cached Scene if it is still fresh, else None. While streaming,
+        the newest buffered frame is also checked for changes.
+        '''
+        frame = self.engine.latest(timeout=0) if self.engine is not None else None
+        return self.scenes.current(frame)
+
+    def captureFrame(self):
+        '''
+        Returns the newest FramePair, or None if the camera gave nothing.
+        While streaming this only waits if the newest frame was already used,
+        and a capture engine that stopped on a camera error is restarted.
+        '''
+        start = time.perf_counter()
+        if self.engine is not None:
+            if not self.engine.running:
+                print('Capture stopped, restarting it:', self.engine.error)
+                self.engine.restart()
+            frame = self.engine.latest(after=self.lastFrameIndex)
+        else:
+            self.source.start()
+            try:
+                frame = frameSource.readFrame(self.source)
+            finally:
+                self.source.stop()
+        if frame is not None:
+            self.lastFrameIndex = frame.index
+        self.timer.record('capture', start)
+        return frame
+
+    def captureFrames(self, n):
+        '''
+        Returns up to n distinct frames, oldest first. Without streaming the
+        camera is only started once for the whole set.
+        '''
+        if self.engine is not None:
+            frames = []
+            for _ in range(n):
+                frame = self.captureFrame()
+                if frame is None:
+                    break
+                frames.append(frame)
+            return frames
+
+        start = time.perf_counter()
+        frames = []
+        self.source.start()
+        try:
+            for _ in range(n):
+                frame = frameSource.readFrame(self.source)
+                if frame is None:
+                    break
+                frames.append(frame)
+        finally:
+            self.source.stop()
+        if frames:
+            self.lastFrameIndex = frames[-1].index
+        self.timer.record('capture', start)
+        return frames
 
     def captureImage(self):
-        self.pipeline.start(self.config)
-        frames = self.pipeline.wait_for_frames()
-        depth_frame = frames.get_depth_frame()
-        color_frame = frames.get_color_frame()
-        self.pipeline.stop()
-        return color_frame, depth_frame 
-
-    def checkForTube(self, color_frame):
-        color_image = np.asanyarray(color_frame.get_data())
-        results = self.model(color_image)
-        results.render()
+        frame = self.captureFrame()
+        if frame is None:
+            return None, None
+        return frame.color, frame.depth
+
+    def detect(self, color_images):
+        '''
+        Runs a batch of images through the model.
+        Returns one list of Detections per image.
+        '''
+        began = time.perf_counter()
+        if self.roiSize and self.roiBox is not None:
+            results = self.detectInRoi(color_images)
+        elif self.resolution is not None:
+            size = self.resolution.choose(color_images[0].shape)
+            start = time.perf_counter()
+            results = self.model(color_images, size=size)
+            latency = (time.perf_counter() - start) / len(color_images)
+            self.resolution.record(size, latency, any(len(rows) for rows in results))
+        else:
+            results = self.model(color_images)
+        detections = [Detection.fromRows(rows) for rows in results]
+
+        # Remember where the tube is for the next crop
+        if self.roiSize:
+            tube = self.selectTube(detections[-1])
+            self.roiBox = tube.box if tube is not None else None
+        if self.resolution is not None and not detections[-1]:
+            self.resolution.observe(None)
+        self.timer.count('frames', len(color_images))
+        self.timer.record('inference', began)
+        return detections
+
+    def roiWindow(self, shape):
+        '''
+        Crop (left, top, right, bottom) around the previous tube
+        '''
+        x1, y1, x2, y2 = self.roiBox
+        marginx = max((x2 - x1) * self.roiMargin, 32)
+        marginy = max((y2 - y1) * self.roiMargin, 32)
+        return (max(int(x1 - marginx), 0), max(int(y1 - marginy), 0),
+                min(int(x2 + marginx), shape[1]), min(int(y2 + marginy), shape[0]))
+
+    def detectInRoi(self, color_images):
+        '''
+        Runs crops around the previous tube at the smaller roiSize and maps the
+        boxes back to full frame pixels. Images where the crop finds nothing,
+        or cuts through a detection, are run again on the full frame.
+        '''
+        left, top, right, bottom = self.roiWindow(color_images[0].shape)
+        crops = [image[top:bottom, left:right] for image in color_images]
+        results = self.model(crops, size=self.roiSize)
+
+        missed = []
+        for i, rows in enumerate(results):
+            rows = rows.copy()
+            rows[:, [0, 2]] += left
+            rows[:, [1, 3]] += top
+            results[i] = rows
+
+            # A box on a crop edge that is not also the image edge was cut off
+            height, width = color_images[i].shape[:2]
+            cut = (((rows[:, 0] <= left + 2) & (left > 0)) |
+                   ((rows[:, 1] <= top + 2) & (top > 0)) |
+                   ((rows[:, 2] >= right - 2) & (right < width)) |
+                   ((rows[:, 3] >= bottom - 2) & (bottom < height)))
+            if not len(rows) or cut.any():
+                missed.append(i)
+
+        if missed:
+            full = self.model([color_images[i] for i in missed])
+            for i, rows in zip(missed, full):
+                results[i] = rows
+        return results
+
+    def checkForTube(self, color_image):
+        return self.selectTube(self.detect([color_image])[0])
+
+    def selectTube(self, detections):
+        '''
+        Picks the detection to report out of one image's Detections: the most
+        confident one
+        '''
         highestConf = -1
         bestResults = None
-        #print(results.xyxy)
-        if not results.xyxy:
-            return None
-
-        for i in results.xyxy[0]:
-            if i[5] > highestConf:
+        for i in detections:
+            if i.confidence > highestConf:
+                highestConf = i.confidence
                 bestResults = i
 
         return bestResults
 
-    def getTubeData(self, color_frame, depth_frame, tubeResults):
-        if tubeResults is not None:
-            centerx, centery = self.getTubePixelCoordinates(tubeResults)
-            realx, realy, depth = self.translatePixelsToReal(centerx, centery, depth_frame)
-            orientation = self.getTubeOrientation(color_frame, tubeResults, centerx, centery)
-            return realx, realy, depth, orientation
+    def measureTube(self, frame, tube):
+        '''
+        Fills in the depth, position and orientation of a Detection
+        '''
+        start = time.perf_counter()
+        centerx, centery = self.getTubePixelCoordinates(tube)
+        tube.realx, tube.realy, tube.depth = self.translatePixelsToReal(centerx, centery,
+                                                                        frame, tube)
+        start = self.timer.record('depth', start)
+        tube.orientation = self.getTubeOrientation(frame.color, tube, centerx, centery)
+        self.timer.record('orientation', start)
+        return tube
+
+    def observeTube(self, tube):
+        '''
+        Lets the resolution controller size the next inference from the
+        measured tube. Only for the tube being reported, not the other
+        tubes of a scene.
+        '''
+        if self.resolution is not None:
+            self.resolution.observe(tube.box, tube.depth)
+
+    def getTubeData(self, frame, tube):
+        if tube is not None:
+            self.measureTube(frame, tube)
+            self.observeTube(tube)
+            return tube.asTuple()
         return -1, -1, -1, -1
 
-    def getTubePixelCoordinates(self, tubeResults):
-        centerx = int((tubeResults[0] + tubeResults[2]) / 2)
-        centery = int((tubeResults[1] + tubeResults[3]) / 2)
-        return centerx, centery
+    def getTubePixelCoordinates(self, tube):
+        return tube.center()
+
+    def getGeometry(self):
+        '''
+        The pixel to robot coordinate tables, built once the camera's
+        intrinsics are known (see coordinates.py)
+        '''
+        if self.geometry is None:
+            intrinsics = self.source.intrinsics or coordinates.DEFAULT_INTRINSICS
+            self.geometry = coordinates.RobotGeometry(intrinsics)
+        return self.geometry
+
+    def toRobot(self, tubes):
+        '''
+        Sets the robot coordinates of measured Detections, all in one
+        vectorized lookup. Returns them as an (n, 3) array.
+        '''
+        if not tubes:
+            return np.zeros((0, 3))
+        geometry = self.getGeometry()
+        centers = np.array([tube.center() for tube in tubes])
+        us = centers[:, 0].clip(0, geometry.intrinsics.width - 1)
+        vs = centers[:, 1].clip(0, geometry.intrinsics.height - 1)
+        points = geometry.toRobot(us, vs, [tube.depth for tube in tubes])
+        for tube, point in zip(tubes, points.tolist()):
+            tube.robot = tuple(point)
+        return points
 
-    def translatePixelsToReal(self, centerx, centery, depth_frame):
-        depth = depth_frame.get_distance(centerx, centery) * 100
-        realx = (centerx - 320) * depth / 386
-        realy = (centery - 240) * depth / 386
+    def translatePixelsToReal(self, centerx, centery, frame, tube):
+        depth, tube.depthConfidence = depthSampler.sampleDepth(frame.depth, frame.depthScale,
+                                                               tube.box,
+                                                               aligner=self.source.aligner)
+        if tube.depthConfidence < self.minDepthConfidence:
+            depth = 0
+        geometry = self.getGeometry()
+        centerx = min(max(centerx, 0), geometry.intrinsics.width - 1)
+        centery = min(max(centery, 0), geometry.intrinsics.height - 1)
+        realx, realy, _ = geometry.toCamera(centerx, centery, depth).tolist()
         return realx, realy, depth
 
-    def getTubeOrientation(self, color_frame, tubeResults, centerx, centery):
-        xdist = (tubeResults[0] - tubeResults[2])
-        ydist = (tubeResults[1] - tubeResults[3])
+    def getTubeOrientation(self, color_image, tube, centerx, centery):
+        x1, y1, x2, y2 = tube.box
+        xdist = (x1 - x2)
+        ydist = (y1 - y2)
         ratio = xdist / ydist
 
         if ratio > 3:
@@ -91,10 +427,9 @@ class VisionSystem:
         elif ratio < .55:
             return 0
 
-        color_image = np.asanyarray(color_frame.get_data())
         return int(edge.get_degrees(
-            (int(tubeResults[0]), int(tubeResults[1])),
-            (int(tubeResults[2]), int(tubeResults[3])),
+            (int(x1), int(y1)),
+            (int(x2), int(y2)),
             (centerx, centery),
             color_image)
         )